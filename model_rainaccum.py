@@ -12,7 +12,12 @@ from netCDF4 import num2date
 from dateutil import parser, tz
 from datetime import datetime
 from ncdump import ncdump
-from subprocess import call
+import wxdata
+import wxcache
+import wxparallel
+import wxmaps
+import wxaccum
+import wxanim
 #import matplotlib.colors as cols
 #import matplotlib.cm as cm
 
@@ -24,49 +29,14 @@ upper_lat = 50.0
 left_lon  = -105.0
 right_lon = -82.0
 select_model = 'hrrr'
+workers = wxparallel.WORKERS  # Processes used to render the frames
+stills = True  # Also save every frame as a 300 dpi PNG
 
 centerpt_lat = (lower_lat + upper_lat) / 2 #Calculate centerpoint lat
 centerpt_lon = (left_lon + right_lon) / 2  #Calculate centerpoint lon
 mapwidth  = abs((left_lon-right_lon)*81541)   #Calculate approx mapwidth
 mapheight = abs((upper_lat-lower_lat)*111092) #Calculate approx mapheight
 
-##################################################
-# Retrieve today's date in UTC                   #
-# Define the model cycle you want (00Z,12Z,etc.) #
-##################################################
-#mydate = datetime.utcnow().strftime("%Y%m%d")
-mydate = raw_input('Enter YYYYMMDD: ')
-mydate = str(mydate)
-cycle  = raw_input('Enter UTC time: ')
-
-###########################################
-# Define model dataset from NOMADS server #
-# Comment out the datasets you don't want #
-###########################################
-model = {'gfs'  : 'gfs_0p25/gfs'+mydate+'/gfs_0p25_'+cycle+'z',
-         'arw'  : 'hiresw/hiresw'+mydate+'/hiresw_conusarw_'+cycle+'z',
-         'nmm'  : 'hiresw/hiresw'+mydate+'/hiresw_conusnmmb_'+cycle+'z',
-         'hrrr' : 'hrrr/hrrr'+mydate+'/hrrr_sfc_'+cycle+'z',
-         'narre': 'narre/narre'+mydate+'/narre_130_mean_'+cycle+'z',
-         'nww3' : 'wave/nww3/nww3'+mydate+'/nww3'+mydate+'_'+cycle+'z',
-         'nam4k': 'nam/nam'+mydate+'/nam1hr_'+cycle+'z',
-         'rap'  : 'rap/rap'+mydate+'/rap_'+cycle+'z'}
-
-model_path = model.get(select_model,0)
-
-########################################
-# Define NOMADS Data URL               #
-# Include model you want at end of URL #
-########################################
-print 'Retrieving file...'
-url = 'http://nomads.ncep.noaa.gov:9090/dods/'+model_path
-print 'URL:', url
-
-#################
-# Create lists #
-################
-validtimes = list()
-
 #############################################################
 # Build function to extract array index from lat/lon points #
 # Define domain over which to plot the weather data         #
@@ -75,71 +45,30 @@ def getnearpos(array,value):
     idx = (np.abs(array-value)).argmin()
     return idx
 
-##########################################
-# Extract variables from the NETCDF file #
-# Count the number of timesteps          #
-# Convert valid times to UTC and local   #
-##########################################
-file = netCDF4.Dataset(url)
-print 'File opened successfully! Processing data...'
-lats  = file.variables['lat'][:]
-lons  = file.variables['lon'][:]
-lower_lat_idx = getnearpos(lats,lower_lat)
-upper_lat_idx = getnearpos(lats,upper_lat)
-left_lon_idx = getnearpos(lons,left_lon)
-right_lon_idx = getnearpos(lons,right_lon)
-lats = lats[lower_lat_idx:upper_lat_idx]
-lons = lons[left_lon_idx:right_lon_idx]
-
-time = file.variables['time'][:]
-timeunits = file.variables['time'].units
-from_zone = tz.gettz('UTC')
-to_zone = tz.gettz('America/Chicago')
-for timesteps,validtime in enumerate(time):
-    validtime = num2date(validtime,units=timeunits)
-    validtime = validtime.replace(tzinfo=from_zone)
-    validtime = validtime.astimezone(to_zone)
-    validtime = validtime.strftime('%I %p CT, %A, %B %d, %Y')
-    validtimes.append(validtime)
-
-#################################################################
-# Initialize desired variable to 0 (which happens to be time 0) #
-#################################################################
-sumprecip = file.variables['apcpsfc'][0,lower_lat_idx:upper_lat_idx,
-left_lon_idx:right_lon_idx]
-
-###########################################
-# Use this code for RAP QPF Accumulations #
-###########################################
-#for i in [1,2,3,6,9,12,15,18]:
-#    print 'Creating image (or hour)',i,'...'
-#    qpf = file.variables['apcpsfc'][i,lower_lat_idx:upper_lat_idx,
-#    left_lon_idx:right_lon_idx]
-#    sumprecip = np.add(qpf,sumprecip)
-
-############################################
-# Use this code for HRRR QPF Accumulations #
-############################################
-for i in range(1,timesteps):
-    print 'Creating image',i,'...'
-    qpf = file.variables['apcpsfc'][i,lower_lat_idx:upper_lat_idx,
-    left_lon_idx:right_lon_idx]
-    sumprecip = np.add(qpf,sumprecip)
+###################################################################
+# Build Map Features, like continents, states, lat/lon lines, and #
+# other physical features once, and reuse them for every image    #
+###################################################################
+def drawland(m,ax):
+    m.fillcontinents(color='#e6e6e6',lake_color='#b3ffff',ax=ax)
+    m.drawmapboundary(fill_color='#b3ffff',ax=ax)
+
+def drawlines(m,ax):
+    m.drawcoastlines(linewidth=0.75,zorder=5,ax=ax)
+    m.drawcounties(linewidth=0.3,color='gray',zorder=5,ax=ax)
+    m.drawstates(linewidth=0.75,zorder=6,ax=ax)
+    m.drawcountries(linewidth=1.0,zorder=7,ax=ax)
+    #m.drawparallels(np.arange(-90.,120.,30.),labels=[1,0,0,0],ax=ax)
+    #m.drawmeridians(np.arange(-180.,180.,60.),labels=[0,0,0,1],ax=ax)
 
 #############################################################
-# Plot the field using Basemap.  Start with setting the map #
-# projection using the limits of the lat/lon data itself:   #
+# Render each timestep; frames are spread over worker       #
+# processes that read the totals from shared memory, and    #
+# get the map and its grids with the other arguments        #
 #############################################################
-    m = Basemap(width=mapwidth,height=mapheight,\
-                rsphere=(6378137.00,6356752.3142),\
-                resolution='i',area_thresh=1000.,projection='lcc',\
-                lat_1=lower_lat,lat_2=upper_lat,\
-                lat_0=centerpt_lat,lon_0=centerpt_lon)
-
-#################################################
-# convert the lat/lon values to x/y projections #
-#################################################
-    x,y = m(*np.meshgrid(lons,lats))
+def rainframe(fields, i, m, x, y, background, validtimes):
+    print('Creating image',i,'...')
+    sumprecip = fields['sumprecip'][i]
 
 ###############################
 # Define custom color palette #
@@ -166,18 +95,7 @@ for i in range(1,timesteps):
     cbar.ax.set_ylabel('inches')
     cbar.ax.tick_params(labelsize=10)
 
-###################################################################
-# Build Map Features, like continents, states, lat/lon lines, and #
-# other physical features                                         #
-###################################################################
-    m.drawcoastlines(linewidth=0.75,zorder=5)
-    m.fillcontinents(color='#e6e6e6',lake_color='#b3ffff')
-    m.drawcountries(linewidth=1.0,zorder=7)
-    m.drawstates(linewidth=0.75,zorder=6)
-    m.drawcounties(linewidth=0.3,color='gray',zorder=5)
-    m.drawmapboundary(fill_color='#b3ffff')
-    #m.drawparallels(np.arange(-90.,120.,30.),labels=[1,0,0,0])
-    #m.drawmeridians(np.arange(-180.,180.,60.),labels=[0,0,0,1])
+    background.draw()
 
 ##############################################
 # Add a title, and then show the plot.       #
@@ -186,28 +104,111 @@ for i in range(1,timesteps):
     plt.suptitle('Precipitation Total',fontsize=14,fontweight='bold')
     plt.title('Model: NCEP '+str.upper(select_model)+'\nThrough '+validtimes[i]+'',
     fontsize=12)
-    plt.savefig(''+select_model+'/'+select_model+str(i).zfill(2)+'.png',
-    dpi=300, bbox_inches='tight')
-    print 'Finished creating image',i
+    if stills:
+        plt.savefig(''+select_model+'/'+select_model+str(i).zfill(2)+'.png',
+        dpi=300, bbox_inches='tight')
+    frame = wxanim.canvasframe()
+    print('Finished creating image',i)
     #plt.show()
-file.close()
-
-#######################################
-# Image Post-Processing               #
-# Make animated GIF using ImageMagick #
-#######################################
-print 'Creating animated GIF'
-call(["convert","-delay","80","-loop","0",""+select_model+"*.png","-delay",
-"200","-loop","0",""+select_model+str(i)+".png","-resize","1024x512",
-""+select_model+".gif"],cwd=select_model)
-print 'Finished creating animated GIF'
-
-#######################################
-# Make MPEG4 animation using FFMPEG   #
-#######################################
-print 'Creating MP4'
-call(["ffmpeg","-i",""+select_model+".gif","-pix_fmt","yuv420p","-y",
-""+select_model+".mp4"],cwd=select_model)
-print 'Finished creating MP4'
-
-print 'The program has completed. Enjoy your day!'
+    plt.close()
+    return frame
+
+#############################################################
+# Spawned render workers import this script, so only ask    #
+# for the cycle, read the data and render the frames when   #
+# it is run directly                                        #
+#############################################################
+if __name__ == '__main__':
+    ##################################################
+    # Retrieve today's date in UTC                   #
+    # Define the model cycle you want (00Z,12Z,etc.) #
+    ##################################################
+    #mydate = datetime.utcnow().strftime("%Y%m%d")
+    mydate = input('Enter YYYYMMDD: ')
+    mydate = str(mydate)
+    cycle  = input('Enter UTC time: ')
+
+    ###########################################
+    # Define model dataset from NOMADS server #
+    # Comment out the datasets you don't want #
+    ###########################################
+    model = {'gfs'  : 'gfs_0p25/gfs'+mydate+'/gfs_0p25_'+cycle+'z',
+             'arw'  : 'hiresw/hiresw'+mydate+'/hiresw_conusarw_'+cycle+'z',
+             'nmm'  : 'hiresw/hiresw'+mydate+'/hiresw_conusnmmb_'+cycle+'z',
+             'hrrr' : 'hrrr/hrrr'+mydate+'/hrrr_sfc_'+cycle+'z',
+             'narre': 'narre/narre'+mydate+'/narre_130_mean_'+cycle+'z',
+             'nww3' : 'wave/nww3/nww3'+mydate+'/nww3'+mydate+'_'+cycle+'z',
+             'nam4k': 'nam/nam'+mydate+'/nam1hr_'+cycle+'z',
+             'rap'  : 'rap/rap'+mydate+'/rap_'+cycle+'z'}
+
+    model_path = model.get(select_model,0)
+
+    ########################################
+    # Define NOMADS Data URL               #
+    # Include model you want at end of URL #
+    ########################################
+    print('Retrieving file...')
+    url = 'http://nomads.ncep.noaa.gov:9090/dods/'+model_path
+    print('URL:', url)
+
+    ##########################################
+    # Extract variables from the NETCDF file #
+    # Count the number of timesteps          #
+    # Convert valid times to UTC and local   #
+    ##########################################
+    file = wxdata.openfile(url, wxcache.FieldCache())
+    print('File opened successfully! Processing data...')
+    lats  = file.variables['lat'][:]
+    lons  = file.variables['lon'][:]
+    lower_lat_idx = getnearpos(lats,lower_lat)
+    upper_lat_idx = getnearpos(lats,upper_lat)
+    left_lon_idx = getnearpos(lons,left_lon)
+    right_lon_idx = getnearpos(lons,right_lon)
+    lats = lats[lower_lat_idx:upper_lat_idx]
+    lons = lons[left_lon_idx:right_lon_idx]
+
+    timeaxis = wxdata.timeaxis(file)
+    validtimes = timeaxis.labels('%I %p CT, %A, %B %d, %Y')
+    timesteps = len(timeaxis) - 1
+
+    #################################################################
+    # Total the QPF through every timestep, following the model's   #
+    # bucket resets (wxaccum.BUCKETS covers the RAP and the GFS)    #
+    #################################################################
+    domain = (lats, lons, lower_lat_idx, upper_lat_idx, left_lon_idx, right_lon_idx)
+    sumprecips = wxaccum.accumulate(file, select_model.upper(), domain, stop=timesteps)
+
+    #############################################################
+    # Plot the field using Basemap.  Start with setting the map #
+    # projection using the limits of the lat/lon data itself:   #
+    #############################################################
+    m = Basemap(width=mapwidth,height=mapheight,\
+                rsphere=(6378137.00,6356752.3142),\
+                resolution='i',area_thresh=1000.,projection='lcc',\
+                lat_1=lower_lat,lat_2=upper_lat,\
+                lat_0=centerpt_lat,lon_0=centerpt_lon)
+
+    #################################################
+    # convert the lat/lon values to x/y projections #
+    #################################################
+    x,y = wxmaps.projectgrid(m,lats,lons)
+
+    background = wxmaps.MapBackground(m,[('land',1,drawland),
+                                         ('coasts-counties-states-countries',5,drawlines)])
+    background.load()
+
+    ##############################################
+    # Render the frames and encode the animated  #
+    # GIF and MP4 from them as they are finished #
+    ##############################################
+    animation = wxanim.Animation(select_model+'/'+select_model)
+    wxparallel.renderframes(rainframe, {'sumprecip': sumprecips},
+                            range(1, timesteps), workers, consume=animation.add,
+                            m=m, x=x, y=y, background=background, validtimes=validtimes)
+    file.close()
+
+    print('Creating animated GIF and MP4')
+    animation.close()
+    print('Finished creating animated GIF and MP4')
+
+    print('The program has completed. Enjoy your day!')
@@ -9,8 +9,9 @@ from netCDF4 import num2date
 from dateutil import parser, tz
 from datetime import datetime
 from ncdump import ncdump
-from subprocess import call
 import os
+import wxdata
+import wxanim
 
 # Parameters
 select_model = 'hrrr'
@@ -46,18 +47,10 @@ def getmodel(select_model):
 
 # Calculate local times
 def gettimes():
-    validtimes = list()
     getmodel(select_model)
-    time = file.variables['time'][:]
-    timeunits = file.variables['time'].units
-    from_zone = tz.gettz('UTC')
-    to_zone = tz.gettz('America/Chicago')
-    for timesteps,validtime in enumerate(time):
-        validtime = num2date(validtime,units=timeunits)
-        validtime = validtime.replace(tzinfo=from_zone)
-        validtime = validtime.astimezone(to_zone)
-        validtime = validtime.strftime('%I %p CT, %A, %B %d, %Y')
-        validtimes.append(validtime)
+    timeaxis = wxdata.timeaxis(file)
+    validtimes = timeaxis.labels('%I %p CT, %A, %B %d, %Y')
+    timesteps = len(timeaxis) - 1
 
     return timesteps, validtimes
 
@@ -98,20 +91,10 @@ def mapbanner(title):
     plt.title('\nModel: NCEP '+str.upper(select_model)+'', fontsize=8,
               loc='right')
 
-# Animated GIF using ImageMagick
-def animated_gif(select_model, i):
-    print 'Creating animated GIF'
-    call(["convert","-delay","80","-loop","0",""+select_model+"*.png","-delay",
-         "200","-loop","0",""+select_model+str(i)+".png","-resize","1024x512",
-         ""+select_model+".gif"],cwd=select_model)
-    print 'Finished creating animated GIF'
-
-def mp4(select_model):
-    print 'Creating MP4'
-    call(["ffmpeg", "-framerate", "1/1", "-i", ""+select_model+"%02d.png",
-         "-vcodec", "libx264", "-crf","25", "-pix_fmt", "yuv420p", "-y", "-vf",
-         "scale=1024:512", ""+select_model+".mp4"], cwd=select_model)
-    print 'Finished creating MP4'
+# Animated GIF and MP4 encoded from the figures as they are drawn:
+# call animation.addfigure() after each frame, then animation.close()
+def animation(select_model):
+    return wxanim.Animation(select_model+'/'+select_model)
 
 # Define preset mapviews for ease of use
 class Maps(object):
@@ -3,12 +3,16 @@
 from mpl_toolkits.basemap import Basemap
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import netCDF4
 from netCDF4 import num2date
 from dateutil import parser, tz
 from datetime import datetime
 import geography
+import wxdata
+import wxcache
+import wxparallel
+import wxmaps
+import wxptype
 
 ########################################
 # Define geographical domain and model #
@@ -18,6 +22,7 @@ upper_lat = 50.0
 left_lon = -105
 right_lon = -82
 select_model = 'narre'
+workers = wxparallel.WORKERS  # Processes used to render the frames
 
 centerpt_lat = (lower_lat + upper_lat) / 2 #Calculate centerpoint lat
 centerpt_lon = (left_lon + right_lon) / 2  #Calculate centerpoint lon
@@ -45,19 +50,6 @@ model = {'gfs'  : 'gfs_0p25/gfs'+mydate+'/gfs_0p25_'+cycle+'z',
          'nam4k': 'nam/nam'+mydate+'/nam1hr_'+cycle+'z',
          'rap'  : 'rap/rap'+mydate+'/rap_'+cycle+'z'}
 
-select_model = model.get(select_model, 0)
-
-########################################
-# Define NOMADS Data URL               #
-# Include model you want at end of URL #
-########################################
-url = 'http://nomads.ncep.noaa.gov:9090/dods/' + select_model
-print('URL:', url)
-
-#################
-# Create lists #
-################
-validtimes = list()
 
 #############################################################
 # Build function to extract array index from lat/lon points #
@@ -67,95 +59,39 @@ def getnearpos(array, value):
     idx = (np.abs(array-value)).argmin()
     return idx
 
-##########################################
-# Extract variables from the NETCDF file #
-# Count the number of timesteps          #
-# Convert valid times to UTC and local   #
-##########################################
-file = netCDF4.Dataset(url)
-print('File opened successfully! Processing data...')
-lats = file.variables['lat'][:]
-lons = file.variables['lon'][:]
-lower_lat_idx = getnearpos(lats, lower_lat)
-upper_lat_idx = getnearpos(lats, upper_lat)
-left_lon_idx = getnearpos(lons, left_lon)
-right_lon_idx = getnearpos(lons, right_lon)
-lats = lats[lower_lat_idx:upper_lat_idx]
-lons = lons[left_lon_idx:right_lon_idx]
-
-time = file.variables['time'][:]
-timeunits = file.variables['time'].units
-from_zone = tz.gettz('UTC')
-to_zone = tz.gettz('America/Chicago')
-for timesteps, validtime in enumerate(time):
-    validtime = num2date(validtime, units=timeunits)
-    validtime = validtime.replace(tzinfo=from_zone)
-    validtime = validtime.astimezone(to_zone)
-    validtime = validtime.strftime('%I %p CT, %A, %B %d, %Y')
-    validtimes.append(validtime)
-
-i = -1
-while i < timesteps:
-    i = i+1
-    print('Creating image', i, '...')
-    rain = file.variables['crainsfc'][0, i, lower_lat_idx:upper_lat_idx,
-                                      left_lon_idx:right_lon_idx]
-    snow = file.variables['csnowsfc'][0, i, lower_lat_idx:upper_lat_idx,
-                                      left_lon_idx:right_lon_idx]
-    sleet = file.variables['cicepsfc'][0, i, lower_lat_idx:upper_lat_idx,
-                                       left_lon_idx:right_lon_idx]
-    frzrain = file.variables['cfrzrsfc'][0, i, lower_lat_idx:upper_lat_idx,
-                                         left_lon_idx:right_lon_idx]
-    plt.figure()
+################################################
+# Build Map Features, like continents, states, #
+# lat/lon lines, and other physical features   #
+# once, and reuse them for every image         #
+################################################
+def drawLand(m, ax):
+    m.fillcontinents(color='#e6e6e6', lake_color='#b3ffff', ax=ax)
+    m.drawmapboundary(fill_color='#b3ffff', ax=ax)
+
+def drawLines(m, ax):
+    m.drawcoastlines(linewidth=0.75, zorder=5, ax=ax)
+    m.drawstates(linewidth=0.75, zorder=6, ax=ax)
+    m.drawcountries(linewidth=1.0, zorder=7, ax=ax)
 
 #############################################################
-# Plot the field using Basemap.  Start with setting the map #
-# projection using the limits of the lat/lon data itself:   #
+# Render each timestep; frames are spread over worker       #
+# processes that read the fields from shared memory, and    #
+# get the map and its grids with the other arguments        #
 #############################################################
-    m = Basemap(width=mapwidth, height=mapheight, \
-                rsphere=(6378137.00, 6356752.3142), \
-                resolution='i', area_thresh=1000., projection='lcc', \
-                lat_1=lower_lat, lat_2=upper_lat, \
-                lat_0=centerpt_lat, lon_0=centerpt_lon)
+def ptypeframe(fields, i, m, x, y, background, validtimes):
+    print('Creating image', i, '...')
+    plt.figure()
 
-#################################################
-# convert the lat/lon values to x/y projections #
-#################################################
-    x, y = m(*np.meshgrid(lons, lats))
-
-# plot the field using the fast pcolormesh routine
-# set the colormap to jet.
-    clevs = [0.25, 1]
-    #clevs = [0.01,0.05,0.10,0.25,0.50,0.75,1.00,1.50,2.00,5.00]
-    m.contourf(x, y, rain, clevs, colors='#00b300', zorder=4)
-    m.contourf(x, y, snow, clevs, colors='#8080ff', zorder=4)
-    m.contourf(x, y, sleet, clevs, colors='#ffcc80', zorder=4)
-    m.contourf(x, y, frzrain, clevs, colors='#ff80bf', zorder=4)
+# plot the precipitation type classes in one raster pass
+    wxptype.draw(m, x, y, fields['ptype'][i])
     #m.contour(x,y,qpf/25.4,clevs,linewidths=[1],zorder=5)
 
-    #m.pcolormesh(x,y,data,shading='flat',cmap=plt.cm.jet)
-
 # Add legend patches
 
-    snow_patch = mpatches.Patch(color='#8080ff', label='Snow')
-    sleet_patch = mpatches.Patch(color='#ffcc80', label='Sleet')
-    frzrain_patch = mpatches.Patch(color='#ff80bf', label='Frz Rain')
-    rain_patch = mpatches.Patch(color='#00b300', label='Rain')
-    l = plt.legend(handles=[snow_patch, sleet_patch, frzrain_patch, rain_patch])
+    l = wxptype.legend()
     l.set_zorder(10)
 
-################################################
-# Build Map Features, like continents, states, #
-# lat/lon lines, and other physical features   #
-################################################
-    def mapFeatures():
-        m.drawcoastlines(linewidth=0.75, zorder=5)
-        m.fillcontinents(color='#e6e6e6', lake_color='#b3ffff')
-        m.drawcountries(linewidth=1.0, zorder=7)
-        m.drawstates(linewidth=0.75, zorder=6)
-        m.drawmapboundary(fill_color='#b3ffff')
-
-    mapFeatures()
+    background.draw()
 
 ##############################################
 # Add a title, and then show the plot.       #
@@ -168,6 +104,71 @@ while i < timesteps:
         print('Finished creating image', i)
 
     mapFigure('Precipitation Type', 'ptype')
+    plt.close()
+
+#############################################################
+# Spawned render workers import this script, so only read   #
+# the data and render the frames when it is run directly    #
+#############################################################
+if __name__ == '__main__':
+    select_model = model.get(select_model, 0)
+
+    ########################################
+    # Define NOMADS Data URL               #
+    # Include model you want at end of URL #
+    ########################################
+    url = 'http://nomads.ncep.noaa.gov:9090/dods/' + select_model
+    print('URL:', url)
+
+    ##########################################
+    # Extract variables from the NETCDF file #
+    # Count the number of timesteps          #
+    # Convert valid times to UTC and local   #
+    ##########################################
+    file = wxdata.openfile(url, wxcache.FieldCache())
+    print('File opened successfully! Processing data...')
+    lats = file.variables['lat'][:]
+    lons = file.variables['lon'][:]
+    lower_lat_idx = getnearpos(lats, lower_lat)
+    upper_lat_idx = getnearpos(lats, upper_lat)
+    left_lon_idx = getnearpos(lons, left_lon)
+    right_lon_idx = getnearpos(lons, right_lon)
+    lats = lats[lower_lat_idx:upper_lat_idx]
+    lons = lons[left_lon_idx:right_lon_idx]
+
+    timeaxis = wxdata.timeaxis(file)
+    validtimes = timeaxis.labels('%I %p CT, %A, %B %d, %Y')
+    timesteps = len(timeaxis) - 1
+
+    #############################################################
+    # Read every timestep of each ptype field in a single request #
+    # and combine them into one precipitation type class grid     #
+    #############################################################
+    domain = (lats, lons, lower_lat_idx, upper_lat_idx, left_lon_idx, right_lon_idx)
+    fields = {'ptype': wxptype.classify(wxdata.readfields(file, wxptype.PTYPES,
+                                                          domain))}
+
+    #############################################################
+    # Plot the field using Basemap.  Start with setting the map #
+    # projection using the limits of the lat/lon data itself:   #
+    #############################################################
+    m = Basemap(width=mapwidth, height=mapheight, \
+                rsphere=(6378137.00, 6356752.3142), \
+                resolution='i', area_thresh=1000., projection='lcc', \
+                lat_1=lower_lat, lat_2=upper_lat, \
+                lat_0=centerpt_lat, lon_0=centerpt_lon)
+
+    #################################################
+    # convert the lat/lon values to x/y projections #
+    #################################################
+    x, y = wxmaps.projectgrid(m, lats, lons)
+
+    background = wxmaps.MapBackground(m, [('land', 1, drawLand),
+                                          ('coasts-states-countries', 5, drawLines)])
+    background.load()
+
+    wxparallel.renderframes(ptypeframe, fields, range(0, timesteps + 1), workers,
+                            m=m, x=x, y=y, background=background, validtimes=validtimes)
 
-file.close()
-print('The program has complete.')
+    file.close()
+    print('The program has complete.')
@@ -0,0 +1,135 @@
+'''ACCUMULATE MODEL PRECIPITATION OVER THE FORECAST'''
+
+import os
+import numpy as np
+import wxdata
+
+# Hours between resets of each model's apcpsfc bucket. Within a bucket the
+# field holds the total since the last reset (e.g. GFS 0-3 h, then 0-6 h).
+# 0 means every step holds only the total since the previous step, and
+# inf means totals run from initialization without resets.
+BUCKETS = {
+    'GFS': 6,
+    'GFSH': 6,
+    'RAP': 3,
+}
+DEFAULT_BUCKET = 0
+
+class Accumulator(object):
+    '''Running precipitation total fed with apcpsfc in [time, lat, lon] chunks
+
+    State is carried between chunks, so a forecast can be streamed in
+    pieces and still produce the same totals as a single pass. Any
+    [time, ...] shape works, e.g. [time, station] point series.
+    '''
+
+    def __init__(self, bucket=DEFAULT_BUCKET):
+        self.bucket = bucket
+        self.total = None
+        self.last = None
+        self.lastbucket = np.nan
+        self._increments = None
+
+    def bucketids(self, hours):
+        '''Number the bucket that each forecast hour falls in'''
+        hours = np.asarray(hours, dtype=float)
+        if self.bucket == 0:
+            return hours
+        return np.ceil(hours / self.bucket)
+
+    def filled(self, apcp):
+        '''apcp with missing values as 0, in a buffer reused between chunks
+
+        apcp is masked, or a compact float32 array with NaN for missing.
+        '''
+        data = np.ma.getdata(apcp)
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+        if (self._increments is None or self._increments.shape != data.shape or
+                self._increments.dtype != dtype):
+            self._increments = np.empty(data.shape, dtype=dtype)
+        increments = self._increments
+        np.copyto(increments, data)
+        if np.ma.is_masked(apcp):
+            increments[np.ma.getmaskarray(apcp)] = 0
+        increments[np.isnan(increments)] = 0
+        return increments
+
+    def update(self, apcp, hours, mask=None, out=None, scale=None):
+        '''Add a chunk of apcpsfc and return the running totals at each step
+
+        mask, e.g. csnowsfc, limits the totals to points where it is >= 1
+        at the end of each step. scale multiplies each step's increment,
+        e.g. by a snow-to-liquid ratio that varies in time and space.
+        Totals are written into out if given, so a caller streaming a
+        forecast can preallocate them.
+        '''
+        increments = self.filled(apcp)
+        if self.last is None:
+            self.last = np.zeros_like(increments[0])
+            self.total = np.zeros_like(increments[0])
+        last = increments[-1].copy()
+
+        # A step in the same bucket as the one before it only adds the
+        # difference between the two bucket totals
+        ids = self.bucketids(hours)
+        same = ids == np.concatenate(([self.lastbucket], ids[:-1]))
+        previous = np.concatenate((self.last[None], increments[:-1]))
+        np.subtract(increments, previous, out=increments,
+                    where=same.reshape((-1, ) + (1, ) * (increments.ndim - 1)))
+        np.maximum(increments, 0, out=increments)
+
+        if mask is not None:
+            increments *= np.ma.filled(mask, 0) >= 1
+        if scale is not None:
+            increments *= scale
+
+        totals = np.cumsum(increments, axis=0, out=out)
+        totals += self.total
+        self.last = last
+        self.lastbucket = ids[-1]
+        self.total = totals[-1].copy()
+        return totals
+
+    def save(self, path):
+        '''Write the carried state, so a later run can continue the totals'''
+        with open(path + '.part', 'wb') as handle:
+            np.savez(handle, bucket=self.bucket, total=self.total, last=self.last,
+                     lastbucket=self.lastbucket)
+        os.replace(path + '.part', path)
+
+    @classmethod
+    def load(cls, path):
+        '''Accumulator restored from save()'''
+        with np.load(path) as state:
+            accumulator = cls(float(state['bucket']))
+            accumulator.total = state['total']
+            accumulator.last = state['last']
+            accumulator.lastbucket = float(state['lastbucket'])
+        return accumulator
+
+def accumulate(netcdf, select_model, domain, ptype=None, start=0, stop=None,
+               chunk=None, bucket=None, budget=wxdata.MEMORY):
+    '''Running precipitation totals (mm) at every timestep of a forecast
+
+    ptype names a categorical precipitation type field (e.g. 'csnowsfc')
+    to total only that type. bucket overrides the model's BUCKETS entry.
+    Fields are read compact, in chunks that fit budget bytes unless chunk
+    is given, and totals are accumulated into one float32 array.
+    '''
+    if bucket is None:
+        bucket = BUCKETS.get(select_model, DEFAULT_BUCKET)
+    accumulator = Accumulator(bucket)
+    hours = wxdata.forecasthours(netcdf)
+    if stop is None:
+        stop = len(netcdf.variables['time'])
+
+    varnames = ['apcpsfc'] if ptype is None else ['apcpsfc', ptype]
+    totals = np.empty((len(range(start, stop)), domain[3] - domain[2],
+                       domain[5] - domain[4]), dtype=np.float32)
+    for chunk_start, fields in wxdata.iterfields(netcdf, varnames, domain, start, stop,
+                                                 1, chunk, compact=True, budget=budget):
+        steps = len(fields['apcpsfc'])
+        accumulator.update(fields['apcpsfc'], hours[chunk_start:chunk_start + steps],
+                           fields.get(ptype),
+                           out=totals[chunk_start - start:chunk_start - start + steps])
+    return totals
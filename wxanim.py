@@ -0,0 +1,172 @@
+'''ENCODE ANIMATIONS STRAIGHT FROM RENDERED FIGURES'''
+
+import io
+import os
+import shutil
+import struct
+import subprocess
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+# Largest frame size; frames keep their aspect ratio inside it, as
+# ImageMagick's -resize 1024x512 did
+SIZE = (1024, 512)
+# Seconds each frame is shown, and the last one
+DELAY = 0.8
+HOLD = 2.0
+# MP4 frame rate; frames are repeated to last DELAY or HOLD seconds
+FPS = 5
+
+def canvasframe(figure=None, size=SIZE):
+    '''RGB array of a figure cropped like bbox_inches='tight', fitted to size
+
+    The figure is drawn once at about the target resolution instead of
+    being saved at print resolution and downscaled afterwards.
+    '''
+    if figure is None:
+        figure = plt.gcf()
+    width, height = figure.get_size_inches()
+    figure.set_dpi(max(size[0] / width, size[1] / height))
+    figure.canvas.draw()
+    rgb = np.asarray(figure.canvas.buffer_rgba())[..., :3]
+
+    # Crop to the drawn artists, in pixels from the top of the canvas
+    bbox = figure.get_tightbbox(figure.canvas.get_renderer())
+    dpi = figure.dpi
+    left = max(int(np.floor(bbox.x0 * dpi)), 0)
+    right = min(int(np.ceil(bbox.x1 * dpi)), rgb.shape[1])
+    top = max(rgb.shape[0] - int(np.ceil(bbox.y1 * dpi)), 0)
+    bottom = min(rgb.shape[0] - int(np.floor(bbox.y0 * dpi)), rgb.shape[0])
+
+    image = Image.fromarray(np.ascontiguousarray(rgb[top:bottom, left:right]))
+    image.thumbnail(size, Image.LANCZOS)
+    return np.asarray(image)
+
+def gifimage(image):
+    '''Image descriptor, colour table and LZW data of one GIF frame
+
+    The frame is encoded by PIL as a GIF of its own, and its global colour
+    table is moved into the image as a local one, so frames with
+    different palettes can follow each other in one stream.
+    '''
+    buffer = io.BytesIO()
+    image.save(buffer, 'GIF')
+    data = buffer.getvalue()
+    position = 13
+    table = b''
+    packed = data[10]
+    if packed & 0x80:
+        table = data[position:position + (3 << ((packed & 7) + 1))]
+        position += len(table)
+    while data[position] == 0x21:
+        # Skip extensions: introducer, label, then sub-blocks up to a 0
+        position += 2
+        while data[position]:
+            position += data[position] + 1
+        position += 1
+    descriptor = bytearray(data[position:position + 10])
+    if not descriptor[9] & 0x80:
+        descriptor[9] |= 0x80 | (packed & 7)
+        return bytes(descriptor) + table + data[position + 10:-1]
+    return bytes(descriptor) + data[position + 10:-1]
+
+class Animation(object):
+    '''GIF and MP4 animations encoded from one stream of RGB frames
+
+    Frames are added as they are rendered. Their size follows the title and
+    labels, so each is centred on a white frame the size of the first, and
+    cropped if it is larger. The MP4 is piped to ffmpeg as raw video and each GIF frame is
+    palettized and appended to the file as soon as its delay is known, so
+    neither holds more than one frame in memory.
+    '''
+
+    def __init__(self, prefix, formats=('gif', 'mp4'), size=SIZE, delay=DELAY,
+                 hold=HOLD, fps=FPS):
+        self.prefix = prefix
+        self.formats = formats
+        self.maxsize = size
+        self.delay = delay
+        self.hold = hold
+        self.fps = fps
+        self.size = None
+        self.gif = None
+        self.last = None
+        self.ffmpeg = None
+
+    def add(self, rgb):
+        '''Add the next frame, an RGB array from canvasframe()'''
+        image = Image.fromarray(np.asarray(rgb, dtype=np.uint8))
+        if self.size is None:
+            self.size = image.size
+            if 'gif' in self.formats:
+                self.gif = self.startgif()
+            if 'mp4' in self.formats:
+                self.ffmpeg = self.startffmpeg()
+        if image.size != self.size:
+            frame = Image.new('RGB', self.size, 'white')
+            frame.paste(image, ((self.size[0] - image.size[0]) // 2,
+                                (self.size[1] - image.size[1]) // 2))
+            image = frame
+
+        if self.last is not None:
+            self.write(self.last, self.delay)
+        self.last = image
+
+    def addfigure(self, figure=None):
+        '''Add the current (or given) figure as the next frame'''
+        self.add(canvasframe(figure, self.maxsize))
+
+    def startffmpeg(self):
+        '''Start an ffmpeg process that encodes raw RGB frames from stdin'''
+        if shutil.which('ffmpeg') is None:
+            print('ffmpeg not found, skipping ' + self.prefix + '.mp4')
+            return None
+        # yuv420p needs even dimensions, so odd ones are padded by one pixel
+        command = ['ffmpeg', '-loglevel', 'error', '-f', 'rawvideo',
+                   '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(*self.size),
+                   '-r', str(self.fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-vcodec', 'libx264',
+                   '-crf', '25', '-pix_fmt', 'yuv420p', '-y', self.prefix + '.mp4']
+        return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def startgif(self):
+        '''Open the GIF, written to a partial file until close()'''
+        gif = open(self.prefix + '.gif.part', 'wb')
+        gif.write(b'GIF89a' + struct.pack('<HHBBB', self.size[0], self.size[1], 0, 0, 0))
+        # Loop forever
+        gif.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        return gif
+
+    def write(self, image, seconds):
+        '''Hand one frame to the encoders for the given number of seconds'''
+        if self.gif is not None:
+            # Graphic control extension: leave the frame in place, delay in 1/100 s
+            self.gif.write(struct.pack('<BBBBHBB', 0x21, 0xf9, 4, 0x04,
+                                       int(round(seconds * 100)), 0, 0))
+            self.gif.write(gifimage(image.quantize(method=Image.MEDIANCUT)))
+        if self.ffmpeg is not None:
+            data = image.tobytes()
+            for _ in range(max(int(round(seconds * self.fps)), 1)):
+                self.ffmpeg.stdin.write(data)
+
+    def close(self):
+        '''Hold the last frame and finish writing the animations'''
+        if self.last is not None:
+            self.write(self.last, self.hold)
+            self.last = None
+        if self.ffmpeg is not None:
+            self.ffmpeg.stdin.close()
+            self.ffmpeg.wait()
+            self.ffmpeg = None
+        if self.gif is not None:
+            self.gif.write(b'\x3b')
+            self.gif.close()
+            os.replace(self.prefix + '.gif.part', self.prefix + '.gif')
+            self.gif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
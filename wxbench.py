@@ -0,0 +1,199 @@
+'''TIME EACH STAGE OF THE MODEL GRAPHICS PIPELINE ON LOCAL FIXTURES
+
+Usage: python wxbench.py [--grids HRRR GFS] [--output run.json]
+                         [--compare baseline.json]
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from mpl_toolkits.basemap import Basemap
+import numpy as np
+import wxaccum
+import wxanim
+import wxdata
+import wxfixtures
+import wxraster
+
+PTYPES = ['crainsfc', 'csnowsfc', 'cicepsfc', 'cfrzrsfc']
+CLEVS = [0.1, 0.5, 1.0, 3.0, 6.0, 9.0, 12.00, 18.00, 24.00]
+QPFCONTOURS = ('#f1eef6', '#bdc9e1', '#74a9cf', '#0570b0', '#feebe2', '#fbb4b9',
+               '#f768a1', '#c51b8a', '#7a0177', )
+
+def timed(function, repeat=1):
+    '''Call function repeat times; return its last result and timing stats'''
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return result, {'seconds': min(seconds), 'median': float(np.median(seconds)),
+                    'repeat': repeat}
+
+def framestats(seconds):
+    '''Timing stats of a per-frame stage'''
+    return {'seconds': min(seconds), 'median': float(np.median(seconds)),
+            'total': float(sum(seconds)), 'repeat': len(seconds)}
+
+def benchgrid(path, grid, area, workdir, repeat=3, dpi=300):
+    '''Time every stage for one fixture and return the stage results'''
+    stages = {}
+
+    def reopen():
+        wxdata.closefile(wxdata.openfile(path))
+    _, stages['open'] = timed(reopen, repeat)
+    netcdf = wxdata.openfile(path)
+
+    domain, stages['geodomain'] = timed(lambda: wxdata.geodomain(netcdf, area.coords),
+                                        repeat)
+    _, stages['time'] = timed(lambda: wxdata.TimeAxis(netcdf).labels(), repeat)
+
+    fields, stages['read'] = timed(lambda: wxdata.readfields(
+        netcdf, ['apcpsfc'] + PTYPES, domain), repeat)
+    stages['read']['bytes'] = int(sum(field.nbytes for field in fields.values()))
+
+    totals, stages['accumulation'] = timed(lambda: wxaccum.accumulate(
+        netcdf, grid, domain, 'csnowsfc'), repeat)
+
+    mapwidth, mapheight = area.mapdimensions()
+    centerpt_lat, centerpt_lon = area.centerpoint()
+    basemap = Basemap(width=mapwidth, height=mapheight,
+                      rsphere=(6378137.00, 6356752.3142),
+                      resolution=None, projection='lcc',
+                      lat_1=area.llat, lat_2=area.ulat,
+                      lat_0=centerpt_lat, lon_0=centerpt_lon)
+    x, y = basemap(*np.meshgrid(domain[1], domain[0]))
+
+    contourf = []
+    savefig = []
+    canvas = []
+    frames = []
+    for frame, total in enumerate(totals):
+        plt.figure()
+        start = time.perf_counter()
+        basemap.contourf(x, y, 20 * total / 25.4, CLEVS, colors=QPFCONTOURS,
+                         zorder=4, extend='max')
+        contourf.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        plt.savefig(os.path.join(workdir, '{}{:02d}.png'.format(grid.lower(), frame)),
+                    dpi=dpi, bbox_inches='tight')
+        savefig.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        frames.append(wxanim.canvasframe())
+        canvas.append(time.perf_counter() - start)
+        plt.close()
+    stages['contourf'] = framestats(contourf)
+    stages['savefig'] = framestats(savefig)
+    stages['canvas'] = framestats(canvas)
+    stages['animation'] = benchanimation(frames, os.path.join(workdir, grid.lower()))
+
+    raster, stages['warp'] = timed(lambda: wxraster.Raster(
+        basemap, domain[0], domain[1], wxanim.SIZE[0], os.path.join(workdir, 'warps')))
+    colortable = wxraster.ColorTable(CLEVS, QPFCONTOURS, extend='max')
+    rasters = []
+    for total in totals:
+        start = time.perf_counter()
+        raster.render(20 * total / 25.4, colortable)
+        rasters.append(time.perf_counter() - start)
+    stages['raster'] = framestats(rasters)
+
+    wxdata.closefile(netcdf)
+    return stages
+
+def benchanimation(frames, prefix):
+    '''Time encoding the GIF and MP4 animations from the canvas frames'''
+    formats = ('gif', 'mp4') if shutil.which('ffmpeg') else ('gif', )
+
+    def encode():
+        animation = wxanim.Animation(prefix, formats)
+        for frame in frames:
+            animation.add(frame)
+        animation.close()
+    _, stats = timed(encode)
+    stats['formats'] = list(formats)
+    return stats
+
+def compare(results, baseline, tolerance):
+    '''List the stages that got slower than the baseline by over tolerance'''
+    regressions = []
+    for grid, stages in results['grids'].items():
+        for stage, stats in stages.items():
+            before = baseline['grids'].get(grid, {}).get(stage, {})
+            if 'seconds' in stats and before.get('seconds'):
+                ratio = stats['seconds'] / before['seconds']
+                if ratio > 1 + tolerance:
+                    regressions.append((grid, stage, before['seconds'],
+                                        stats['seconds'], ratio))
+    return regressions
+
+def summary(results):
+    '''Print a table of the stage timings'''
+    print('{:<8} {:<14} {:>10} {:>10} {:>12}'.format('grid', 'stage', 'seconds',
+                                                     'median', 'bytes'))
+    for grid, stages in results['grids'].items():
+        for stage, stats in stages.items():
+            if 'skipped' in stats:
+                print('{:<8} {:<14} {:>10}'.format(grid, stage, 'skipped'))
+                continue
+            print('{:<8} {:<14} {:>10.4f} {:>10.4f} {:>12}'.format(
+                grid, stage, stats['seconds'], stats['median'], stats.get('bytes', '')))
+
+def main(argv=None):
+    '''Write the fixtures, time every stage and report'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--grids', nargs='+', default=sorted(wxfixtures.GRIDS))
+    parser.add_argument('--steps', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--fixtures', help='reuse or keep fixtures in this directory')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='wxbench')
+    fixtures = args.fixtures or workdir
+    if not os.path.exists(fixtures):
+        os.makedirs(fixtures)
+
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'machine': platform.platform(),
+               'steps': args.steps, 'dpi': args.dpi, 'grids': {}}
+    try:
+        for grid in args.grids:
+            path = os.path.join(fixtures, grid.lower() + '.nc')
+            if not os.path.exists(path):
+                wxfixtures.writefixture(path, grid, args.steps)
+            results['grids'][grid] = benchgrid(path, grid, wxdata.MIDWEST, workdir,
+                                               args.repeat, args.dpi)
+    finally:
+        shutil.rmtree(workdir)
+
+    summary(results)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        for grid, stage, before, after, ratio in regressions:
+            print('REGRESSION {} {}: {:.4f}s -> {:.4f}s ({:.2f}x)'.format(
+                grid, stage, before, after, ratio))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
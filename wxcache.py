@@ -0,0 +1,259 @@
+'''CACHE FETCHED MODEL DATA ON THE LOCAL DISK'''
+
+import hashlib
+import json
+import os
+import time
+import netCDF4
+import numpy as np
+import wxtrace
+
+CACHEDIR = os.environ.get('WXCACHE', os.path.join(os.path.expanduser('~'),
+                                                  '.cache', 'wxmodels'))
+MAXBYTES = 2 * 1024 ** 3
+# Seconds before dataset metadata is described again. NOMADS extends the
+# time axis of a cycle while it is being published.
+METAAGE = 15 * 60
+
+def cachekey(*parts):
+    '''Hash the parts of a cache key into a file name'''
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def normalize(index, shape):
+    '''Convert a variable index into absolute (start, stop, step) tuples'''
+    if not isinstance(index, tuple):
+        index = (index, )
+
+    expanded = []
+    for item in index:
+        if item is Ellipsis:
+            expanded.extend([slice(None)] * (len(shape) - len(index) + 1))
+        else:
+            expanded.append(item)
+    expanded.extend([slice(None)] * (len(shape) - len(expanded)))
+
+    parts = []
+    for item, size in zip(expanded, shape):
+        if isinstance(item, slice):
+            parts.append(item.indices(size))
+        else:
+            item = int(item)
+            parts.append(item + size if item < 0 else item)
+    return tuple(parts)
+
+class FieldCache(object):
+    '''Size-capped store of arrays on disk with least-recently-used eviction
+
+    With offline=True a miss raises IOError instead of going to the server.
+    Metadata older than metaage seconds is refreshed from the server,
+    except offline, and so are blocks stored with timesteps that had no
+    data yet.
+    '''
+
+    def __init__(self, directory=CACHEDIR, maxbytes=MAXBYTES, offline=False,
+                 metaage=METAAGE):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.offline = offline
+        self.metaage = metaage
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        '''Location of a cached entry'''
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key, maxage=None):
+        '''Return the cached array for key, or None on a miss
+
+        With maxage, an entry stored as incomplete more than maxage
+        seconds ago misses, so it is read again.
+        '''
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                if (maxage is not None and 'incomplete' in entry and
+                        time.time() - float(entry['incomplete']) > maxage):
+                    return None
+                array = np.ma.array(entry['data'], mask=entry['mask'])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        # The modification time marks when an entry was last used. Another
+        # process may have evicted the entry since it was read.
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            pass
+        return array
+
+    @staticmethod
+    def partial(path):
+        '''Temporary file for writing path, unique to this process'''
+        return '{}.{}.part'.format(path, os.getpid())
+
+    def put(self, key, array, incomplete=False):
+        '''Store an array under key and evict old entries over the size cap
+
+        An incomplete entry, e.g. with timesteps that are not published
+        yet, records when it was written so that get() can expire it.
+        '''
+        path = self.path(key)
+        partial = self.partial(path)
+        extra = {'incomplete': time.time()} if incomplete else {}
+        with open(partial, 'wb') as handle:
+            np.savez(handle, data=np.ma.getdata(array),
+                     mask=np.ma.getmask(array), **extra)
+        os.replace(partial, path)
+        self.evict()
+
+    def getmeta(self, key, maxage=None):
+        '''Return a cached metadata dictionary, or None on a miss
+
+        With maxage, metadata written more than maxage seconds ago misses.
+        '''
+        path = os.path.join(self.directory, key + '.json')
+        try:
+            if maxage is not None and time.time() - os.path.getmtime(path) > maxage:
+                return None
+            with open(path) as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def putmeta(self, key, meta):
+        '''Store a metadata dictionary, which is not evicted by size'''
+        path = os.path.join(self.directory, key + '.json')
+        partial = self.partial(path)
+        with open(partial, 'w') as handle:
+            json.dump(meta, handle)
+        os.replace(partial, path)
+
+    def evict(self):
+        '''Delete the least recently used entries until under the size cap
+
+        Other processes sharing the directory may evict the same entries,
+        so entries that are already gone are skipped.
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        usage = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if usage <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            usage -= size
+
+class CachedVariable(object):
+    '''Variable whose hyperslabs are read through a FieldCache'''
+
+    def __init__(self, dataset, name, meta):
+        self.dataset = dataset
+        self.name = name
+        self.dimensions = tuple(meta['dimensions'])
+        self.shape = tuple(meta['shape'])
+        self.ndim = len(self.shape)
+        self.attributes = meta['attributes']
+        for attribute, value in self.attributes.items():
+            if not hasattr(self, attribute):
+                setattr(self, attribute, value)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def ncattrs(self):
+        '''Names of the variable attributes'''
+        return list(self.attributes)
+
+    def unpublished(self, parts, array):
+        '''Whether a block read at parts has a timestep with no data at all
+
+        NOMADS lists forecast hours before their data arrives, so such a
+        block may fill in later.
+        '''
+        if 'time' not in self.dimensions or not np.ma.is_masked(array):
+            return False
+        position = self.dimensions.index('time')
+        mask = np.ma.getmaskarray(array)
+        if not isinstance(parts[position], tuple):
+            return bool(mask.all())
+        # Integer indexes drop their dimensions before the time axis
+        axis = sum(isinstance(part, tuple) for part in parts[:position])
+        mask = np.moveaxis(mask, axis, 0)
+        return bool(mask.reshape(len(mask), -1).all(axis=1).any())
+
+    def __getitem__(self, index):
+        parts = normalize(index, self.shape)
+        key = cachekey(self.dataset.key, self.name, parts)
+        cache = self.dataset.cache
+        array = cache.get(key, None if cache.offline else cache.metaage)
+        if array is None:
+            array = self.dataset.remote().variables[self.name][index]
+            cache.put(key, array, self.unpublished(parts, array))
+        else:
+            # Counted as a hit of the stage reading it, not as bytes read
+            wxtrace.TRACE.current()['hit'] = True
+        return array
+
+class CachedDataset(object):
+    '''Stand-in for a netCDF4.Dataset that serves hyperslabs from disk
+
+    The remote dataset is only opened on the first cache miss, or to
+    refresh metadata older than the cache's metaage, so a fully populated
+    cache runs offline without a network connection. opener opens it,
+    e.g. wxdap.DapDataset instead of netCDF4.Dataset.
+    '''
+
+    def __init__(self, url, cache, key=None, opener=netCDF4.Dataset):
+        self.url = url
+        self.cache = cache
+        self.opener = opener
+        self.key = tuple(key) if key is not None else (url, )
+        self._netcdf = None
+
+        meta = cache.getmeta(cachekey(self.key, 'metadata'),
+                             None if cache.offline else cache.metaage)
+        if meta is None:
+            meta = self.describe(self.remote())
+            cache.putmeta(cachekey(self.key, 'metadata'), meta)
+
+        self.variables = dict((name, CachedVariable(self, name, meta[name]))
+                              for name in meta)
+
+    @staticmethod
+    def describe(netcdf):
+        '''Collect the dimensions, shape and attributes of every variable'''
+        meta = {}
+        for name, variable in netcdf.variables.items():
+            attributes = {}
+            for attribute in variable.ncattrs():
+                value = variable.getncattr(attribute)
+                attributes[attribute] = np.asarray(value).tolist()
+            meta[name] = {'dimensions': list(variable.dimensions),
+                          'shape': list(variable.shape),
+                          'attributes': attributes}
+        return meta
+
+    def remote(self):
+        '''Open the remote dataset on first use'''
+        if self._netcdf is None:
+            if self.cache.offline:
+                raise IOError('Offline and not cached: ' + self.url)
+            self._netcdf = self.opener(self.url)
+        return self._netcdf
+
+    def close(self):
+        '''Close the remote dataset if it was opened'''
+        if self._netcdf is not None:
+            self._netcdf.close()
+            self._netcdf = None
@@ -0,0 +1,301 @@
+'''READ OPENDAP DATASETS OVER POOLED, PARALLEL DAP2 REQUESTS
+
+DapDataset stands in for netCDF4.Dataset on http:// URLs. Each read is
+split into sub-requests of at most MAXBYTES, which are fetched in
+parallel over keep-alive connections, retried with backoff, and put
+back together into one array. Blocks that arrived are kept when a read
+fails, so reading the same slice again only fetches the rest.
+'''
+
+import http.client
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import quote, urlsplit
+import numpy as np
+import wxcache
+
+CONNECTIONS = 4
+TIMEOUT = 60
+RETRIES = 4
+BACKOFF = 1.
+MAXBYTES = 16 * 2 ** 20
+
+# DAP2 types: XDR encoding on the wire and the type of the decoded array.
+# XDR widens 16-bit integers to 32 bits.
+TYPES = {
+    'Byte': ('u1', np.uint8),
+    'Int16': ('>i4', np.int16),
+    'UInt16': ('>u4', np.uint16),
+    'Int32': ('>i4', np.int32),
+    'UInt32': ('>u4', np.uint32),
+    'Float32': ('>f4', np.float32),
+    'Float64': ('>f8', np.float64),
+}
+
+DECLARATION = re.compile(r'^\s*(\w+)\s+([\w.-]+)((?:\s*\[\s*[\w.-]+\s*=\s*\d+\s*\])*)\s*;')
+DIMENSION = re.compile(r'\[\s*([\w.-]+)\s*=\s*(\d+)\s*\]')
+ATTRIBUTE = re.compile(r'^\s*(\w+)\s+([\w.-]+)\s+(.*);\s*$')
+CONTAINER = re.compile(r'^\s*([\w.-]+)\s*\{\s*$')
+
+class DapError(IOError):
+    '''A DAP request failed for good'''
+
+def parsedds(dds):
+    '''(type, dimension names, shape) of every variable in a DDS
+
+    A Grid is described by its array; its maps are variables of their own.
+    '''
+    variables = {}
+    part = None
+    for line in dds.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('Grid'):
+            part = 'grid'
+        elif stripped == 'ARRAY:':
+            part = 'array'
+        elif stripped == 'MAPS:':
+            part = 'maps'
+        elif stripped.startswith('}'):
+            part = None
+        else:
+            match = DECLARATION.match(line)
+            if match and part != 'maps':
+                dimensions = DIMENSION.findall(match.group(3))
+                variables[match.group(2)] = (
+                    match.group(1), tuple(name for name, _ in dimensions),
+                    tuple(int(size) for _, size in dimensions))
+    return variables
+
+def attributevalue(kind, text):
+    '''Value of a DAS attribute: a string, a number or a list of numbers'''
+    if kind in ('String', 'Url'):
+        return ', '.join(value.strip().strip('"') for value in
+                         re.findall(r'"(?:[^"\\]|\\.)*"', text)).replace('\\"', '"')
+    values = [value.strip() for value in text.split(',')]
+    dtype = TYPES.get(kind, (None, np.float64))[1]
+    values = [dtype(float(value)) if dtype in (np.float32, np.float64)
+              else dtype(int(float(value))) for value in values]
+    return values[0] if len(values) == 1 else values
+
+def parsedas(das):
+    '''Attributes of every variable in a DAS'''
+    attributes = {}
+    stack = []
+    for line in das.splitlines():
+        container = CONTAINER.match(line)
+        if container:
+            stack.append(container.group(1))
+            if len(stack) == 2:
+                attributes[stack[1]] = {}
+        elif line.strip().startswith('}'):
+            if stack:
+                stack.pop()
+        elif len(stack) == 2:
+            match = ATTRIBUTE.match(line)
+            if match:
+                attributes[stack[1]][match.group(2)] = attributevalue(match.group(1),
+                                                                      match.group(3))
+    return attributes
+
+def blocks(counts, itemsize, maxbytes=MAXBYTES):
+    '''Split an array of counts along its outer axes into blocks of maxbytes
+
+    Returns (offset, count) pairs for every axis of every block.
+    '''
+    pieces = [()]
+    size = itemsize * int(np.prod(counts))
+    for axis, count in enumerate(counts):
+        inner = size // count if count else 0
+        if size <= maxbytes:
+            spans = [(0, count)]
+        else:
+            per = max(1, maxbytes // max(inner, 1))
+            spans = [(first, min(per, count - first)) for first in range(0, count, per)]
+        pieces = [piece + (span, ) for piece in pieces for span in spans]
+        size = inner if size > maxbytes else 0
+    return pieces
+
+def decode(body, kind, count):
+    '''First array of a .dods response, e.g. the array of a Grid'''
+    start = body.index(b'\nData:\n') + len(b'\nData:\n')
+    length = int(np.frombuffer(body, '>u4', 1, start)[0])
+    if length != count:
+        raise DapError('Expected {} values, got {}'.format(count, length))
+    wire, dtype = TYPES[kind]
+    return np.frombuffer(body, wire, length, start + 8).astype(dtype)
+
+class DapVariable(object):
+    '''Variable of a DapDataset, read in parallel blocks on indexing'''
+
+    def __init__(self, dataset, name, kind, dimensions, shape, attributes):
+        self.dataset = dataset
+        self.name = name
+        self.kind = kind
+        self.dtype = np.dtype(TYPES[kind][1])
+        self.dimensions = dimensions
+        self.shape = shape
+        self.ndim = len(shape)
+        self.attributes = attributes
+        self.automask = True
+        for attribute, value in attributes.items():
+            if not hasattr(self, attribute):
+                setattr(self, attribute, value)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def ncattrs(self):
+        '''Names of the variable attributes'''
+        return list(self.attributes)
+
+    def getncattr(self, attribute):
+        '''Value of one attribute'''
+        return self.attributes[attribute]
+
+    def set_auto_mask(self, automask):
+        '''Whether reads mask fill values, as with netCDF4'''
+        self.automask = automask
+
+    def constraint(self, ranges, block):
+        '''DAP2 constraint of one block of a read'''
+        index = ''
+        for (start, _, step), (offset, count) in zip(ranges, block):
+            first = start + offset * step
+            index += '[{}:{}:{}]'.format(first, step, first + (count - 1) * step)
+        return self.name + index
+
+    def __getitem__(self, index):
+        parts = wxcache.normalize(index, self.shape)
+        ranges = []
+        for part in parts:
+            if isinstance(part, tuple):
+                if part[2] < 0:
+                    raise IndexError('DAP2 cannot read with a negative step')
+                ranges.append(part)
+            else:
+                ranges.append((part, part + 1, 1))
+        counts = tuple(len(range(*part)) for part in ranges)
+
+        data = np.empty(counts, dtype=self.dtype)
+        if data.size:
+            pieces = blocks(counts, self.dtype.itemsize, self.dataset.maxbytes)
+            constraints = [self.constraint(ranges, block) for block in pieces]
+            arrays = self.dataset.fetch(constraints, self.kind,
+                                        [int(np.prod([count for _, count in block]))
+                                         for block in pieces])
+            for block, array in zip(pieces, arrays):
+                data[tuple(slice(offset, offset + count) for offset, count in block)] = \
+                    array.reshape([count for _, count in block])
+        data = data[tuple(slice(None) if isinstance(part, tuple) else 0 for part in parts)]
+
+        if not self.automask:
+            return data
+        missing = np.zeros(data.shape, dtype=bool)
+        for attribute in ('_FillValue', 'missing_value'):
+            if attribute in self.attributes:
+                missing |= data == self.dtype.type(self.attributes[attribute])
+        return np.ma.array(data, mask=missing)
+
+class DapDataset(object):
+    '''Stand-in for a netCDF4.Dataset on a DAP2 server
+
+    Up to connections requests run at once, each thread keeping its own
+    keep-alive connection. A request that fails with a connection error,
+    a timeout or a 5xx status is retried up to retries times, waiting
+    backoff, 2 * backoff, 4 * backoff, ... seconds in between.
+    '''
+
+    def __init__(self, url, connections=CONNECTIONS, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, maxbytes=MAXBYTES):
+        self.url = url
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbytes = maxbytes
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(connections)
+        self._arrived = {}
+
+        dds = self.request(self.path + '.dds').decode('utf-8')
+        das = parsedas(self.request(self.path + '.das').decode('utf-8'))
+        self.variables = {}
+        self.dimensions = {}
+        for name, (kind, dimensions, shape) in parsedds(dds).items():
+            self.variables[name] = DapVariable(self, name, kind, dimensions, shape,
+                                               das.get(name, {}))
+            self.dimensions.update(zip(dimensions, shape))
+
+    def connection(self, fresh=False):
+        '''This thread's keep-alive connection to the server'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and fresh:
+            connection.close()
+            connection = None
+        if connection is None:
+            if self.scheme == 'https':
+                connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def request(self, path):
+        '''Body of a GET of path, retried with backoff'''
+        fresh = False
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                connection = self.connection(fresh)
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                failure = error
+                fresh = True
+                continue
+            if response.status == 200:
+                return body
+            failure = DapError('HTTP {} {} for {}'.format(response.status, response.reason,
+                                                          path))
+            if response.status < 500:
+                raise failure
+        raise DapError('Giving up after {} attempts: {}'.format(self.retries + 1, failure))
+
+    def fetch(self, constraints, kind, counts):
+        '''Arrays of several constraints, requested in parallel
+
+        Arrays that arrive are kept until every constraint has, so after
+        a failure a second fetch of the same constraints resumes.
+        '''
+        def get(constraint, count):
+            if constraint not in self._arrived:
+                body = self.request(self.path + '.dods?' + quote(constraint, safe='[]:,.'))
+                self._arrived[constraint] = decode(body, kind, count)
+            return self._arrived[constraint]
+
+        futures = [self._executor.submit(get, constraint, count)
+                   for constraint, count in zip(constraints, counts)]
+        wait(futures)
+        arrays = [future.result() for future in futures]
+        for constraint in constraints:
+            self._arrived.pop(constraint, None)
+        return arrays
+
+    def close(self):
+        '''Close every connection and stop the request threads'''
+        self._executor.shutdown()
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
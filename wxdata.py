@@ -1,11 +1,22 @@
 '''GET NOMADS OPENDAP MODEL DATA'''
 
+import os
 import netCDF4
 import numpy as np
 from dateutil import tz
+import wxcache
+import wxdap
+import wxstore
+import wxtrace
 
-def model(select_model, date, cycle):
-    '''Define model URLs on NOMADS OpenDAP server'''
+SERVER = 'http://nomads.ncep.noaa.gov:9090/dods/'
+
+def model(select_model, date, cycle, server=SERVER):
+    '''Define model URLs on NOMADS OpenDAP server
+
+    server may point at a mirror, or at a local directory of files laid
+    out like the server's datasets.
+    '''
 
     model_urls = {
         'GFS': 'gfs_0p25/gfs' + date + '/gfs_0p25_' + cycle + 'z',
@@ -20,58 +31,353 @@ def model(select_model, date, cycle):
     }
 
     select_model = model_urls.get(select_model, 0)
-    url = 'http://nomads.ncep.noaa.gov:9090/dods/' + select_model
+    url = server + select_model
 
     return url
 
-def openfile(netcdf):
-    '''Read netcdf file'''
-    netcdf4 = netCDF4.Dataset(netcdf)
+# How http:// datasets are opened: 'netCDF4' (netcdf-c) or 'dap', the
+# pooled parallel client of wxdap
+BACKEND = 'netCDF4'
+
+def openfile(netcdf, cache=None, key=None, backend=None):
+    '''Read netcdf file, through a wxcache.FieldCache if one is given
+
+    key identifies the dataset in the cache, e.g. (model, date, cycle),
+    and defaults to the URL. A wxstore directory opens as a FieldStore.
+    backend overrides BACKEND.
+    '''
+    opener = netCDF4.Dataset
+    if (backend or BACKEND) == 'dap' and netcdf.startswith(('http://', 'https://')):
+        opener = wxdap.DapDataset
+    with wxtrace.TRACE.stage('openfile', url=netcdf):
+        if os.path.isdir(netcdf) and wxstore.isstore(netcdf):
+            return wxstore.FieldStore(netcdf)
+        if cache is not None:
+            return wxcache.CachedDataset(netcdf, cache, key, opener)
+        netcdf4 = opener(netcdf)
     return netcdf4
 
 def closefile(netcdf):
     '''Close netcdf file'''
+    _TIMEAXES.pop(id(netcdf), None)
     netcdf.close()
 
 def getnearpos(array, value):
-    '''Retrieve nearest index value from lat/lon'''
-    idx = (np.abs(array - value)).argmin()
-    return idx
+    '''Retrieve nearest index value(s) from a monotonic lat/lon axis'''
+    array = np.ma.getdata(array)
+    descending = array[0] > array[-1]
+    if descending:
+        array = array[::-1]
+
+    # Binary search, then pick the closer of the two neighbouring points
+    right = np.clip(np.searchsorted(array, value), 1, len(array) - 1)
+    left = right - 1
+    idx = np.where(np.abs(value - array[left]) <= np.abs(array[right] - value),
+                   left, right)
+
+    if descending:
+        idx = len(array) - 1 - idx
+    return idx[()]
 
+def normalizelon(lons, value):
+    '''Express longitude(s) in the 0-360 or -180-180 convention of lons'''
+    if np.ma.max(lons) > 180:
+        return np.mod(value, 360)
+    return np.mod(np.add(value, 180), 360) - 180
+
+def unitvectors(lats, lons):
+    '''Points on the unit sphere, so distances ignore the longitude seam'''
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons),
+                     np.sin(lats)], axis=-1)
+
+_GRIDINDEXES = {}
+
+def gridindex(lats, lons):
+    '''KD-tree of a 2-D lat/lon grid, built once per model grid'''
+    lats = np.ma.getdata(lats)
+    lons = np.ma.getdata(lons)
+    key = (lats.shape, lats[0, 0], lats[-1, -1], lons[0, 0], lons[-1, -1])
+    if key not in _GRIDINDEXES:
+        from scipy.spatial import cKDTree
+        _GRIDINDEXES[key] = cKDTree(unitvectors(lats, lons).reshape(-1, 3))
+    return _GRIDINDEXES[key]
+
+def gridnearpos(lats, lons, latvalues, lonvalues):
+    '''Retrieve nearest (row, column) indices on a 2-D lat/lon grid'''
+    points = unitvectors(np.asarray(latvalues), np.asarray(lonvalues))
+    _, flat = gridindex(lats, lons).query(points)
+    return np.unravel_index(flat, np.shape(lats))
+
+@wxtrace.traced('geodomain')
 def geodomain(netcdf, coords):
-    '''Calculate geographical domain'''
+    '''Calculate geographical domain
+
+    Longitudes may be given in either the 0-360 or the -180-180 convention.
+    On curvilinear grids with 2-D lat/lon the domain is the index box that
+    encloses the whole lat/lon box.
+    '''
     lats = netcdf.variables['lat'][:]
     lons = netcdf.variables['lon'][:]
+    return boxdomain(lats, lons, coords)
+
+def boxdomain(lats, lons, coords):
+    '''geodomain of a lat/lon box on lat/lon axes that are already read'''
     llat = coords[0]
     ulat = coords[1]
     llon = coords[2]
     rlon = coords[3]
 
-    llat_idx = getnearpos(lats, llat)
-    ulat_idx = getnearpos(lats, ulat)
-    llon_idx = getnearpos(lons, llon)
-    rlon_idx = getnearpos(lons, rlon)
+    if np.ndim(lats) == 2:
+        edge = np.linspace(0, 1, 50)
+        perimeter_lats = np.concatenate([llat + (ulat - llat) * edge,
+                                         np.full_like(edge, ulat),
+                                         ulat - (ulat - llat) * edge,
+                                         np.full_like(edge, llat)])
+        perimeter_lons = np.concatenate([np.full_like(edge, llon),
+                                         llon + (rlon - llon) * edge,
+                                         np.full_like(edge, rlon),
+                                         rlon - (rlon - llon) * edge])
+        rows, columns = gridnearpos(lats, lons, perimeter_lats, perimeter_lons)
+        llat_idx, ulat_idx = rows.min(), rows.max() + 1
+        llon_idx, rlon_idx = columns.min(), columns.max() + 1
+    else:
+        llat_idx = getnearpos(lats, llat)
+        ulat_idx = getnearpos(lats, ulat)
+        llon_idx = getnearpos(lons, normalizelon(lons, llon))
+        rlon_idx = getnearpos(lons, normalizelon(lons, rlon))
+
+    return indexdomain(lats, lons, llat_idx, ulat_idx, llon_idx, rlon_idx)
 
-    lats_domain = lats[llat_idx : ulat_idx]
-    lons_domain = lons[llon_idx : rlon_idx]
+def indexdomain(lats, lons, llat_idx, ulat_idx, llon_idx, rlon_idx):
+    '''Domain tuple of an index box, as geodomain returns it'''
+    if np.ndim(lats) == 2:
+        lats_domain = lats[llat_idx : ulat_idx, llon_idx : rlon_idx]
+        lons_domain = lons[llat_idx : ulat_idx, llon_idx : rlon_idx]
+    else:
+        lats_domain = lats[llat_idx : ulat_idx]
+        lons_domain = lons[llon_idx : rlon_idx]
 
     return lats_domain, lons_domain, llat_idx, ulat_idx, llon_idx, rlon_idx
 
+@wxtrace.traced('geodomain')
+def uniondomain(netcdf, areas):
+    '''Domain enclosing the geodomains of several lat/lon boxes, and those
+
+    Fields read once over the union and cut with subdomain are the same
+    as fields read over each box's own geodomain.
+    '''
+    lats = netcdf.variables['lat'][:]
+    lons = netcdf.variables['lon'][:]
+    domains = [boxdomain(lats, lons, coords) for coords in areas]
+    union = indexdomain(lats, lons, min(domain[2] for domain in domains),
+                        max(domain[3] for domain in domains),
+                        min(domain[4] for domain in domains),
+                        max(domain[5] for domain in domains))
+    return union, domains
+
+def subdomain(domain, sector):
+    '''Index of a sector's box in [..., lat, lon] fields read over domain'''
+    return (Ellipsis, slice(sector[2] - domain[2], sector[3] - domain[2]),
+            slice(sector[4] - domain[4], sector[5] - domain[4]), )
+
+# Categorical fields that compact reads return as uint8 flags
+CATEGORICAL = ('crainsfc', 'csnowsfc', 'cicepsfc', 'cfrzrsfc')
+# Default memory budget (bytes) of one chunk of fields
+MEMORY = 512 * 2 ** 20
+
+def compactfield(field, varname, fillvalues=()):
+    '''float32 array with NaN for missing values, or uint8 flags (>= 1)
+
+    Categorical fields become 1 where flagged and 0 elsewhere, including
+    where missing, so NARRE member fractions only count where every
+    member agrees. fillvalues
+    are raw fill values of an unmasked read, converted in place.
+    '''
+    data = np.asarray(np.ma.getdata(field), dtype=np.float32)
+    missing = np.ma.getmask(field)
+    for fillvalue in fillvalues:
+        missing = missing | (data == np.float32(fillvalue))
+    if varname in CATEGORICAL:
+        # Missing points are not flagged, whatever their raw values
+        flags = data >= 1
+        if np.any(missing):
+            flags[np.broadcast_to(missing, flags.shape)] = False
+        return flags.view(np.uint8)
+    if np.any(missing):
+        if not data.flags.writeable:
+            data = data.copy()
+        data[missing] = np.nan
+    return data
+
+def hyperslab(variable, domain, start=0, stop=None, step=1, compact=False,
+              levels=slice(None)):
+    '''Read a [time, lat, lon] block of a variable in a single request
+
+    compact returns a plain array from compactfield instead of a masked one.
+    Variables on pressure levels give [time, lev, lat, lon] blocks of the
+    levels selected by the levels slice.
+    '''
+    llat_idx, ulat_idx, llon_idx, rlon_idx = domain[2:6]
+    # NARRE fields carry a leading ensemble dimension
+    parts = {'ens': 0, 'time': slice(start, stop, step), 'lev': levels,
+             'lat': slice(llat_idx, ulat_idx), 'lon': slice(llon_idx, rlon_idx)}
+    unknown = [dimension for dimension in variable.dimensions if dimension not in parts]
+    if unknown:
+        raise ValueError('Cannot read {} by dimensions {}'.format(
+            getattr(variable, 'name', 'variable'), ', '.join(unknown)))
+    index = tuple(parts[dimension] for dimension in variable.dimensions)
+
+    name = getattr(variable, 'name', None)
+    with wxtrace.TRACE.stage('read', variable=name) as record:
+        if compact and hasattr(variable, 'set_auto_mask'):
+            # Skip building the mask; fill values are converted once below
+            variable.set_auto_mask(False)
+            try:
+                field = variable[index]
+            finally:
+                variable.set_auto_mask(True)
+            fillvalues = [getattr(variable, attribute) for attribute
+                          in ('_FillValue', 'missing_value') if hasattr(variable, attribute)]
+            field = compactfield(field, name, fillvalues)
+        else:
+            field = variable[index]
+            if compact:
+                field = compactfield(field, name)
+        if record.get('hit'):
+            record['hitbytes'] = field.nbytes
+        else:
+            record['bytes'] = field.nbytes
+    return field
+
+def chunksize(varnames, domain, budget=MEMORY, compact=False):
+    '''Timesteps per chunk that keep one chunk of fields within budget bytes
+
+    Masked reads are counted as float64 plus a mask byte per point.
+    '''
+    points = (domain[3] - domain[2]) * (domain[5] - domain[4])
+    perstep = 0
+    for varname in varnames:
+        if not compact:
+            perstep += 9 * points
+        elif varname in CATEGORICAL:
+            perstep += points
+        else:
+            perstep += 4 * points
+    return max(int(budget // max(perstep, 1)), 1)
+
+def iterfields(netcdf, varnames, domain, start=0, stop=None, step=1, chunk=None,
+               compact=False, budget=None):
+    '''Yield the first timestep and the fields of each block of chunk steps
+
+    Without a chunk, a budget (bytes) sets it through chunksize; without
+    either, everything is one block.
+    '''
+    if stop is None:
+        stop = len(netcdf.variables['time'])
+    if chunk is None and budget is not None:
+        chunk = chunksize(varnames, domain, budget, compact)
+    if chunk is None:
+        chunk = max(len(range(start, stop, step)), 1)
+    span = chunk * step
+
+    for chunk_start in range(start, stop, span):
+        chunk_stop = min(chunk_start + span, stop)
+        fields = {}
+        for varname in varnames:
+            fields[varname] = hyperslab(netcdf.variables[varname], domain,
+                                        chunk_start, chunk_stop, step, compact)
+        yield chunk_start, fields
+
+def readfields(netcdf, varnames, domain, start=0, stop=None, step=1, chunk=None,
+               compact=False, budget=None):
+    '''Read variables over a time range into [time, lat, lon] arrays
+
+    Each variable is fetched with one request per chunk of timesteps
+    instead of one request per timestep, so element k of each array is
+    timestep start + k * step.
+    '''
+    blocks = dict((varname, []) for varname in varnames)
+    for _, fields in iterfields(netcdf, varnames, domain, start, stop, step, chunk,
+                                compact, budget):
+        for varname in varnames:
+            blocks[varname].append(fields[varname])
+
+    concatenate = np.concatenate if compact else np.ma.concatenate
+    for varname in varnames:
+        if len(blocks[varname]) == 1:
+            blocks[varname] = blocks[varname][0]
+        else:
+            blocks[varname] = concatenate(blocks[varname])
+
+    return blocks
+
+TIMEZONE = 'America/Chicago'
+TIMEFORMAT = '%-I %p CT, %A, %B %-d, %Y'
+SECONDS = {'days': 86400, 'hours': 3600, 'minutes': 60, 'seconds': 1}
+
+def unitseconds(timeunits):
+    '''Seconds in the unit of a CF time units string, e.g. "Hour since ..."'''
+    unit = timeunits.split()[0].lower()
+    if not unit.endswith('s'):
+        unit += 's'
+    if unit not in SECONDS:
+        raise ValueError('Unknown time units: ' + timeunits)
+    return SECONDS[unit]
+
+class TimeAxis(object):
+    '''Valid times of every timestep, decoded in one pass as datetime64'''
+
+    def __init__(self, netcdf):
+        with wxtrace.TRACE.stage('time'):
+            times = np.ma.filled(netcdf.variables['time'][:], np.nan)
+            timeunits = netcdf.variables['time'].units
+
+            # Only the first time goes through num2date; the reference dates
+            # of GrADS datasets (year 1) need the mixed Julian/Gregorian calendar
+            first = netCDF4.num2date(times[0], units=timeunits)
+            first = np.datetime64(first.isoformat(), 'us') + np.timedelta64(500000, 'us')
+            offsets = np.round((times - times[0]) * unitseconds(timeunits))
+            self.validtimes = (first.astype('datetime64[s]') +
+                               offsets.astype('timedelta64[s]'))
+        self._labels = {}
+
+    def __len__(self):
+        return len(self.validtimes)
+
+    @property
+    def forecasthours(self):
+        '''Hours since initialization of every timestep'''
+        return (self.validtimes - self.validtimes[0]) / np.timedelta64(1, 'h')
+
+    def labels(self, timeformat=TIMEFORMAT, timezone=TIMEZONE):
+        '''Formatted local valid times, built on first use and kept'''
+        if (timeformat, timezone) not in self._labels:
+            from_zone = tz.gettz('UTC')
+            to_zone = tz.gettz(timezone)
+            self._labels[timeformat, timezone] = [
+                validtime.replace(tzinfo=from_zone).astimezone(to_zone).strftime(timeformat)
+                for validtime in self.validtimes.astype(object)]
+        return self._labels[timeformat, timezone]
+
+_TIMEAXES = {}
+
+def timeaxis(netcdf):
+    '''TimeAxis of a dataset, decoded once per open dataset'''
+    if id(netcdf) not in _TIMEAXES:
+        _TIMEAXES[id(netcdf)] = (netcdf, TimeAxis(netcdf))
+    return _TIMEAXES[id(netcdf)][1]
+
+def forecasthours(netcdf):
+    '''Hours since initialization of every timestep'''
+    return timeaxis(netcdf).forecasthours
+
 def time(netcdf):
     '''Retrieve valid forecast times'''
-    times = netcdf.variables['time'][:]
-    timeunits = netcdf.variables['time'].units
-    from_zone = tz.gettz('UTC')
-    to_zone = tz.gettz('America/Chicago')
-
-    validtimes = []
-    for timesteps, validtime in enumerate(times):
-        validtime = netCDF4.num2date(validtime, units=timeunits)
-        validtime = validtime.replace(tzinfo=from_zone)
-        validtime = validtime.astimezone(to_zone)
-        validtime = validtime.strftime('%-I %p CT, %A, %B %-d, %Y')
-        validtimes.append(validtime)
-    timesteps = len(validtimes)
+    axis = timeaxis(netcdf)
+    validtimes = axis.labels()
+    timesteps = len(axis)
 
     return validtimes, timesteps
 
@@ -100,7 +406,8 @@ class Geography(object):
 WISCONSIN = Geography(41.5, 47.5, -94.0, -86.3)
 MIDWEST = Geography(37.0, 50.0, -105.0, -82.0)
 
-# Global models, like the GFS, require lons between 0 and 360
+# Global models, like the GFS, use lons between 0 and 360. geodomain now
+# converts either convention, so these remain only for older scripts
 WISCONSIN_GLOBAL = Geography(41.5, 47.5, 266.0, 273.7)
 MIDWEST_GLOBAL = Geography(37.0, 50.0, 255.0, 278.0)
 
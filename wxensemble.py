@@ -0,0 +1,246 @@
+'''ENSEMBLE STATISTICS OF SEVERAL MODELS ON A COMMON GRID
+
+Usage: python wxensemble.py 20180211 00 [--models HRRR RAP NAM3K ARW NMM GFS]
+                            [--quantity qpf] [--thresholds 0.1 0.5 1.0]
+                            [--area WISCONSIN] [--output ensemble.npz]
+                            [--weightdir /path/to/weights]
+
+Every member is regridded onto a regular lat/lon grid over the area with
+a sparse matrix of interpolation weights. The weights are computed once
+per source and target grid and cached on disk, so regridding a field is
+one sparse matrix product.
+'''
+
+import argparse
+import collections
+import os
+import sys
+import numpy as np
+from scipy import sparse
+import wxaccum
+import wxcache
+import wxdata
+import wxmaps
+import wxtrace
+
+WEIGHTDIR = os.path.join(wxcache.CACHEDIR, 'weights')
+MODELS = ['HRRR', 'RAP', 'NAM3K', 'ARW', 'NMM', 'GFS']
+RESOLUTION = 0.1    # degrees of the common grid
+MARGIN = 1.    # degrees read around the area, so edge points have neighbours
+MPH = 2.237    # m/s to miles per hour
+INCHES = 1 / 25.4    # mm to inches
+SNOWRATIO = 10
+
+# Default exceedance thresholds, in inches for qpf and snow and mph for gust
+THRESHOLDS = {
+    'qpf': [0.1, 0.25, 0.5, 1.0],
+    'snow': [1.0, 3.0, 6.0, 12.0],
+    'gust': [30., 40., 50., 60.],
+}
+
+Ensemble = collections.namedtuple('Ensemble', ['quantity', 'members', 'validtimes',
+                                               'lats', 'lons', 'mean', 'spread',
+                                               'probability'])
+
+def targetgrid(area, resolution=RESOLUTION):
+    '''1-D lat/lon axes of a regular grid over a Geography'''
+    lats = np.arange(area.llat, area.ulat + resolution / 2, resolution)
+    lons = np.arange(area.llon, area.rlon + resolution / 2, resolution)
+    return lats, lons
+
+def axisweights(axis, values):
+    '''Lower neighbour index and weight of values between points of an axis
+
+    Values beyond the axis get index -1.
+    '''
+    axis = np.ma.getdata(axis)
+    positions = np.arange(len(axis), dtype=float)
+    if axis[0] > axis[-1]:
+        axis = axis[::-1]
+        positions = positions[::-1]
+    fraction = np.interp(values, axis, positions, left=-1, right=-1)
+    lower = np.clip(np.floor(fraction).astype(int), 0, len(axis) - 2)
+    weight = fraction - lower
+    lower[fraction < 0] = -1
+    return lower, weight
+
+def interpolation(lats, lons, targetlats, targetlons):
+    '''Sparse [target point, source point] matrix of interpolation weights
+
+    Regular sources are interpolated bilinearly. Curvilinear sources with
+    2-D lat/lon use the inverse distances of the four nearest points.
+    Target points off the source grid get no weights.
+    '''
+    targetlon2d, targetlat2d = np.meshgrid(targetlons, targetlats)
+    targetlat2d = targetlat2d.ravel()
+    targetlon2d = targetlon2d.ravel()
+    shape = np.shape(lats) if np.ndim(lats) == 2 else (len(lats), len(lons))
+
+    if np.ndim(lats) == 2:
+        points = wxdata.unitvectors(targetlat2d, targetlon2d)
+        distance, nearest = wxdata.gridindex(lats, lons).query(points, k=4)
+        weights = 1 / np.maximum(distance, 1e-12)
+        weights /= weights.sum(axis=1, keepdims=True)
+        rows = np.repeat(np.arange(len(points)), 4)
+        # Points nearest the edge of the grid lie beyond it
+        row, column = np.unravel_index(nearest[:, 0], shape)
+        inside = ((row > 0) & (row < shape[0] - 1) & (column > 0) & (column < shape[1] - 1))
+        weights[~inside] = 0
+        return sparse.csr_matrix((weights.ravel(), (rows, nearest.ravel())),
+                                 shape=(len(points), shape[0] * shape[1]))
+
+    latlower, latweight = axisweights(lats, targetlat2d)
+    lonlower, lonweight = axisweights(lons, wxdata.normalizelon(lons, targetlon2d))
+    inside = (latlower >= 0) & (lonlower >= 0)
+    target = np.flatnonzero(inside)
+    latlower, latweight = latlower[inside], latweight[inside]
+    lonlower, lonweight = lonlower[inside], lonweight[inside]
+
+    rows, columns, weights = [], [], []
+    for latstep, latpart in ((0, 1 - latweight), (1, latweight)):
+        for lonstep, lonpart in ((0, 1 - lonweight), (1, lonweight)):
+            rows.append(target)
+            columns.append(np.ravel_multi_index((latlower + latstep, lonlower + lonstep),
+                                                shape))
+            weights.append(latpart * lonpart)
+    return sparse.csr_matrix((np.concatenate(weights),
+                              (np.concatenate(rows), np.concatenate(columns))),
+                             shape=(len(targetlat2d), shape[0] * shape[1]))
+
+_WEIGHTS = {}
+
+def weights(lats, lons, targetlats, targetlons, directory=None):
+    '''interpolation matrix of a source and target grid, kept in memory and on disk
+
+    directory defaults to WEIGHTDIR.
+    '''
+    if directory is None:
+        directory = WEIGHTDIR
+    key = wxcache.cachekey('weights', wxmaps.gridkey(lats, lons),
+                           wxmaps.gridkey(targetlats, targetlons))
+    if key not in _WEIGHTS:
+        path = os.path.join(directory, key + '.npz')
+        if os.path.exists(path):
+            _WEIGHTS[key] = sparse.load_npz(path)
+        else:
+            with wxtrace.TRACE.stage('weights'):
+                matrix = interpolation(lats, lons, targetlats, targetlons)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            partial = '{}.{}.npz'.format(path[:-4], os.getpid())
+            sparse.save_npz(partial, matrix)
+            os.replace(partial, path)
+            _WEIGHTS[key] = matrix
+    return _WEIGHTS[key]
+
+def regrid(matrix, field, shape):
+    '''[time, lat, lon] field on the target grid of an interpolation matrix
+
+    Weights are renormalized over the source points that have values, and
+    target points with less than half their weight present are NaN.
+    '''
+    data = np.asarray(np.ma.filled(np.ma.asarray(field, dtype=np.float32), np.nan))
+    data = data.reshape(len(data), -1).T
+    present = ~np.isnan(data)
+    with wxtrace.TRACE.stage('regrid'):
+        values = matrix @ np.where(present, data, 0)
+        coverage = matrix @ present.astype(np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values /= coverage
+        values[coverage < 0.5] = np.nan
+    return values.T.reshape((len(field), ) + tuple(shape))
+
+def memberfield(netcdf, select_model, quantity, domain):
+    '''[time, lat, lon] values of a quantity for one member, in float32
+
+    qpf and snow are running totals in inches, snow at SNOWRATIO where
+    csnowsfc is flagged; gust is the surface gust in mph.
+    '''
+    if quantity == 'qpf':
+        return INCHES * wxaccum.accumulate(netcdf, select_model, domain)
+    if quantity == 'snow':
+        return SNOWRATIO * INCHES * wxaccum.accumulate(netcdf, select_model, domain,
+                                                       'csnowsfc')
+    if quantity == 'gust':
+        return MPH * wxdata.readfields(netcdf, ['gustsfc'], domain, compact=True,
+                                       budget=wxdata.MEMORY)['gustsfc']
+    raise ValueError('Unknown quantity: ' + quantity)
+
+def ensemble(members, area, quantity, thresholds=None, resolution=RESOLUTION,
+             weightdir=None):
+    '''Ensemble mean, spread and exceedance probabilities of a quantity
+
+    members is a list of (model name, dataset URL) pairs. Statistics are
+    taken at the valid times that every member has, over the members
+    with a value at each point. probability maps each threshold to the
+    fraction of those members at or above it. Interpolation weights are
+    cached in weightdir (default WEIGHTDIR).
+    '''
+    if thresholds is None:
+        thresholds = THRESHOLDS[quantity]
+    targetlats, targetlons = targetgrid(area, resolution)
+    shape = (len(targetlats), len(targetlons))
+    padded = (area.llat - MARGIN, area.ulat + MARGIN, area.llon - MARGIN, area.rlon + MARGIN)
+
+    datasets = [wxdata.openfile(url) for _, url in members]
+    validtimes = wxdata.timeaxis(datasets[0]).validtimes
+    for netcdf in datasets[1:]:
+        validtimes = np.intersect1d(validtimes, wxdata.timeaxis(netcdf).validtimes)
+
+    stack = np.empty((len(members), len(validtimes)) + shape, dtype=np.float32)
+    for member, ((select_model, _), netcdf) in enumerate(zip(members, datasets)):
+        domain = wxdata.geodomain(netcdf, padded)
+        steps = np.searchsorted(wxdata.timeaxis(netcdf).validtimes, validtimes)
+        field = memberfield(netcdf, select_model, quantity, domain)[steps]
+        matrix = weights(domain[0], domain[1], targetlats, targetlons, weightdir)
+        stack[member] = regrid(matrix, field, shape)
+        wxdata.closefile(netcdf)
+
+    with wxtrace.TRACE.stage('statistics'):
+        present = ~np.isnan(stack)
+        count = present.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(stack, axis=0) / count
+            spread = np.sqrt(np.nansum((stack - mean) ** 2, axis=0) / count)
+            probability = dict((threshold, (stack >= threshold).sum(axis=0) / count)
+                               for threshold in thresholds)
+    return Ensemble(quantity, [select_model for select_model, _ in members], validtimes,
+                    targetlats, targetlons, mean.astype(np.float32),
+                    spread.astype(np.float32),
+                    dict((threshold, values.astype(np.float32))
+                         for threshold, values in probability.items()))
+
+def archive(path, result):
+    '''Save an Ensemble compactly'''
+    probability = dict(('probability_{:g}'.format(threshold), values)
+                       for threshold, values in result.probability.items())
+    np.savez_compressed(path, quantity=result.quantity, members=result.members,
+                        validtimes=result.validtimes, lats=result.lats, lons=result.lons,
+                        mean=result.mean, spread=result.spread, **probability)
+
+def main(argv=None):
+    '''Compute the ensemble statistics of one cycle of several models'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('date')
+    parser.add_argument('cycle')
+    parser.add_argument('--models', nargs='+', default=MODELS)
+    parser.add_argument('--quantity', choices=sorted(THRESHOLDS), default='qpf')
+    parser.add_argument('--thresholds', nargs='+', type=float)
+    parser.add_argument('--area', default='WISCONSIN')
+    parser.add_argument('--resolution', type=float, default=RESOLUTION)
+    parser.add_argument('--server', default=wxdata.SERVER)
+    parser.add_argument('--weightdir', default=WEIGHTDIR)
+    parser.add_argument('--output', default='ensemble.npz')
+    args = parser.parse_args(argv)
+
+    members = [(select_model, wxdata.model(select_model, args.date, args.cycle, args.server))
+               for select_model in args.models]
+    result = ensemble(members, getattr(wxdata, args.area), args.quantity,
+                      args.thresholds, args.resolution, args.weightdir)
+    archive(args.output, result)
+    print('Wrote', args.output, 'from', ' '.join(result.members))
+    print(wxtrace.TRACE.table())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+'''FIND AND DECLUSTER HIGHS AND LOWS OF MODEL FIELDS'''
+
+import matplotlib.pyplot as plt
+import numpy as np
+from scipy.ndimage import maximum_filter, minimum_filter
+from scipy.spatial import cKDTree
+
+def extrema(field, window=10, mode='nearest'):
+    '''Boolean masks of the local minima and maxima of a field
+
+    field is 2-D, or [time, lat, lon] to filter every time slice in one
+    pass. The window (in grid points) controls how many extrema are
+    found: a higher value finds fewer. Use mode='wrap' for global grids
+    that wrap around in longitude. Masked points are never extrema.
+    '''
+    field = np.ma.asarray(field)
+    missing = np.ma.getmaskarray(field)
+    data = np.ma.getdata(field)
+    size = (1, ) * (field.ndim - 2) + (window, window)
+
+    lows = minimum_filter(np.where(missing, np.inf, data), size=size, mode=mode)
+    highs = maximum_filter(np.where(missing, -np.inf, data), size=size, mode=mode)
+    return (data == lows) & ~missing, (data == highs) & ~missing
+
+def decluster(x, y, values, distance, lowest=True):
+    '''Indices of the points to label, no two within distance of each other
+
+    The strongest point (the lowest, or the highest with lowest=False)
+    of each cluster wins. Neighbours come from a KD-tree instead of
+    comparing every point against every label already placed.
+    '''
+    order = np.argsort(values if lowest else -np.asarray(values), kind='stable')
+    points = np.column_stack([np.asarray(x)[order], np.asarray(y)[order]])
+    neighbours = cKDTree(points).query_ball_point(points, distance)
+
+    keep = []
+    suppressed = np.zeros(len(order), dtype=bool)
+    for rank, near in enumerate(neighbours):
+        if not suppressed[rank]:
+            keep.append(order[rank])
+            suppressed[near] = True
+    return np.array(keep, dtype=int)
+
+def centers(field, x, y, distance, window=10, mode='nearest', bounds=None):
+    '''Declustered lows and highs of a 2-D or [time, lat, lon] field
+
+    x and y are the projected coordinates of the grid and distance is in
+    the same units. bounds=(xmin, xmax, ymin, ymax) drops points off the
+    map. Returns one (lows, highs) pair per time slice, each a tuple of
+    x, y and value arrays.
+    '''
+    field = np.ma.asarray(field)
+    squeeze = field.ndim == 2
+    if squeeze:
+        field = field[np.newaxis]
+    x = np.asarray(x)
+    y = np.asarray(y)
+    visible = np.ones(x.shape, dtype=bool)
+    if bounds is not None:
+        xmin, xmax, ymin, ymax = bounds
+        visible = (x > xmin) & (x < xmax) & (y > ymin) & (y < ymax)
+
+    minima, maxima = extrema(field, window, mode)
+    results = []
+    for values, lows, highs in zip(np.ma.getdata(field), minima, maxima):
+        pair = []
+        for found, lowest in ((lows & visible, True), (highs & visible, False)):
+            xs = x[found]
+            ys = y[found]
+            vals = values[found]
+            if len(vals):
+                keep = decluster(xs, ys, vals, distance, lowest)
+                xs, ys, vals = xs[keep], ys[keep], vals[keep]
+            pair.append((xs, ys, vals))
+        results.append(tuple(pair))
+    return results[0] if squeeze else results
+
+def drawcenters(lows, highs, offset, ax=None):
+    '''Plot lows as blue L's and highs as red H's with their values beneath'''
+    if ax is None:
+        ax = plt.gca()
+    for (xs, ys, values), letter, color in ((lows, 'L', 'b'), (highs, 'H', 'r')):
+        for x, y, value in zip(xs, ys, values):
+            ax.text(x, y, letter, fontsize=14, fontweight='bold',
+                    ha='center', va='center', color=color)
+            ax.text(x, y - offset, repr(int(value)), fontsize=9,
+                    ha='center', va='top', color=color,
+                    bbox=dict(boxstyle="square", ec='None', fc=(1, 1, 1, 0.5)))
@@ -0,0 +1,152 @@
+'''FETCH SEVERAL MODELS AND CYCLES CONCURRENTLY
+
+Usage: python wxfetch.py HRRR NAM3K RAP --date 20180211 --cycles 00 06
+                         [--server /path/to/mirror/] [--backend dap]
+'''
+
+import argparse
+import collections
+from concurrent import futures
+import sys
+import time
+from urllib.parse import urlsplit
+import wxcache
+import wxdata
+import wxparallel
+import wxtrace
+
+# Datasets fetched at once, and at most this many from any one server
+WORKERS = 6
+PERHOST = 3
+
+class FetchJob(object):
+    '''One model run to fetch: its dataset and the subset to read from it'''
+
+    def __init__(self, select_model, date, cycle, varnames, area=wxdata.MIDWEST,
+                 start=0, stop=None, step=1, url=None, server=wxdata.SERVER):
+        self.select_model = select_model
+        self.date = date
+        self.cycle = cycle
+        self.varnames = list(varnames)
+        self.area = area
+        self.start = start
+        self.stop = stop
+        self.step = step
+        if url is None:
+            url = wxdata.model(select_model, date, cycle, server)
+        self.url = url
+
+    def host(self):
+        '''Server the dataset comes from; local files share the empty host'''
+        return urlsplit(self.url).netloc
+
+    def key(self):
+        '''Cache key of the dataset'''
+        return (self.select_model, self.date, self.cycle)
+
+    def __repr__(self):
+        return 'FetchJob({} {} {}z)'.format(self.select_model, self.date, self.cycle)
+
+# What a worker hands back for one job. error is None on success, otherwise
+# the exception's text and the other data fields are None.
+Fetched = collections.namedtuple('Fetched', ['job', 'domain', 'timeaxis', 'fields',
+                                             'error', 'seconds'])
+
+def fetch(job, cache=None):
+    '''Open one dataset and read the job's subset from it'''
+    start = time.perf_counter()
+    netcdf = wxdata.openfile(job.url, cache, job.key() if cache else None)
+    try:
+        domain = wxdata.geodomain(netcdf, job.area.coords)
+        timeaxis = wxdata.timeaxis(netcdf)
+        fields = wxdata.readfields(netcdf, job.varnames, domain,
+                                   job.start, job.stop, job.step)
+    finally:
+        wxdata.closefile(netcdf)
+    return Fetched(job, domain, timeaxis, fields, None, time.perf_counter() - start)
+
+def _fetchjob(job, cache):
+    '''Fetch in a worker process and hand its trace records back'''
+    wxtrace.TRACE.reset()
+    start = time.perf_counter()
+    try:
+        with wxtrace.TRACE.stage('fetch', model=job.select_model, cycle=job.cycle):
+            fetched = fetch(job, cache)
+    except Exception as error:
+        fetched = Fetched(job, None, None, None, '{}: {}'.format(
+            type(error).__name__, error), time.perf_counter() - start)
+    return fetched, list(wxtrace.TRACE.records)
+
+def fetchall(jobs, cache=None, workers=WORKERS, perhost=PERHOST):
+    '''Fetch every job concurrently and yield Fetched results as they finish
+
+    At most workers datasets are read at once, and at most perhost of them
+    from the same server. Jobs start in the order given whenever a slot is
+    free. A failed job is yielded with its error instead of stopping the
+    others.
+
+    netCDF4 is not thread-safe, so the jobs run in worker processes.
+    '''
+    if workers < 1 or perhost < 1:
+        raise ValueError('workers and perhost must be at least 1')
+    pending = collections.deque(jobs)
+    running = {}
+    hosts = collections.Counter()
+    workers = max(1, min(workers, len(pending)))
+
+    with futures.ProcessPoolExecutor(workers, mp_context=wxparallel.CONTEXT) as pool:
+        while pending or running:
+            for _ in range(len(pending)):
+                job = pending.popleft()
+                if len(running) < workers and hosts[job.host()] < perhost:
+                    running[pool.submit(_fetchjob, job, cache)] = job
+                    hosts[job.host()] += 1
+                else:
+                    pending.append(job)
+            if not running:
+                raise RuntimeError('No job can start: {!r}'.format(list(pending)))
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                hosts[job.host()] -= 1
+                fetched, records = future.result()
+                wxtrace.TRACE.merge(records)
+                yield fetched
+
+def main(argv=None):
+    '''Fetch the models and cycles given on the command line and report'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('models', nargs='+')
+    parser.add_argument('--date', required=True)
+    parser.add_argument('--cycles', nargs='+', default=['00'])
+    parser.add_argument('--varnames', nargs='+', default=['apcpsfc'])
+    parser.add_argument('--server', default=wxdata.SERVER)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--perhost', type=int, default=PERHOST)
+    parser.add_argument('--nocache', action='store_true')
+    parser.add_argument('--backend', choices=['netCDF4', 'dap'], default=wxdata.BACKEND)
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.perhost < 1:
+        parser.error('--workers and --perhost must be at least 1')
+    # Worker processes are forked, so they open datasets the same way
+    wxdata.BACKEND = args.backend
+
+    jobs = [FetchJob(select_model, args.date, cycle, args.varnames,
+                     server=args.server)
+            for select_model in args.models for cycle in args.cycles]
+    cache = None if args.nocache else wxcache.FieldCache()
+
+    failed = 0
+    for fetched in fetchall(jobs, cache, args.workers, args.perhost):
+        if fetched.error:
+            failed += 1
+            print('{!r} failed after {:.1f}s: {}'.format(fetched.job, fetched.seconds,
+                                                        fetched.error))
+        else:
+            print('{!r} fetched in {:.1f}s'.format(fetched.job, fetched.seconds))
+    print(wxtrace.TRACE.table())
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+'''WRITE SYNTHETIC NOMADS-SHAPED NETCDF FILES FOR BENCHMARKS'''
+
+import datetime
+import http.server
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import unquote
+import netCDF4
+import numpy as np
+
+FILLVALUE = 9.999e20
+
+# Approximate shapes of the NOMADS GrADS grids: lat/lon axes, hours between
+# timesteps, and whether variables carry NARRE's leading ensemble dimension
+GRIDS = {
+    'GFS': {'lats': np.linspace(-90, 90, 721), 'lons': np.arange(0, 360, 0.25),
+            'interval': 3, 'ens': False},
+    'HRRR': {'lats': np.linspace(21.14, 52.62, 1059),
+             'lons': np.linspace(-134.10, -60.92, 1799),
+             'interval': 1, 'ens': False},
+    'NARRE': {'lats': np.linspace(16.28, 55.48, 337),
+              'lons': np.linspace(-139.86, -57.38, 451),
+              'interval': 1, 'ens': True},
+}
+
+# Variable name: (long name, units, scale of the synthetic field)
+VARIABLES = {
+    'apcpsfc': ('surface total precipitation [kg/m^2]', 'kg/m^2', 4.),
+    'csnowsfc': ('surface categorical snow [yes=1;no=0]', 'yes=1;no=0', 1.),
+    'crainsfc': ('surface categorical rain [yes=1;no=0]', 'yes=1;no=0', 1.),
+    'cicepsfc': ('surface categorical ice pellets [yes=1;no=0]', 'yes=1;no=0', 1.),
+    'cfrzrsfc': ('surface categorical freezing rain [yes=1;no=0]', 'yes=1;no=0', 1.),
+    'refd1000m': ('1000 m above ground reflectivity [db]', 'db', 60.),
+    'ugrd10m': ('10 m above ground u-component of wind [m/s]', 'm/s', 15.),
+    'vgrd10m': ('10 m above ground v-component of wind [m/s]', 'm/s', 15.),
+    'gustsfc': ('surface wind speed (gust) [m/s]', 'm/s', 30.),
+    'prmslmsl': ('mean sea level pressure reduced to msl [pa]', 'pa', 3000.),
+    'tmpprs': ('(1000 975 950 .. 7 5 3 2 1) temperature [k]', 'k', 8.),
+}
+# Pressure levels (hPa) of the fixtures written with levels=True
+LEVELS = [1000, 925, 850, 700, 500, 300]
+
+def synthetic(name, lats, lons, hour):
+    '''Smooth moving weather systems, so contouring costs what it would live'''
+    scale = VARIABLES[name][2]
+    lon2d, lat2d = np.meshgrid(np.radians(lons), np.radians(lats))
+    phase = hour / 12.
+    wave = (np.sin(3 * lon2d + phase) * np.cos(4 * lat2d - phase / 2) +
+            0.5 * np.sin(7 * lon2d - 5 * lat2d + phase))
+
+    if name.startswith('c'):
+        # Categorical types occupy neighbouring bands of the same system
+        band = {'crainsfc': 0, 'cfrzrsfc': 1, 'cicepsfc': 2, 'csnowsfc': 3}[name]
+        return ((wave > 0.2 + 0.3 * band) & (wave <= 0.5 + 0.3 * band)).astype('f4')
+    if name in ('apcpsfc', 'gustsfc'):
+        return (scale * np.clip(wave, 0, None)).astype('f4')
+    if name == 'prmslmsl':
+        return (101325. + scale * wave).astype('f4')
+    if name == 'tmpprs':
+        # Standard atmosphere lapse rate, from near freezing at the surface
+        return np.array([268. + scale * wave - 0.065 * (1000 - level)
+                         for level in LEVELS]).astype('f4')
+    return (scale * wave).astype('f4')
+
+def writefixture(path, grid='HRRR', steps=None, init=datetime.datetime(2018, 2, 11, 0),
+                 varnames=None, unlimited=False, levels=False):
+    '''Write a netCDF file laid out like a NOMADS OpenDAP model dataset
+
+    With unlimited=True, growfixture can append timesteps later, the way
+    forecast hours arrive while a cycle is published. Such fixtures are
+    netCDF-3 files, which HDF5 file locking does not stop from growing
+    while a reader has them open. levels=True adds tmpprs on LEVELS.
+    '''
+    spec = GRIDS[grid]
+    if steps is None:
+        steps = 7
+    if varnames is None:
+        varnames = sorted(name for name in VARIABLES if name != 'tmpprs')
+        if levels:
+            varnames.append('tmpprs')
+    lats = spec['lats']
+    lons = spec['lons']
+
+    netcdf = netCDF4.Dataset(path, 'w', format='NETCDF3_64BIT_OFFSET' if unlimited
+                             else 'NETCDF4')
+    if spec['ens']:
+        netcdf.createDimension('ens', 1)
+    netcdf.createDimension('time', None if unlimited else steps)
+    if levels:
+        netcdf.createDimension('lev', len(LEVELS))
+    netcdf.createDimension('lat', len(lats))
+    netcdf.createDimension('lon', len(lons))
+
+    hours = np.arange(steps) * spec['interval']
+    time = netcdf.createVariable('time', 'f8', ('time', ))
+    time.units = 'days since 1-1-1 00:00:0.0'
+    time.grads_dim = 't'
+    # GrADS counts days since year 1 in the mixed Julian/Gregorian
+    # calendar, which date2num only uses when asked for it
+    time[:] = netCDF4.date2num([init + datetime.timedelta(hours=int(hour))
+                                for hour in hours], time.units, calendar='standard')
+    netcdf.createVariable('lat', 'f8', ('lat', ))[:] = lats
+    netcdf.createVariable('lon', 'f8', ('lon', ))[:] = lons
+    if spec['ens']:
+        netcdf.createVariable('ens', 'f8', ('ens', ))[:] = [1]
+    if levels:
+        lev = netcdf.createVariable('lev', 'f8', ('lev', ))
+        lev.units = 'millibar'
+        lev[:] = LEVELS
+
+    for name in varnames:
+        dimensions = ('time', 'lev', 'lat', 'lon') if name == 'tmpprs' else ('time', 'lat', 'lon')
+        if spec['ens']:
+            dimensions = ('ens', ) + dimensions
+        variable = netcdf.createVariable(name, 'f4', dimensions,
+                                         fill_value=np.float32(FILLVALUE))
+        variable.long_name = VARIABLES[name][0]
+        variable.units = VARIABLES[name][1]
+        variable.missing_value = np.float32(FILLVALUE)
+        writesteps(variable, spec, 0, hours)
+
+    netcdf.close()
+    return path
+
+def writesteps(variable, spec, first, hours):
+    '''Write the synthetic fields of timesteps first, first + 1, ...'''
+    for step, hour in enumerate(hours, first):
+        field = synthetic(variable.name, spec['lats'], spec['lons'], hour)
+        if variable.name == 'apcpsfc' and step == 0:
+            field[:] = FILLVALUE
+        if spec['ens']:
+            variable[0, step] = field
+        else:
+            variable[step] = field
+
+def growfixture(path, grid='HRRR', steps=1):
+    '''Append timesteps to a fixture written with unlimited=True'''
+    spec = GRIDS[grid]
+    netcdf = netCDF4.Dataset(path, 'a')
+    time = netcdf.variables['time']
+    first = len(time)
+    hours = (first + np.arange(steps)) * spec['interval']
+    time[first:] = time[0] + hours / 24.
+    for name in netcdf.variables:
+        if name in VARIABLES:
+            writesteps(netcdf.variables[name], spec, first, hours)
+    netcdf.close()
+    return path
+
+def writefixtures(directory, steps=None):
+    '''Write one fixture per grid and return their paths by grid name'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return dict((grid, writefixture(os.path.join(directory, grid.lower() + '.nc'),
+                                    grid, steps))
+                for grid in GRIDS)
+
+# numpy kinds of the DAP2 types a stand-in server sends
+DAPTYPES = {'f4': 'Float32', 'f8': 'Float64', 'i4': 'Int32', 'i2': 'Int16',
+            'u1': 'Byte'}
+# netcdf-c is not thread-safe, so the server reads one file at a time
+_NETCDFLOCK = threading.Lock()
+
+def daptype(variable):
+    '''DAP2 type name of a netCDF variable'''
+    return DAPTYPES[variable.dtype.str[1:]]
+
+def dapdeclaration(kind, name, dimensions, shape):
+    '''DDS line of an array, e.g. Float32 apcpsfc[time = 7][lat = 1059]'''
+    return '{} {}{};'.format(kind, name, ''.join(
+        '[{} = {}]'.format(dimension, size) for dimension, size in zip(dimensions, shape)))
+
+def dapmap(netcdf, dimension, index=slice(None)):
+    '''DAP2 type and values of the map of a dimension
+
+    Dimensions without a coordinate variable are numbered from 0.
+    '''
+    if dimension in netcdf.variables:
+        coordinate = netcdf.variables[dimension]
+        return daptype(coordinate), np.asarray(coordinate[index])
+    return 'Int32', np.arange(len(netcdf.dimensions[dimension]))[index]
+
+def dapdds(netcdf, name, shapes=None):
+    '''DDS of a dataset, or of the arrays and shapes of a constraint
+
+    Variables on coordinates other than their own are Grids, as on the
+    GrADS Data Server.
+    '''
+    if shapes is None:
+        shapes = dict((varname, variable.shape)
+                      for varname, variable in netcdf.variables.items())
+    lines = ['Dataset {']
+    for varname, shape in shapes.items():
+        variable = netcdf.variables[varname]
+        declaration = dapdeclaration(daptype(variable), varname, variable.dimensions, shape)
+        if variable.dimensions == (varname, ):
+            lines.append('    ' + declaration)
+            continue
+        lines.extend(['    Grid {', '     ARRAY:', '        ' + declaration, '     MAPS:'])
+        for dimension, size in zip(variable.dimensions, shape):
+            lines.append('        ' + dapdeclaration(dapmap(netcdf, dimension, slice(0))[0],
+                                                     dimension, (dimension, ), (size, )))
+        lines.append('    }} {};'.format(varname))
+    lines.append('}} {};'.format(name))
+    return '\n'.join(lines) + '\n'
+
+def dapdas(netcdf):
+    '''DAS of the attributes of every variable'''
+    lines = ['Attributes {']
+    for varname, variable in netcdf.variables.items():
+        lines.append('    {} {{'.format(varname))
+        for attribute in variable.ncattrs():
+            value = variable.getncattr(attribute)
+            if isinstance(value, str):
+                lines.append('        String {} "{}";'.format(
+                    attribute, value.replace('"', '\\"')))
+            else:
+                value = np.atleast_1d(value)
+                lines.append('        {} {} {};'.format(
+                    DAPTYPES[value.dtype.str[1:]], attribute,
+                    ', '.join(repr(item) for item in value.tolist())))
+        lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def xdr(array, kind):
+    '''XDR encoding of an array: its length twice, then its values'''
+    array = np.ravel(array)
+    length = np.array([array.size, array.size], dtype='>u4').tobytes()
+    if kind == 'Byte':
+        data = array.astype('u1').tobytes()
+        return length + data + bytes(-len(data) % 4)
+    wire = {'Float32': '>f4', 'Float64': '>f8', 'Int32': '>i4', 'Int16': '>i4'}[kind]
+    return length + array.astype(wire).tobytes()
+
+def dapdods(netcdf, name, constraint):
+    '''.dods response of constraints like apcpsfc[0:1:6][10:1:20][0:2:100]
+
+    Grids are sent as their array followed by the matching slices of
+    their maps.
+    '''
+    indexes = {}
+    for projection in constraint.split(','):
+        indexes[projection.split('[')[0]] = tuple(
+            slice(int(first), int(last) + 1, int(step)) for first, step, last
+            in re.findall(r'\[(\d+):(\d+):(\d+)\]', projection))
+
+    arrays = {}
+    for varname, index in indexes.items():
+        variable = netcdf.variables[varname]
+        variable.set_auto_mask(False)
+        arrays[varname] = np.asarray(variable[index or slice(None)])
+    shapes = dict((varname, array.shape) for varname, array in arrays.items())
+
+    body = (dapdds(netcdf, name, shapes) + '\nData:\n').encode('utf-8')
+    for varname, array in arrays.items():
+        variable = netcdf.variables[varname]
+        body += xdr(array, daptype(variable))
+        if variable.dimensions != (varname, ):
+            index = indexes[varname] or (slice(None), ) * variable.ndim
+            for dimension, part in zip(variable.dimensions, index):
+                kind, values = dapmap(netcdf, dimension, part)
+                body += xdr(values, kind)
+    return body
+
+class DapHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves the netCDF files of a directory the way a DAP2 server would
+
+    A request for e.g. /hrrr/hrrr20180211/hrrr_sfc_02z.dds reads
+    hrrr/hrrr20180211/hrrr_sfc_02z, or the same with .nc, under the
+    server's directory, so a wxfetch mirror can be served as it is.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.random.random() < server.failrate
+        if server.delay:
+            time.sleep(server.delay)
+        if fail:
+            return self.reply(503, b'Service Unavailable')
+
+        path, _, constraint = self.path.partition('?')
+        base, extension = os.path.splitext(unquote(path).lstrip('/'))
+        filename = os.path.join(server.directory, base)
+        if not os.path.isfile(filename):
+            filename += '.nc'
+        if extension not in ('.dds', '.das', '.dods') or not os.path.isfile(filename):
+            return self.reply(404, b'Not Found')
+        name = os.path.basename(base)
+        with _NETCDFLOCK:
+            netcdf = netCDF4.Dataset(filename)
+            try:
+                if extension == '.dds':
+                    body = dapdds(netcdf, name).encode('utf-8')
+                elif extension == '.das':
+                    body = dapdas(netcdf).encode('utf-8')
+                else:
+                    body = dapdods(netcdf, name, unquote(constraint))
+            finally:
+                netcdf.close()
+        return self.reply(200, body)
+
+    def reply(self, status, body):
+        '''Send a response that keeps the connection open'''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(directory, port=0, failrate=0., delay=0., seed=0):
+    '''Start a stand-in DAP2 server of a directory in a background thread
+
+    failrate is the fraction of requests answered with 503, and delay the
+    seconds every request waits first, to try out retries and parallel
+    requests. server.url is the base URL, and server.shutdown() stops it.
+    '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), DapHandler)
+    server.daemon_threads = True
+    server.directory = directory
+    server.failrate = failrate
+    server.delay = delay
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
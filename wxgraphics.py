@@ -1,141 +1,267 @@
 '''Forecast Weather Data Plots'''
 
+import sys
+import time
 from mpl_toolkits.basemap import Basemap
-import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import wxdata
+import wxcache
+import wxparallel
+import wxmaps
+import wxaccum
+import wxanim
+import wxptype
+import wxraster
+import wxsnow
+import wxstore
+import wxtrace
+import wxwatch
 
 MODEL = 'HRRR'
 DATE_INIT = '20180211'
 CYCLE = '02'
 
-if MODEL == 'GFSH' or MODEL == 'GFS':
-    AREA = wxdata.WISCONSIN_GLOBAL
-else:
-    AREA = wxdata.WISCONSIN
+# Per-stage timings of the run are written here; a run that takes longer
+# than SLA seconds exits with status 2 so that cron monitoring notices
+TRACEFILE = 'trace.json'
+SLA = 3600
+wxtrace.TRACE.name = 'wxgraphics {} {} {}z'.format(MODEL, DATE_INIT, CYCLE)
+wxtrace.TRACE.sla = SLA
+
+# Write each frame as a 300 dpi PNG, and/or encode GIF and MP4 animations
+# from the rendered figures
+STILLS = True
+ANIMATE = True
+
+# Watch mode polls the cycle and renders forecast hours as they arrive,
+# keeping its manifest and accumulation state in WATCHDIR
+WATCH = False
+WATCHDIR = 'watch'
+
+# Snow-to-liquid ratio of the snowfall maps: a fixed ratio, or 'kuchera'
+# to set it from the temperature column of tmpprs. Watch mode uses 20.
+RATIO = 20
+
+AREA = wxdata.WISCONSIN
 
 FILENAME = wxdata.model(MODEL, DATE_INIT, CYCLE)
-CONTENTS = wxdata.openfile(FILENAME)
-TIME = wxdata.time(CONTENTS)
-DOMAIN = wxdata.geodomain(CONTENTS, AREA.coords)
+# A cycle ingested with wxstore.py is read from the local disk instead, if
+# it holds the variables of the maps over the whole of AREA
+VARNAMES = ['apcpsfc', 'csnowsfc'] + (['tmpprs', 'lev'] if RATIO == 'kuchera' else [])
+if wxstore.covers(wxstore.storepath(MODEL, DATE_INIT, CYCLE), AREA.coords, VARNAMES):
+    FILENAME = wxstore.storepath(MODEL, DATE_INIT, CYCLE)
+# Set offline=True to re-render from the local cache without the server
+CACHE = wxcache.FieldCache(offline=False)
 
-LATS = DOMAIN[0]
-LONS = DOMAIN[1]
 MAPWIDTH = AREA.mapdimensions()[0]
 MAPHEIGHT = AREA.mapdimensions()[1]
 LOWER_LAT = AREA.llat
 UPPER_LAT = AREA.ulat
-LLAT_I = DOMAIN[2]
-ULAT_I = DOMAIN[3]
-LLON_I = DOMAIN[4]
-RLON_I = DOMAIN[5]
 CENTERPT_LAT = AREA.centerpoint()[0]
 CENTERPT_LON = AREA.centerpoint()[1]
 
-VALIDTIMES = TIME[0]
-TIMESTEPS = TIME[1]
+# Set by opencycle(), which watch mode retries until the cycle is published
+CONTENTS = None
+
+
+def drawland(basemap, ax):
+    '''Land and water, drawn beneath the weather data'''
+    #basemap.drawcoastlines(linewidth=0.75, zorder=5, ax=ax)
+    basemap.fillcontinents(color='#e6e6e6', lake_color='#b3ffff', ax=ax)
+    basemap.drawmapboundary(fill_color='#b3ffff', ax=ax)
+
+
+def drawcounties(basemap, ax):
+    '''County lines, drawn over the weather data'''
+    #basemap.drawcountries(linewidth=1.0, zorder=7, ax=ax)
+    basemap.readshapefile('../../GIS/wi_county/co55_d00', 'counties',
+                          zorder=6, linewidth=0.3, color='gray', ax=ax)
+
+
+def drawstates(basemap, ax):
+    '''State lines, drawn over the weather data and the legends'''
+    basemap.readshapefile('../../GIS/us_states/cb_2016_us_state_5m', 'states',
+                          linewidth=0.75, zorder=10, ax=ax)
+
 
-BASEMAP = Basemap(width=MAPWIDTH, height=MAPHEIGHT,
-                  rsphere=(6378137.00, 6356752.3142),
-                  resolution='i', area_thresh=1000., projection='lcc',
-                  lat_1=LOWER_LAT, lat_2=UPPER_LAT,
-                  lat_0=CENTERPT_LAT, lon_0=CENTERPT_LON)
+def opencycle():
+    '''Open the cycle and build the map of its domain'''
+    global CONTENTS, TIME, DOMAIN, LATS, LONS, LLAT_I, ULAT_I, LLON_I, RLON_I
+    global VALIDTIMES, TIMESTEPS, BASEMAP, X, Y, BACKGROUND
+    CONTENTS = wxdata.openfile(FILENAME, CACHE, (MODEL, DATE_INIT, CYCLE))
+    TIME = wxdata.time(CONTENTS)
+    DOMAIN = wxdata.geodomain(CONTENTS, AREA.coords)
 
-X, Y = BASEMAP(* np.meshgrid(LONS, LATS))
+    LATS = DOMAIN[0]
+    LONS = DOMAIN[1]
+    LLAT_I = DOMAIN[2]
+    ULAT_I = DOMAIN[3]
+    LLON_I = DOMAIN[4]
+    RLON_I = DOMAIN[5]
+
+    VALIDTIMES = TIME[0]
+    TIMESTEPS = TIME[1]
+
+    with wxtrace.TRACE.stage('basemap'):
+        BASEMAP = Basemap(width=MAPWIDTH, height=MAPHEIGHT,
+                          rsphere=(6378137.00, 6356752.3142),
+                          resolution='i', area_thresh=1000., projection='lcc',
+                          lat_1=LOWER_LAT, lat_2=UPPER_LAT,
+                          lat_0=CENTERPT_LAT, lon_0=CENTERPT_LON)
+
+    X, Y = wxmaps.projectgrid(BASEMAP, LATS, LONS)
+
+    # Static layers are rendered once per domain and projection, then reused
+    BACKGROUND = wxmaps.MapBackground(BASEMAP, [
+        ('land', 1, drawland),
+        ('wi-counties', 6, drawcounties),
+        ('us-states', 10, drawstates),
+    ]).load()
 
 
 def mapfeatures():
     '''Defines how the map will look'''
-    #BASEMAP.drawcoastlines(linewidth=0.75, zorder=5)
-    BASEMAP.fillcontinents(color='#e6e6e6', lake_color='#b3ffff')
-    #BASEMAP.drawcountries(linewidth=1.0, zorder=7)
-    BASEMAP.readshapefile('../../GIS/us_states/cb_2016_us_state_5m', 'states',
-                          linewidth=0.75, zorder=10)
-    BASEMAP.readshapefile('../../GIS/wi_county/co55_d00', 'counties',
-                          zorder=6, linewidth=0.3, color='gray')
-    BASEMAP.drawmapboundary(fill_color='#b3ffff')
-
-
-def mapfigure(title, fprefix, TIMESTEP):
-    '''Generate image on the disk'''
-    plt.title(title + '\n' + VALIDTIMES[TIMESTEP] + '')
-    plt.savefig(fprefix + str(TIMESTEP) + '.png', dpi=300, bbox_inches='tight')
+    BACKGROUND.draw()
+
+
+def mapfigure(title, fprefix, TIMESTEP, validtimes=None):
+    '''Generate image on the disk and return the animation frame'''
+    if validtimes is None:
+        validtimes = VALIDTIMES
+    plt.title(title + '\n' + validtimes[TIMESTEP] + '')
+    if STILLS:
+        with wxtrace.TRACE.stage('savefig', TIMESTEP):
+            plt.savefig(fprefix + str(TIMESTEP) + '.png', dpi=300, bbox_inches='tight')
+    frame = None
+    if ANIMATE:
+        with wxtrace.TRACE.stage('canvas', TIMESTEP):
+            frame = wxanim.canvasframe()
     print('Finished creating image', TIMESTEP)
+    return frame
 
 
-def plotprecip():
-    '''Plot precipitation type areas'''
-    global TIMESTEP
+def animate(fprefix, render, fields, frames, workers, **kwargs):
+    '''Render the frames, encoding the animations as they arrive'''
+    animation = wxanim.Animation(fprefix) if ANIMATE else None
+    wxparallel.renderframes(render, fields, frames, workers,
+                            consume=animation and animation.add, **kwargs)
+    if animation is not None:
+        with wxtrace.TRACE.stage('animation'):
+            animation.close()
+
 
+def precipframe(fields, TIMESTEP):
+    '''Plot precipitation type areas for one timestep'''
     TITLE = 'Precipitation Type '
     FPREFIX = 'ptype'
 
-    for TIMESTEP in range(0, TIMESTEPS, 1):
-        rain = CONTENTS.variables['crainsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        snow = CONTENTS.variables['csnowsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        sleet = CONTENTS.variables['cicepsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        frzrain = CONTENTS.variables['cfrzrsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        clevs = [0.25, 1]
-
-        BASEMAP.contourf(X, Y, rain, clevs, colors='#00b300', zorder=4)
-        BASEMAP.contourf(X, Y, snow, clevs, colors='#8080ff', zorder=4)
-        BASEMAP.contourf(X, Y, sleet, clevs, colors='#ffcc80', zorder=4)
-        BASEMAP.contourf(X, Y, frzrain, clevs, colors='#ff80bf', zorder=4)
-
-        snow_patch = mpatches.Patch(color='#8080ff', label='Snow')
-        sleet_patch = mpatches.Patch(color='#ffcc80', label='Sleet')
-        frzrain_patch = mpatches.Patch(color='#ff80bf', label='Frz Rain')
-        rain_patch = mpatches.Patch(color='#00b300', label='Rain')
-        legend = plt.legend(handles=[snow_patch, sleet_patch,
-                                    frzrain_patch, rain_patch])
-        legend.set_zorder(10)
-
-        mapfeatures()
-        mapfigure(TITLE, FPREFIX, TIMESTEP)
-        plt.close()
-
-
-def snowaccumulator(ratio):
-    '''Plot snowfall amounts'''
-    global TIMESTEP
+    with wxtrace.TRACE.stage('raster', TIMESTEP):
+        wxptype.draw(BASEMAP, X, Y, fields['ptype'][TIMESTEP])
+    legend = wxptype.legend()
+    legend.set_zorder(10)
+
+    mapfeatures()
+    frame = mapfigure(TITLE, FPREFIX, TIMESTEP)
+    plt.close()
+    return frame
 
+
+def plotprecip(workers=1):
+    '''Plot precipitation type areas'''
+    FIELDS = {'ptype': wxptype.classify(wxdata.readfields(
+        CONTENTS, wxptype.PTYPES, DOMAIN, 0, TIMESTEPS))}
+    animate('ptype', precipframe, FIELDS, range(0, TIMESTEPS, 1), workers)
+
+
+SNOWCONTOURS = ('#f1eef6', '#bdc9e1', '#74a9cf', '#0570b0', '#feebe2', '#fbb4b9',
+                '#f768a1', '#c51b8a', '#7a0177', )
+SNOWCLEVS = [0.1, 0.5, 1.0, 3.0, 6.0, 9.0, 12.00, 18.00, 24.00]
+
+
+def snowframe(fields, TIMESTEP, ratio, start=0, validtimes=None):
+    '''Plot snowfall amounts for one timestep
+
+    fields hold the timesteps from start onward.
+    '''
     TITLE = 'Snow Accumulation Ending '
     FPREFIX = 'accum_snow'
 
-    snow_accum = CONTENTS.variables['apcpsfc'][1, LLAT_I:ULAT_I, LLON_I:RLON_I]
-    snow_accum = np.zeros_like(snow_accum)
+    plt.figure()
+    with wxtrace.TRACE.stage('contourf', TIMESTEP):
+        BASEMAP.contourf(X, Y, ratio * (fields['snow_accum'][TIMESTEP - start]/25.4),
+                         SNOWCLEVS, colors=SNOWCONTOURS, zorder=4, extend='max')
+    BASEMAP.colorbar(location='right')
+
+    mapfeatures()
+    frame = mapfigure(TITLE, FPREFIX, TIMESTEP, validtimes)
+    plt.close()
+    return frame
+
+
+def snowtotals(ratio):
+    '''Snow accumulation and the ratio to multiply it by
+
+    With ratio='kuchera' the totals are already snow, and the ratio is 1.
+    '''
+    if ratio == 'kuchera':
+        return wxsnow.snowfall(CONTENTS, MODEL, DOMAIN), 1
+    return wxaccum.accumulate(CONTENTS, MODEL, DOMAIN, 'csnowsfc'), ratio
+
+
+def snowaccumulator(ratio, workers=1):
+    '''Plot snowfall amounts'''
+    snow_accum, ratio = snowtotals(ratio)
+    animate('accum_snow', snowframe, {'snow_accum': snow_accum},
+            range(0, TIMESTEPS, 1), workers, ratio=ratio)
+
+
+def rastersnow(ratio, fprefix='accum_snow_web'):
+    '''Write colour-mapped snowfall images for the web without matplotlib'''
+    snow_accum, ratio = snowtotals(ratio)
+    raster = wxraster.Raster(BASEMAP, LATS, LONS, BACKGROUND.width)
+    colortable = wxraster.ColorTable(SNOWCLEVS, SNOWCONTOURS, extend='max')
+    for TIMESTEP in range(0, TIMESTEPS, 1):
+        with wxtrace.TRACE.stage('raster', TIMESTEP):
+            image = raster.render(ratio * snow_accum[TIMESTEP] / 25.4, colortable)
+            image = wxraster.onbackground(BACKGROUND, image)
+        wxraster.save(fprefix + str(TIMESTEP) + '.png', image)
+
+
+def watchsnow(ratio, workers=1, interval=wxwatch.INTERVAL, timeout=None):
+    '''Plot snowfall amounts as the forecast hours are published
+
+    Waits for the cycle to appear before building the map, then renders
+    each forecast hour once its data is in.
+    '''
+    started = time.time()
+    while CONTENTS is None:
+        try:
+            opencycle()
+        except (IOError, OSError, RuntimeError) as error:
+            print('Opening {} failed: {}'.format(FILENAME, error))
+            if timeout is not None and time.time() - started + interval > timeout:
+                return False
+            time.sleep(interval)
+
+    watch = wxwatch.Watch(FILENAME, MODEL, AREA, snowframe, directory=WATCHDIR,
+                          accumulate='snow_accum', ptype='csnowsfc',
+                          probe='csnowsfc', workers=workers, ratio=ratio)
+    if timeout is not None:
+        timeout -= time.time() - started
+    return watch.run(interval, timeout=timeout)
+
 
-    if MODEL == 'GFS':
-        TIMEINT = 2
-    elif MODEL == 'GFSH':
-        TIMEINT = 6
-    elif MODEL == 'RAP':
-        TIMEINT = 3
+if __name__ == '__main__':
+    if WATCH:
+        watchsnow(ratio=20, workers=wxparallel.WORKERS)
     else:
-        TIMEINT = 1
-
-    for TIMESTEP in range(0, TIMESTEPS, TIMEINT):
-        plt.figure()
-        qpf = CONTENTS.variables['apcpsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        snow = CONTENTS.variables['csnowsfc'][TIMESTEP, LLAT_I:ULAT_I, LLON_I:RLON_I]
-        snow_timestep = (np.ma.masked_where(snow < 1, qpf))
-        snow_timestep = snow_timestep.filled(0)
-        snow_accum = np.add(snow_accum, snow_timestep)
-
-        qpfcontours = ('#f1eef6', '#bdc9e1', '#74a9cf', '#0570b0', '#feebe2', '#fbb4b9',
-                    '#f768a1', '#c51b8a', '#7a0177', )
-        clevs = [0.1, 0.5, 1.0, 3.0, 6.0, 9.0, 12.00, 18.00, 24.00]
-        BASEMAP.contourf(X, Y, ratio * (snow_accum/25.4), clevs, colors=qpfcontours, 
-                         zorder=4, extend='max')
-        BASEMAP.colorbar(location='right')
-
-        mapfeatures()
-        mapfigure(TITLE, FPREFIX, TIMESTEP)
-        plt.close()
-
-
-snowaccumulator(ratio=20)
-#plotprecip()
-wxdata.closefile(CONTENTS)
-print('The program has completed.')
+        opencycle()
+        snowaccumulator(ratio=RATIO, workers=wxparallel.WORKERS)
+        #plotprecip(workers=wxparallel.WORKERS)
+    if CONTENTS is not None:
+        wxdata.closefile(CONTENTS)
+    wxtrace.TRACE.write(TRACEFILE)
+    print(wxtrace.TRACE.table())
+    print('The program has completed.')
+    if wxtrace.TRACE.oversla():
+        sys.exit(2)
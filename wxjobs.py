@@ -0,0 +1,255 @@
+'''RUN MODEL, CYCLE, PRODUCT AND SECTOR JOBS FROM A JOB SPEC
+
+Usage: python wxjobs.py jobs.json [--workers 6] [--perhost 3] [--plan]
+
+A job spec is JSON, e.g.
+
+    {"date": "20180211", "directory": "maps",
+     "areas": {"DANE": [42.8, 43.3, -89.9, -89.0]},
+     "jobs": [{"models": ["HRRR", "RAP"], "cycles": ["00", "06"],
+               "products": ["reflectivity", "snowaccumulation"],
+               "sectors": ["WISCONSIN", "DANE"]},
+              {"models": ["GFS"], "cycles": ["00"], "date": "20180210",
+               "products": ["windgusts"], "sectors": ["MIDWEST"]}]}
+
+Sectors are Geography names in wxdata or boxes under "areas". date,
+server, directory and storedir may be set for the whole spec or per job.
+Every model cycle is fetched once into a wxstore, with the variables of
+all its products over the union of all its sectors, and each sector is
+then rendered from the local store. Fetches and renders share one pool
+of worker processes.
+'''
+
+import argparse
+import collections
+from concurrent import futures
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+import wxcache
+import wxdata
+import wxfetch
+import wxparallel
+import wxproducts
+import wxstore
+import wxtrace
+
+class FetchTask(object):
+    '''One model cycle to fetch into a store: variables over sector boxes'''
+
+    def __init__(self, select_model, date, cycle, server, storedir):
+        self.select_model = select_model
+        self.date = date
+        self.cycle = cycle
+        self.url = wxdata.model(select_model, date, cycle, server)
+        self.storedir = storedir
+        self.varnames = []
+        self.sectors = {}
+
+    def add(self, products, sectors):
+        '''Also fetch what products need over sectors, a dict of Geography'''
+        for product in products:
+            product = wxproducts.PRODUCTS[product]
+            for varname in product.varnames + [product.ptype]:
+                if varname is not None and varname not in self.varnames:
+                    self.varnames.append(varname)
+        self.sectors.update(sectors)
+
+    def path(self):
+        '''Store directory, named by the variables and boxes it holds'''
+        key = wxcache.cachekey(sorted(self.varnames),
+                               sorted((name, area.coords) for name, area in self.sectors.items()))
+        return os.path.join(wxstore.storepath(self.select_model, self.date, self.cycle,
+                                              self.storedir), key[:12])
+
+    def host(self):
+        '''Server the dataset comes from; local files share the empty host'''
+        return urlsplit(self.url).netloc
+
+    def __repr__(self):
+        return 'FetchTask({} {} {}z: {})'.format(self.select_model, self.date, self.cycle,
+                                                 ' '.join(self.varnames))
+
+class RenderTask(object):
+    '''Products of one sector, rendered from the store of a FetchTask'''
+
+    def __init__(self, fetch, sector, directory):
+        self.fetch = fetch
+        self.sector = sector
+        self.directory = directory
+        self.products = []
+
+    def __repr__(self):
+        return 'RenderTask({} {} {}z {}: {})'.format(
+            self.fetch.select_model, self.fetch.date, self.fetch.cycle, self.sector,
+            ' '.join(self.products))
+
+# Tasks in dependency order: each render comes after the fetch it names
+Plan = collections.namedtuple('Plan', ['fetches', 'renders'])
+
+# What a worker hands back for one task. error is None on success,
+# otherwise the exception's text.
+Done = collections.namedtuple('Done', ['task', 'error', 'seconds'])
+
+def area(spec, name):
+    '''Geography of a sector name: a box under "areas", or one in wxdata'''
+    if name in spec.get('areas', {}):
+        return wxdata.Geography(*spec['areas'][name])
+    return getattr(wxdata, name)
+
+def plan(spec):
+    '''Fetch and render tasks of a job spec
+
+    Jobs that share a model cycle share one fetch, and a product of a
+    sector asked for by several jobs is rendered once.
+    '''
+    fetches = collections.OrderedDict()
+    renders = collections.OrderedDict()
+    for job in spec['jobs']:
+        settings = dict(spec, **job)
+        date = settings['date']
+        server = settings.get('server', wxdata.SERVER)
+        storedir = settings.get('storedir', wxstore.STOREDIR)
+        directory = settings.get('directory', '.')
+        sectors = dict((name, area(spec, name)) for name in job['sectors'])
+        for select_model in job['models']:
+            for cycle in job['cycles']:
+                key = (select_model, date, cycle)
+                if key not in fetches:
+                    fetches[key] = FetchTask(select_model, date, cycle, server, storedir)
+                fetches[key].add(job['products'], sectors)
+                for sector in job['sectors']:
+                    if key + (sector, ) not in renders:
+                        renders[key + (sector, )] = RenderTask(
+                            fetches[key], sector, os.path.join(
+                                directory, select_model, date, cycle + 'z'))
+                    for product in job['products']:
+                        if product not in renders[key + (sector, )].products:
+                            renders[key + (sector, )].products.append(product)
+    return Plan(list(fetches.values()), list(renders.values()))
+
+def fetch(task):
+    '''Ingest the task's variables over the union of its sectors
+
+    A store that a previous run completed is kept as it is.
+    '''
+    path = task.path()
+    if wxstore.isstore(path):
+        return path
+    netcdf = wxdata.openfile(task.url)
+    try:
+        domain, _ = wxdata.uniondomain(netcdf, [sector.coords for _, sector
+                                                in sorted(task.sectors.items())])
+        wxstore.ingest(netcdf, path, task.varnames, domain)
+    finally:
+        wxdata.closefile(netcdf)
+    return path
+
+def render(task):
+    '''Render the task's products of its sector from the fetched store'''
+    netcdf = wxdata.openfile(task.fetch.path())
+    try:
+        sectors = {task.sector: task.fetch.sectors[task.sector]}
+        domain, frames = wxproducts.sectorframes(netcdf, task.fetch.select_model,
+                                                 task.products, sectors, task.directory)
+        wxproducts.renderproducts(netcdf, task.fetch.select_model, task.products,
+                                  domain, frames, workers=1)
+    finally:
+        wxdata.closefile(netcdf)
+
+def _runtask(task):
+    '''Run a task in a worker process and hand its trace records back'''
+    wxtrace.TRACE.reset()
+    start = time.perf_counter()
+    error = None
+    try:
+        if isinstance(task, FetchTask):
+            with wxtrace.TRACE.stage('fetch', model=task.select_model, cycle=task.cycle):
+                fetch(task)
+        else:
+            with wxtrace.TRACE.stage('render', model=task.fetch.select_model,
+                                     cycle=task.fetch.cycle, sector=task.sector):
+                render(task)
+    except Exception as exception:
+        error = '{}: {}'.format(type(exception).__name__, exception)
+    return Done(task, error, time.perf_counter() - start), list(wxtrace.TRACE.records)
+
+def run(tasks, workers=wxparallel.WORKERS, perhost=wxfetch.PERHOST):
+    '''Run a Plan and yield Done results as tasks finish
+
+    Renders start as soon as their fetch is done, ahead of fetches still
+    waiting. At most perhost fetches from one server run at once. The
+    renders of a failed fetch are yielded as failed without running.
+    '''
+    if workers < 1 or perhost < 1:
+        raise ValueError('workers and perhost must be at least 1')
+    pending = collections.deque(tasks.fetches)
+    waiting = collections.defaultdict(list)
+    for task in tasks.renders:
+        waiting[id(task.fetch)].append(task)
+    ready = collections.deque()
+    running = {}
+    hosts = collections.Counter()
+    workers = max(1, min(workers, len(tasks.fetches) + len(tasks.renders)))
+
+    with futures.ProcessPoolExecutor(workers, mp_context=wxparallel.CONTEXT) as pool:
+        while pending or ready or running:
+            while ready and len(running) < workers:
+                task = ready.popleft()
+                running[pool.submit(_runtask, task)] = task
+            for _ in range(len(pending)):
+                task = pending.popleft()
+                if len(running) < workers and hosts[task.host()] < perhost:
+                    running[pool.submit(_runtask, task)] = task
+                    hosts[task.host()] += 1
+                else:
+                    pending.append(task)
+            if not running:
+                raise RuntimeError('No task can start: {!r}'.format(list(pending)))
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                result, records = future.result()
+                wxtrace.TRACE.merge(records)
+                yield result
+                if isinstance(task, FetchTask):
+                    hosts[task.host()] -= 1
+                    for render_task in waiting.pop(id(task), []):
+                        if result.error:
+                            yield Done(render_task, 'fetch failed', 0.)
+                        else:
+                            ready.append(render_task)
+
+def main(argv=None):
+    '''Run the jobs of a job spec and report every task'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('spec', help='JSON job spec')
+    parser.add_argument('--workers', type=int, default=wxparallel.WORKERS)
+    parser.add_argument('--perhost', type=int, default=wxfetch.PERHOST)
+    parser.add_argument('--plan', action='store_true', help='print the tasks and exit')
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.perhost < 1:
+        parser.error('--workers and --perhost must be at least 1')
+
+    with open(args.spec) as handle:
+        tasks = plan(json.load(handle))
+    if args.plan:
+        for task in tasks.fetches + tasks.renders:
+            print(task)
+        return 0
+
+    failed = 0
+    for done in run(tasks, args.workers, args.perhost):
+        if done.error:
+            failed += 1
+            print('{!r} failed after {:.1f}s: {}'.format(done.task, done.seconds, done.error))
+        else:
+            print('{!r} done in {:.1f}s'.format(done.task, done.seconds))
+    print(wxtrace.TRACE.table())
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
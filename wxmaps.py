@@ -0,0 +1,152 @@
+'''CACHE THE STATIC LAYERS OF MAP FRAMES'''
+
+import copy
+import os
+import matplotlib.pyplot as plt
+import numpy as np
+import wxcache
+import wxtrace
+
+BACKGROUNDDIR = os.path.join(wxcache.CACHEDIR, 'backgrounds')
+PROJECTIONDIR = os.path.join(wxcache.CACHEDIR, 'projections')
+
+def projectionkey(basemap):
+    '''Identify a Basemap by projection, map extent and coastline resolution'''
+    corners = (basemap.llcrnrx, basemap.llcrnry, basemap.urcrnrx, basemap.urcrnry)
+    return (basemap.proj4string, tuple(round(corner, 1) for corner in corners),
+            basemap.resolution, basemap.area_thresh, )
+
+def codekey(code):
+    '''Identify compiled code by its bytecode, names and constants'''
+    return (code.co_code, code.co_names,
+            tuple(codekey(constant) if hasattr(constant, 'co_code') else constant
+                  for constant in code.co_consts))
+
+def stylekey(draw):
+    '''Identify how a layer is drawn, so restyling it renders it again'''
+    code = getattr(draw, '__code__', None)
+    return codekey(code) if code is not None else getattr(draw, '__qualname__', repr(draw))
+
+def gridkey(lats, lons):
+    '''Identify a model grid domain by its shape and corner coordinates'''
+    lats = np.ma.getdata(lats)
+    lons = np.ma.getdata(lons)
+    return (np.shape(lats), np.shape(lons),
+            tuple(np.round(lats.flat[[0, -1]], 4)), tuple(np.round(lons.flat[[0, -1]], 4)))
+
+_ARRAYS = {}
+
+def cachedarray(directory, key, compute):
+    '''Array from compute(), kept in memory and memory-mapped from a .npy file
+
+    Later runs map the file read-only instead of computing again, and
+    worker processes share the pages of one copy.
+    '''
+    if key not in _ARRAYS:
+        path = os.path.join(directory, key + '.npy')
+        if os.path.exists(path):
+            _ARRAYS[key] = np.load(path, mmap_mode='r')
+        else:
+            array = compute()
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            partial = '{}.{}.npy'.format(path[:-4], os.getpid())
+            np.save(partial, array)
+            os.replace(partial, path)
+            _ARRAYS[key] = array
+    return _ARRAYS[key]
+
+def projectgrid(basemap, lats, lons, directory=PROJECTIONDIR):
+    '''Map x, y of every point of a lat/lon domain, computed once per grid
+
+    lats and lons are the 1-D axes of a regular grid or the 2-D
+    coordinates of a curvilinear one.
+    '''
+    def project():
+        if np.ndim(lats) == 2:
+            return np.array(basemap(np.ma.getdata(lons), np.ma.getdata(lats)))
+        return np.array(basemap(*np.meshgrid(np.ma.getdata(lons), np.ma.getdata(lats))))
+    with wxtrace.TRACE.stage('projection'):
+        key = wxcache.cachekey('projection', gridkey(lats, lons), projectionkey(basemap))
+        x, y = cachedarray(directory, key, project)
+    return x, y
+
+def rasterize(basemap, draw, width):
+    '''Draw static features into a transparent RGBA image of the map extent'''
+    mapwidth = basemap.urcrnrx - basemap.llcrnrx
+    mapheight = basemap.urcrnry - basemap.llcrnry
+    height = int(round(width * mapheight / mapwidth))
+
+    figure = plt.figure(figsize=(width / 100., height / 100.), dpi=100)
+    axes = figure.add_axes([0, 0, 1, 1])
+    axes.set_axis_off()
+    figure.patch.set_alpha(0)
+
+    # Draw on a copy so the map boundary patch cached by Basemap never
+    # belongs to this throwaway figure
+    draw(copy.copy(basemap), axes)
+    axes.set_xlim(basemap.llcrnrx, basemap.urcrnrx)
+    axes.set_ylim(basemap.llcrnry, basemap.urcrnry)
+
+    figure.canvas.draw()
+    image = np.asarray(figure.canvas.buffer_rgba()).copy()
+    plt.close(figure)
+    return image
+
+class MapBackground(object):
+    '''Static map layers rendered once and composited under or over the data
+
+    layers is a list of (name, zorder, draw) tuples, where draw(basemap, ax)
+    draws the features of that layer. A layer is cached on disk by its
+    name and the code of its draw function, together with the projection,
+    extent and resolution. Features that belong above the weather data
+    and features below it go in separate layers.
+    '''
+
+    def __init__(self, basemap, layers, directory=BACKGROUNDDIR, width=2000):
+        self.basemap = basemap
+        self.layers = layers
+        self.directory = directory
+        self.width = width
+        self.images = {}
+
+    def path(self, name, draw):
+        '''Location of a cached layer image'''
+        key = wxcache.cachekey(name, stylekey(draw), projectionkey(self.basemap),
+                               self.width)
+        return os.path.join(self.directory, key + '.png')
+
+    def image(self, name, draw):
+        '''Load a layer from memory or disk, rendering it on first use'''
+        if name not in self.images:
+            path = self.path(name, draw)
+            if os.path.exists(path):
+                image = plt.imread(path)
+                self.images[name] = (image * 255).round().astype(np.uint8)
+            else:
+                with wxtrace.TRACE.stage('background', layer=name):
+                    self.images[name] = rasterize(self.basemap, draw, self.width)
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                partial = '{}.{}.png'.format(path, os.getpid())
+                plt.imsave(partial, self.images[name])
+                os.replace(partial, path)
+        return self.images[name]
+
+    def load(self):
+        '''Render or read every layer, e.g. before forking render workers'''
+        for name, _, draw in self.layers:
+            self.image(name, draw)
+        return self
+
+    def draw(self, ax=None):
+        '''Composite every layer onto the map axes'''
+        if ax is None:
+            ax = plt.gca()
+        extent = (self.basemap.llcrnrx, self.basemap.urcrnrx,
+                  self.basemap.llcrnry, self.basemap.urcrnry)
+        for name, zorder, draw in self.layers:
+            ax.imshow(self.image(name, draw), extent=extent, origin='upper',
+                      interpolation='none', zorder=zorder)
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
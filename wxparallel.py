@@ -0,0 +1,130 @@
+'''RENDER FORECAST FRAMES IN PARALLEL FROM SHARED MEMORY'''
+
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import wxtrace
+
+WORKERS = multiprocessing.cpu_count()
+
+# Forked workers inherit the render function and its arguments, e.g. a
+# Basemap and its projected grids, instead of unpickling copies. Scripts
+# still guard their work with __main__, as spawned workers import them.
+if 'fork' in multiprocessing.get_all_start_methods():
+    CONTEXT = multiprocessing.get_context('fork')
+else:
+    CONTEXT = multiprocessing.get_context('spawn')
+
+def unmask(array):
+    '''Fill masked points with NaN (floats) or 0 for plain shared storage'''
+    array = np.ma.asarray(array)
+    if np.issubdtype(array.dtype, np.floating):
+        return array.filled(np.nan)
+    return array.filled(0)
+
+def filebacked(array):
+    '''Whether an array is a view of a memory-mapped file, e.g. a wxstore chunk'''
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+class SharedFields(object):
+    '''Copy a dictionary of field arrays into named shared memory blocks'''
+
+    def __init__(self, fields):
+        self.blocks = {}
+        self.layout = {}
+        for name, array in fields.items():
+            array = unmask(array)
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.blocks[name] = block
+            self.layout[name] = (block.name, array.shape, array.dtype.str)
+
+    def release(self):
+        '''Free the shared memory blocks'''
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def attach(layout):
+    '''Map the blocks described by SharedFields.layout back into arrays'''
+    blocks = {}
+    fields = {}
+    for name, (block_name, shape, dtype) in layout.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        fields[name] = np.ndarray(shape, dtype, buffer=blocks[name].buf)
+    return blocks, fields
+
+_WORKER = {}
+
+def _initialize(render, layout, mapped, kwargs):
+    '''Attach each pool worker to the shared fields once'''
+    _WORKER['blocks'], _WORKER['fields'] = attach(layout)
+    _WORKER['fields'].update(mapped)
+    _WORKER['render'] = render
+    _WORKER['kwargs'] = kwargs
+
+def _renderframe(frame):
+    '''Render one frame and hand its trace records back to the parent'''
+    wxtrace.TRACE.reset()
+    with wxtrace.TRACE.stage('frame', frame):
+        result = _WORKER['render'](_WORKER['fields'], frame, **_WORKER['kwargs'])
+    return result, list(wxtrace.TRACE.records)
+
+def renderframes(render, fields, frames, workers=WORKERS, consume=None, **kwargs):
+    '''Call render(fields, frame, **kwargs) for every frame
+
+    With more than one worker the frames are fanned out to a process pool
+    that reads the fields from shared memory rather than pickled copies.
+    Unmasked fields mapped from files are inherited by forked workers
+    without being copied at all.
+    Results are returned in frame order. consume, e.g. the add method of a
+    wxanim.Animation, is called with each result in frame order as soon as
+    it is ready.
+    '''
+    frames = list(frames)
+    workers = min(workers, len(frames))
+    if workers <= 1:
+        fields = dict((name, unmask(array)) for name, array in fields.items())
+        results = []
+        for frame in frames:
+            with wxtrace.TRACE.stage('frame', frame):
+                results.append(render(fields, frame, **kwargs))
+            if consume is not None:
+                consume(results[-1])
+        return results
+
+    mapped = {}
+    if CONTEXT.get_start_method() == 'fork':
+        mapped = dict((name, array) for name, array in fields.items()
+                      if np.ma.getmask(array) is np.ma.nomask and filebacked(array))
+    copied = dict((name, array) for name, array in fields.items() if name not in mapped)
+
+    with SharedFields(copied) as shared:
+        pool = CONTEXT.Pool(workers, _initialize, (render, shared.layout,
+                                                    dict((name, np.ma.getdata(array))
+                                                         for name, array in mapped.items()),
+                                                    kwargs))
+        try:
+            results = []
+            for result, records in pool.imap(_renderframe, frames):
+                results.append(result)
+                wxtrace.TRACE.merge(records)
+                if consume is not None:
+                    consume(result)
+        finally:
+            pool.close()
+            pool.join()
+    return results
@@ -0,0 +1,216 @@
+'''EXTRACT POINT FORECASTS AT MANY STATIONS AT ONCE
+
+Usage: python wxpoints.py HRRR 20180211 02 stations.csv [--output points.csv]
+                          [--varnames tmp2m apcpsfc csnowsfc ugrd10m vgrd10m]
+                          (default: those of VARNAMES in the dataset)
+                          [--url file.nc]
+
+stations.csv has name, lat and lon columns. Every station is matched to
+its nearest grid point in one vectorized step, cached per model grid and
+station list, and each variable is read once per chunk of timesteps over
+the box around the stations and gathered with a single fancy index.
+'''
+
+import argparse
+import csv
+import hashlib
+import os
+import sys
+import numpy as np
+import wxaccum
+import wxcache
+import wxdata
+import wxmaps
+import wxtrace
+
+POINTDIR = os.path.join(wxcache.CACHEDIR, 'points')
+# Read by default, those of them that the dataset has
+VARNAMES = ['tmp2m', 'apcpsfc', 'csnowsfc', 'ugrd10m', 'vgrd10m', 'gustsfc']
+CHUNK = 6
+MPH = 2.237    # m/s to miles per hour
+INCHES = 1 / 25.4    # mm to inches
+SNOWRATIO = 10
+
+def readstations(path):
+    '''Names, lats and lons of the stations in a CSV file'''
+    with open(path) as handle:
+        rows = list(csv.DictReader(handle))
+    names = [row['name'] for row in rows]
+    lats = np.array([float(row['lat']) for row in rows])
+    lons = np.array([float(row['lon']) for row in rows])
+    return names, lats, lons
+
+def stationindex(lats, lons, latvalues, lonvalues):
+    '''[row, column] of the nearest grid point of every station, or -1
+
+    Stations off the grid, more than half a grid cell beyond its edge,
+    get -1 in both rows.
+    '''
+    lats = np.ma.getdata(lats)
+    lons = np.ma.getdata(lons)
+    latvalues = np.asarray(latvalues, dtype=float)
+    lonvalues = np.asarray(lonvalues, dtype=float)
+    if np.ndim(lats) == 2:
+        distance, flat = wxdata.gridindex(lats, lons).query(
+            wxdata.unitvectors(latvalues, lonvalues))
+        shape = np.shape(lats)
+        row, column = np.unravel_index(flat, shape)
+        # A station within the grid is at most half a cell diagonal from its
+        # nearest point; the cell is measured to the neighbouring points
+        points = wxdata.unitvectors(lats, lons)
+        nearest = points[row, column]
+        rowspacing = np.linalg.norm(
+            points[np.where(row < shape[0] - 1, row + 1, row - 1), column] - nearest, axis=-1)
+        columnspacing = np.linalg.norm(
+            points[row, np.where(column < shape[1] - 1, column + 1, column - 1)] - nearest,
+            axis=-1)
+        outside = distance > np.hypot(rowspacing, columnspacing) / 2
+    else:
+        lonvalues = wxdata.normalizelon(lons, lonvalues)
+        row = wxdata.getnearpos(lats, latvalues)
+        column = wxdata.getnearpos(lons, lonvalues)
+        latstep = abs(lats[-1] - lats[0]) / max(len(lats) - 1, 1) / 2
+        lonstep = abs(lons[-1] - lons[0]) / max(len(lons) - 1, 1) / 2
+        outside = ((latvalues < lats.min() - latstep) | (latvalues > lats.max() + latstep) |
+                   (lonvalues < lons.min() - lonstep) | (lonvalues > lons.max() + lonstep))
+
+    index = np.array([np.atleast_1d(row), np.atleast_1d(column)], dtype=np.int32)
+    index[:, np.atleast_1d(outside)] = -1
+    return index
+
+def pointindex(lats, lons, latvalues, lonvalues, directory=POINTDIR):
+    '''stationindex of a grid and station list, kept in memory and on disk'''
+    stations = hashlib.sha1(np.asarray(latvalues, dtype=float).tobytes() +
+                            np.asarray(lonvalues, dtype=float).tobytes()).hexdigest()
+    # 'distance' keeps indexes cached by the earlier edge test from being reused
+    key = wxcache.cachekey('points', 'distance', wxmaps.gridkey(lats, lons), stations)
+    return wxmaps.cachedarray(directory, key,
+                              lambda: stationindex(lats, lons, latvalues, lonvalues))
+
+class Points(object):
+    '''Stations matched to the grid of a dataset
+
+    domain is the smallest index box holding every station on the grid,
+    and rows/columns index the stations within fields read over it.
+    Stations off the grid are left out; inside marks the ones kept.
+    '''
+
+    def __init__(self, netcdf, names, lats, lons, directory=POINTDIR):
+        gridlats = netcdf.variables['lat'][:]
+        gridlons = netcdf.variables['lon'][:]
+        index = np.asarray(pointindex(gridlats, gridlons, lats, lons, directory))
+        self.inside = index[0] >= 0
+        self.names = [name for name, inside in zip(names, self.inside) if inside]
+        self.lats = np.asarray(lats)[self.inside]
+        self.lons = np.asarray(lons)[self.inside]
+        if not self.inside.any():
+            raise ValueError('No stations on the model grid')
+
+        rows, columns = index[:, self.inside]
+        self.domain = wxdata.indexdomain(gridlats, gridlons, rows.min(), rows.max() + 1,
+                                         columns.min(), columns.max() + 1)
+        self.rows = rows - rows.min()
+        self.columns = columns - columns.min()
+
+    def __len__(self):
+        return len(self.names)
+
+    def gather(self, field):
+        '''[time, station] series of a [time, lat, lon] field over domain'''
+        return field[:, self.rows, self.columns]
+
+def extract(netcdf, select_model, points, varnames, start=0, stop=None, chunk=CHUNK):
+    '''[time, station] float32 series of each variable at every station
+
+    Also derives qpf and snowfall (running totals in inches, snow at
+    SNOWRATIO from apcpsfc where csnowsfc is flagged) and wind10m (mph)
+    from the variables that are there.
+    '''
+    bucket = wxaccum.BUCKETS.get(select_model, wxaccum.DEFAULT_BUCKET)
+    accumulators = {'qpf': wxaccum.Accumulator(bucket),
+                    'snowfall': wxaccum.Accumulator(bucket)}
+    hours = wxdata.forecasthours(netcdf)
+
+    blocks = {}
+    for chunk_start, fields in wxdata.iterfields(netcdf, varnames, points.domain,
+                                                 start, stop, 1, chunk):
+        with wxtrace.TRACE.stage('gather', chunk_start, stations=len(points)):
+            series = dict((varname, points.gather(field))
+                          for varname, field in fields.items())
+        steps = len(series[varnames[0]])
+        chunkhours = hours[chunk_start:chunk_start + steps]
+        if 'apcpsfc' in series:
+            series['qpf'] = INCHES * accumulators['qpf'].update(series['apcpsfc'],
+                                                                chunkhours)
+        if 'apcpsfc' in series and 'csnowsfc' in series:
+            series['snowfall'] = SNOWRATIO * INCHES * accumulators['snowfall'].update(
+                series['apcpsfc'], chunkhours, series['csnowsfc'])
+        if 'ugrd10m' in series and 'vgrd10m' in series:
+            series['wind10m'] = MPH * np.ma.sqrt(series['ugrd10m'] ** 2 +
+                                                 series['vgrd10m'] ** 2)
+        for name, values in series.items():
+            values = np.ma.filled(np.ma.asarray(values, dtype=np.float32), np.nan)
+            blocks.setdefault(name, []).append(values)
+
+    return dict((name, np.concatenate(values)) for name, values in blocks.items())
+
+def writetable(path, netcdf, points, series, start=0):
+    '''Write series as a CSV table, one row per station and timestep
+
+    Rows run station by station; missing values are empty.
+    '''
+    names = sorted(series)
+    steps = len(series[names[0]])
+    validtimes = wxdata.timeaxis(netcdf).validtimes[start:start + steps]
+    hours = wxdata.forecasthours(netcdf)[start:start + steps]
+
+    # Format whole columns at once; the rows are only joined
+    columns = [np.repeat(points.names, steps),
+               np.repeat(np.char.mod('%.4f', points.lats), steps),
+               np.repeat(np.char.mod('%.4f', points.lons), steps),
+               np.tile(np.datetime_as_string(validtimes, unit='m'), len(points)),
+               np.tile(np.char.mod('%g', hours), len(points))]
+    for name in names:
+        values = series[name].T.ravel()
+        column = np.char.mod('%.6g', values)
+        column[np.isnan(values)] = ''
+        columns.append(column)
+
+    with open(path + '.part', 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['name', 'lat', 'lon', 'validtime', 'hour'] + names)
+        writer.writerows(zip(*columns))
+    os.replace(path + '.part', path)
+    return path
+
+def main(argv=None):
+    '''Extract point forecasts of one model cycle at a list of stations'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('model')
+    parser.add_argument('date')
+    parser.add_argument('cycle')
+    parser.add_argument('stations', help='CSV file with name, lat and lon columns')
+    parser.add_argument('--varnames', nargs='+')
+    parser.add_argument('--output', default='points.csv')
+    parser.add_argument('--url', help='dataset to read instead of NOMADS')
+    parser.add_argument('--chunk', type=int, default=CHUNK)
+    args = parser.parse_args(argv)
+
+    netcdf = wxdata.openfile(args.url or wxdata.model(args.model, args.date, args.cycle))
+    varnames = args.varnames
+    if varnames is None:
+        varnames = [varname for varname in VARNAMES if varname in netcdf.variables]
+    missing = [varname for varname in varnames if varname not in netcdf.variables]
+    if missing:
+        parser.error('The dataset has no ' + ', '.join(missing))
+    names, lats, lons = readstations(args.stations)
+    points = Points(netcdf, names, lats, lons)
+    series = extract(netcdf, args.model, points, varnames, chunk=args.chunk)
+    writetable(args.output, netcdf, points, series)
+    wxdata.closefile(netcdf)
+    print('Wrote', len(points), 'of', len(names), 'stations to', args.output)
+    print(wxtrace.TRACE.table())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
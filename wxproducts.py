@@ -0,0 +1,267 @@
+'''RENDER SEVERAL MAP PRODUCTS FROM ONE PASS OVER THE MODEL DATA
+
+Usage: python wxproducts.py HRRR 20180211 02 [--products reflectivity windgusts]
+                            [--sectors WISCONSIN MIDWEST] [--url file.nc]
+                            [--workers 4]
+
+Each variable that any of the products needs is read once per chunk of
+timesteps, over the union of the sectors, and every product of every
+sector is rendered for those timesteps before the next chunk is read.
+'''
+
+import argparse
+import os
+import sys
+from mpl_toolkits.basemap import Basemap
+import matplotlib.pyplot as plt
+import numpy as np
+import wxaccum
+import wxdata
+import wxmaps
+import wxparallel
+import wxtrace
+
+MPH = 2.237    # m/s to miles per hour
+INCHES = 1 / 25.4    # mm to inches
+SNOWRATIO = 10
+CHUNK = 6
+
+class Product(object):
+    '''A map product: the variables it reads, how it derives its values
+    from them, and its contour levels, colours and legend label
+
+    Products that accumulate total apcpsfc over the forecast (only where
+    ptype is flagged, if given) and scale the totals. Others apply derive
+    to the fields of a chunk, or scale their single variable.
+    '''
+
+    def __init__(self, name, title, varnames, clevs, colors, label, scale=1.,
+                 derive=None, accumulate=False, ptype=None):
+        self.name = name
+        self.title = title
+        self.varnames = list(varnames)
+        self.clevs = clevs
+        self.colors = colors
+        self.label = label
+        self.scale = scale
+        self.derive = derive
+        self.accumulate = accumulate
+        self.ptype = ptype
+
+    def values(self, fields, hours, accumulator=None):
+        '''Values of the product at each timestep of a chunk of fields'''
+        if self.accumulate:
+            return self.scale * accumulator.update(fields['apcpsfc'], hours,
+                                                   fields.get(self.ptype))
+        if self.derive is not None:
+            return self.derive(fields)
+        return self.scale * fields[self.varnames[0]]
+
+def windspeed(fields):
+    '''10 m wind speed in miles per hour'''
+    return MPH * np.ma.sqrt(fields['ugrd10m'] ** 2 + fields['vgrd10m'] ** 2)
+
+WINDCLEVS = [20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75]
+WINDCONTOURS = ('#f1eef6', '#bdc9e1', '#74a9cf', '#0570b0', '#ffffd4', '#fed98e',
+                '#fe9929', '#cc4c02', '#f1eef6', '#d7b5d8', '#df65b0', '#ce1256', )
+
+# The Maps presets of modelsconfig, plus 10 m wind speed
+PRODUCTS = {
+    'reflectivity': Product(
+        'reflectivity', 'Forecast Radar', ['refd1000m'], np.arange(5, 80, 5),
+        ('#29EDEC', '#1BA3F2', '#0A22E7', '#29FD2F', '#1EC522', '#128E15',
+         '#FFFD38', '#E7BE2A', '#FD8F25', '#FC0D1B', '#CA3415', '#97040C',
+         '#FC28FC', '#983BC9', '#FFFFFF', ), 'Reflectivity (dBZ)'),
+    'rainaccumulation': Product(
+        'rainaccumulation', 'Rainfall Total', ['apcpsfc'],
+        [0.01, 0.05, 0.10, 0.25, 0.50, 0.75, 1.00, 2.00, 5.00],
+        ('#edf8fb', '#b2e2e2', '#66c2a4', '#238b45', '#fef0d9', '#fdcc8a',
+         '#fc8d59', '#e34a33', '#b30000', ), 'inches', scale=INCHES, accumulate=True),
+    'windgusts': Product(
+        'windgusts', 'Wind Gusts', ['gustsfc'], WINDCLEVS, WINDCONTOURS,
+        'miles per hour', scale=MPH),
+    'windspeed': Product(
+        'windspeed', 'Wind Speed', ['ugrd10m', 'vgrd10m'], WINDCLEVS, WINDCONTOURS,
+        'miles per hour', derive=windspeed),
+    'snowaccumulation': Product(
+        'snowaccumulation', 'Snowfall Total', ['apcpsfc', 'csnowsfc'],
+        [0.1, 0.5, 1.0, 3.0, 6.0, 9.0, 12.00, 18.00, 24.00],
+        ('#f1eef6', '#bdc9e1', '#74a9cf', '#0570b0', '#feebe2', '#fbb4b9',
+         '#f768a1', '#c51b8a', '#7a0177', ), 'inches', scale=SNOWRATIO * INCHES,
+        accumulate=True, ptype='csnowsfc'),
+}
+
+def sectormap(area):
+    '''Lambert conformal Basemap of a Geography, as the map scripts set it up'''
+    mapwidth, mapheight = area.mapdimensions()
+    centerpt_lat, centerpt_lon = area.centerpoint()
+    with wxtrace.TRACE.stage('basemap'):
+        return Basemap(width=mapwidth, height=mapheight,
+                       rsphere=(6378137.00, 6356752.3142),
+                       resolution='l', area_thresh=1000., projection='lcc',
+                       lat_1=area.llat, lat_2=area.ulat,
+                       lat_0=centerpt_lat, lon_0=centerpt_lon)
+
+class ProductFrame(object):
+    '''Draws and saves one product at one timestep, in the models.ipynb style
+
+    Called by wxparallel.renderframes with frames of (timestep, product
+    name). Images go to directory/<product>/<product><timestep>.png.
+    view, e.g. from wxdata.subdomain, cuts the map's box out of fields
+    read over a larger domain.
+    '''
+
+    def __init__(self, products, basemap, x, y, validtimes, select_model,
+                 background=None, directory='.', dpi=300, view=Ellipsis):
+        self.products = dict((product.name, product) for product in products)
+        self.basemap = basemap
+        self.x = x
+        self.y = y
+        self.validtimes = validtimes
+        self.select_model = select_model
+        self.background = background
+        self.directory = directory
+        self.dpi = dpi
+        self.view = view
+
+    def frames(self, steps, products):
+        '''Frames of every product at each of steps'''
+        return [(step, product.name) for step in steps for product in products]
+
+    def __call__(self, fields, frame, start=0):
+        step, name = frame
+        product = self.products[name]
+        plt.figure()
+        with wxtrace.TRACE.stage('contourf', step, product=name):
+            self.basemap.contourf(self.x, self.y, fields[name][step - start][self.view],
+                                  product.clevs, colors=product.colors, zorder=4,
+                                  alpha=.8, extend='max')
+        cbar = self.basemap.colorbar(location='right')
+        cbar.ax.set_ylabel(product.label)
+        cbar.ax.tick_params(labelsize=10)
+        if self.background is not None:
+            self.background.draw()
+
+        plt.title('{}\n'.format(product.title), fontsize=14, fontweight='bold')
+        plt.title('\nValid: {}'.format(self.validtimes[step]), fontsize=8, loc='left')
+        plt.title('\nModel: NCEP {}'.format(self.select_model.upper()), fontsize=8,
+                  loc='right')
+        path = os.path.join(self.directory, name, '{}{:02d}.png'.format(name, step))
+        with wxtrace.TRACE.stage('savefig', step, product=name):
+            plt.savefig(path, dpi=self.dpi, bbox_inches='tight')
+        plt.close()
+        return path
+
+class SectorFrames(object):
+    '''Renders of several sectors, by name, from fields over their union
+
+    Frames are (timestep, product name, sector name).
+    '''
+
+    def __init__(self, renders):
+        self.renders = renders
+
+    def frames(self, steps, products):
+        '''Frames of every product of every sector at each of steps'''
+        return [(step, product.name, sector) for step in steps
+                for sector in sorted(self.renders) for product in products]
+
+    def __call__(self, fields, frame, start=0):
+        step, name, sector = frame
+        return self.renders[sector](fields, (step, name), start)
+
+def renderproducts(netcdf, select_model, products, domain, render, start=0,
+                   stop=None, chunk=CHUNK, workers=1):
+    '''Render every product at every timestep from one read of each variable
+
+    products are Product instances or names in PRODUCTS. render is a
+    ProductFrame or SectorFrames, called with each of its frames and
+    start=chunk start. Returns the results of render in timestep order.
+    '''
+    products = [PRODUCTS[product] if isinstance(product, str) else product
+                for product in products]
+    varnames = []
+    for product in products:
+        for varname in product.varnames + [product.ptype]:
+            if varname is not None and varname not in varnames:
+                varnames.append(varname)
+
+    bucket = wxaccum.BUCKETS.get(select_model, wxaccum.DEFAULT_BUCKET)
+    accumulators = dict((product.name, wxaccum.Accumulator(bucket))
+                        for product in products if product.accumulate)
+    hours = wxdata.forecasthours(netcdf)
+
+    results = []
+    for chunk_start, fields in wxdata.iterfields(netcdf, varnames, domain,
+                                                 start, stop, 1, chunk):
+        steps = len(fields[varnames[0]])
+        values = {}
+        for product in products:
+            values[product.name] = product.values(
+                fields, hours[chunk_start:chunk_start + steps],
+                accumulators.get(product.name))
+        frames = render.frames(range(chunk_start, chunk_start + steps), products)
+        results.extend(wxparallel.renderframes(render, values, frames, workers,
+                                               start=chunk_start))
+    return results
+
+def sectorframes(netcdf, select_model, products, sectors, directory='.'):
+    '''Union domain of sectors and a SectorFrames drawing each of them
+
+    sectors maps names to Geography boxes. Each sector's map, projected
+    grid and background are set up once, and its images go to
+    directory/<sector>/<product>/.
+    '''
+    products = [PRODUCTS[product] if isinstance(product, str) else product
+                for product in products]
+    names = sorted(sectors)
+    union, domains = wxdata.uniondomain(netcdf, [sectors[name].coords for name in names])
+    validtimes = wxdata.timeaxis(netcdf).labels()
+
+    def drawlines(basemap, ax):
+        basemap.drawcoastlines(linewidth=0.75, zorder=5, ax=ax)
+        basemap.drawstates(linewidth=0.75, zorder=6, ax=ax)
+        basemap.drawcountries(linewidth=1.0, zorder=7, ax=ax)
+
+    renders = {}
+    for name, domain in zip(names, domains):
+        basemap = sectormap(sectors[name])
+        x, y = wxmaps.projectgrid(basemap, domain[0], domain[1])
+        background = wxmaps.MapBackground(basemap, [('coasts-states-countries', 5,
+                                                     drawlines)]).load()
+        sectordir = os.path.join(directory, name.lower())
+        for product in products:
+            if not os.path.exists(os.path.join(sectordir, product.name)):
+                os.makedirs(os.path.join(sectordir, product.name))
+        renders[name] = ProductFrame(products, basemap, x, y, validtimes, select_model,
+                                     background, sectordir,
+                                     view=wxdata.subdomain(union, domain))
+    return union, SectorFrames(renders)
+
+def main(argv=None):
+    '''Render the chosen products of one model cycle over the chosen sectors'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('model')
+    parser.add_argument('date')
+    parser.add_argument('cycle')
+    parser.add_argument('--products', nargs='+', default=sorted(PRODUCTS),
+                        choices=sorted(PRODUCTS))
+    parser.add_argument('--sectors', nargs='+', default=['WISCONSIN'],
+                        help='Geography names in wxdata')
+    parser.add_argument('--url', help='dataset to read instead of NOMADS')
+    parser.add_argument('--directory', default='.')
+    parser.add_argument('--workers', type=int, default=wxparallel.WORKERS)
+    args = parser.parse_args(argv)
+
+    netcdf = wxdata.openfile(args.url or wxdata.model(args.model, args.date, args.cycle))
+    sectors = dict((name, getattr(wxdata, name)) for name in args.sectors)
+    domain, render = sectorframes(netcdf, args.model, args.products, sectors,
+                                  args.directory)
+    renderproducts(netcdf, args.model, args.products, domain, render,
+                   workers=args.workers)
+    wxdata.closefile(netcdf)
+    print(wxtrace.TRACE.table())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+'''COMBINE CATEGORICAL PRECIPITATION TYPES INTO ONE CLASS GRID'''
+
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+from matplotlib.colors import BoundaryNorm, ListedColormap
+import numpy as np
+
+# Categorical fields in increasing priority. Where several types are
+# flagged at a point, the later one wins: freezing rain over sleet over
+# snow over rain, as the four overlapping contourf layers used to draw.
+# The class of a type is its position here plus one; 0 is no precipitation.
+PTYPES = ['crainsfc', 'csnowsfc', 'cicepsfc', 'cfrzrsfc']
+NAMES = ['None', 'Rain', 'Snow', 'Sleet', 'Frz Rain']
+COLORS = [None, '#00b300', '#8080ff', '#ffcc80', '#ff80bf']
+# Flags at or above this count; NARRE ensemble means are member fractions
+THRESHOLD = 0.25
+
+CMAP = ListedColormap(COLORS[1:])
+NORM = BoundaryNorm(np.arange(len(NAMES)) + 0.5, CMAP.N)
+
+def classify(fields, threshold=THRESHOLD):
+    '''uint8 class grid of every timestep from the four categorical fields'''
+    classes = np.zeros(np.shape(fields[PTYPES[0]]), dtype=np.uint8)
+    for ptype, name in enumerate(PTYPES, 1):
+        classes[np.ma.filled(fields[name], 0) >= threshold] = ptype
+    return classes
+
+def draw(basemap, x, y, classes, zorder=4, ax=None):
+    '''Draw one class grid in a single raster pass'''
+    return basemap.pcolormesh(x, y, np.ma.masked_equal(classes, 0), cmap=CMAP,
+                              norm=NORM, shading='nearest', zorder=zorder,
+                              rasterized=True, ax=ax)
+
+def legend(ax=None):
+    '''Legend of the precipitation types, in the order the maps have used'''
+    if ax is None:
+        ax = plt.gca()
+    handles = [mpatches.Patch(color=COLORS[ptype], label=NAMES[ptype])
+               for ptype in (2, 3, 4, 1)]
+    return ax.legend(handles=handles)
+
+def archive(path, classes, **meta):
+    '''Save class grids compactly, with e.g. valid times or lat/lon'''
+    np.savez_compressed(path, classes=classes, **meta)
@@ -0,0 +1,161 @@
+'''RENDER FIELDS STRAIGHT TO RGBA IMAGES OF THE MAP PROJECTION
+
+Each output pixel of the map is looked up once in the model grid, so a
+frame is a NumPy gather and a colour table lookup instead of contouring
+and saving a matplotlib figure.
+'''
+
+import os
+import numpy as np
+from matplotlib.colors import to_rgba
+from PIL import Image
+import wxcache
+import wxdata
+import wxmaps
+
+WARPDIR = os.path.join(wxcache.CACHEDIR, 'warps')
+TRANSPARENT = (0, 0, 0, 0)
+
+def warpindex(basemap, lats, lons, width):
+    '''Flat index into the lat/lon domain of every pixel of the map, or -1
+
+    Pixels are looked up at their centres with the nearest grid point.
+    Rows run from the top of the map down. Pixels beyond the domain are -1.
+    '''
+    mapwidth = basemap.urcrnrx - basemap.llcrnrx
+    mapheight = basemap.urcrnry - basemap.llcrnry
+    height = int(round(width * mapheight / mapwidth))
+    columns = basemap.llcrnrx + (np.arange(width) + 0.5) * mapwidth / width
+    rows = basemap.urcrnry - (np.arange(height) + 0.5) * mapheight / height
+    pixlons, pixlats = basemap(*np.meshgrid(columns, rows), inverse=True)
+
+    lats = np.ma.getdata(lats)
+    lons = np.ma.getdata(lons)
+    if np.ndim(lats) == 2:
+        row, column = wxdata.gridnearpos(lats, lons, pixlats, pixlons)
+        shape = np.shape(lats)
+        # Pixels whose nearest point is on the edge of the domain lie beyond it
+        outside = ((row == 0) | (row == shape[0] - 1) |
+                   (column == 0) | (column == shape[1] - 1))
+    else:
+        pixlons = wxdata.normalizelon(lons, pixlons)
+        row = wxdata.getnearpos(lats, pixlats)
+        column = wxdata.getnearpos(lons, pixlons)
+        shape = (len(lats), len(lons))
+        latstep = abs(lats[-1] - lats[0]) / max(len(lats) - 1, 1) / 2
+        lonstep = abs(lons[-1] - lons[0]) / max(len(lons) - 1, 1) / 2
+        outside = ((pixlats < lats.min() - latstep) | (pixlats > lats.max() + latstep) |
+                   (pixlons < lons.min() - lonstep) | (pixlons > lons.max() + lonstep))
+
+    index = np.ravel_multi_index((row, column), shape).astype(np.int32)
+    index[outside] = -1
+    return index
+
+def warp(basemap, lats, lons, width, directory=WARPDIR):
+    '''warpindex of a grid, map and size, kept in memory and on disk'''
+    key = wxcache.cachekey(wxmaps.gridkey(lats, lons), wxmaps.projectionkey(basemap),
+                           width)
+    return wxmaps.cachedarray(directory, key,
+                              lambda: warpindex(basemap, lats, lons, width))
+
+class ColorTable(object):
+    '''RGBA lookup table of filled contour levels, as contourf colours them
+
+    Values from clevs[k] up to clevs[k + 1] get colors[k]. Values below
+    clevs[0] are transparent, and so are values above clevs[-1] unless
+    extend is 'max' or 'both'.
+    '''
+
+    def __init__(self, clevs, colors, extend='neither'):
+        self.clevs = np.asarray(clevs, dtype=float)
+        table = [TRANSPARENT]
+        for level in range(1, len(self.clevs)):
+            table.append(to_rgba(colors[level - 1]))
+        if extend in ('max', 'both') and len(colors) >= len(self.clevs):
+            table.append(to_rgba(colors[len(self.clevs) - 1]))
+        else:
+            table.append(TRANSPARENT)
+        self.table = (np.array(table) * 255).round().astype(np.uint8)
+
+    def __call__(self, values):
+        '''RGBA colours of an array of values; missing values are transparent'''
+        levels = np.searchsorted(self.clevs, values, side='right')
+        # NaN sorts above every level
+        levels[np.isnan(values)] = 0
+        return self.table[levels]
+
+class Raster(object):
+    '''Colour-mapped images of fields on a lat/lon domain, drawn on a Basemap
+
+    The pixel lookup is computed once per grid, map and width and reused
+    for every frame.
+    '''
+
+    def __init__(self, basemap, lats, lons, width=1024, directory=WARPDIR):
+        self.index = np.asarray(warp(basemap, lats, lons, width, directory))
+
+    def render(self, field, colortable):
+        '''RGBA uint8 image of a 2-D field'''
+        # Colour the model grid, then gather whole RGBA pixels as uint32.
+        # Pixels off the domain have index -1, which picks the transparent
+        # colour appended.
+        colours = colortable(np.ma.filled(np.ma.asarray(field, dtype=float), np.nan))
+        colours = np.append(colours.reshape(-1, 4), [TRANSPARENT], axis=0)
+        pixels = colours.astype(np.uint8).view(np.uint32).ravel()[self.index]
+        return pixels.view(np.uint8).reshape(self.index.shape + (4, ))
+
+def over(base, image):
+    '''Alpha-composite an RGBA uint8 image over another of the same size
+
+    Only partly transparent pixels are blended; opaque ones are copied and
+    transparent ones skipped, so sparse or solid layers cost little.
+    '''
+    alpha = image[..., 3]
+    result = np.where(alpha == 255, image.view(np.uint32)[..., 0],
+                      base.view(np.uint32)[..., 0])
+    result = result[..., np.newaxis].view(np.uint8)
+    partial = (alpha > 0) & (alpha < 255)
+    if partial.any():
+        top = image[partial].astype(np.float32) / 255
+        bottom = base[partial].astype(np.float32) / 255
+        below = bottom[:, 3:] * (1 - top[:, 3:])
+        total = top[:, 3:] + below
+        blended = np.empty_like(top)
+        blended[:, :3] = (top[:, :3] * top[:, 3:] + bottom[:, :3] * below) / total
+        blended[:, 3:] = total
+        result[partial] = (blended * 255).round().astype(np.uint8)
+    return result
+
+def composite(*images):
+    '''Stack RGBA uint8 images of one size, the first at the bottom'''
+    result = images[0]
+    for image in images[1:]:
+        result = over(result, image)
+    return result
+
+def save(path, image):
+    '''Write an RGBA image as PNG'''
+    Image.fromarray(image, 'RGBA').save(path)
+
+_STACKS = {}
+
+def onbackground(background, image, zorder=4):
+    '''Composite an image between the layers of a wxmaps.MapBackground
+
+    The layers below and above zorder are stacked once and kept. The
+    background must have been rendered at the width of the image.
+    '''
+    key = (id(background), zorder)
+    if key not in _STACKS:
+        layers = [(layerz, background.image(name, draw))
+                  for name, layerz, draw in background.layers]
+        below = [layer for layerz, layer in layers if layerz < zorder]
+        above = [layer for layerz, layer in layers if layerz >= zorder]
+        _STACKS[key] = (composite(*below) if below else None,
+                        composite(*above) if above else None)
+    below, above = _STACKS[key]
+    if below is not None:
+        image = over(below, image)
+    if above is not None:
+        image = over(image, above)
+    return image
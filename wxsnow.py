@@ -0,0 +1,98 @@
+'''SNOWFALL WITH SNOW-TO-LIQUID RATIOS FROM THE TEMPERATURE COLUMN
+
+The Kuchera method sets the ratio from the warmest temperature between
+the surface and 500 hPa: 12 plus the degrees below 271.16 K, or 12
+minus twice the degrees above it. Pressure-level temperatures are read in
+[time, lev, lat, lon] chunks that fit a memory budget, and the ratios
+of a whole chunk are computed in one vectorized pass.
+'''
+
+import numpy as np
+import wxaccum
+import wxdata
+import wxtrace
+
+KUCHERA = 271.16    # K
+TOP = 500.    # hPa; the column runs from the surface up to here
+DEFAULT = 10.    # ratio where a column has no temperatures
+
+def kuchera(tmax):
+    '''Kuchera snow-to-liquid ratios of column maximum temperatures (K)'''
+    ratio = np.subtract(KUCHERA, tmax, dtype=np.float32)
+    # Warm columns lose ratio twice as fast as cold ones gain it
+    ratio[ratio < 0] *= 2
+    ratio += 12
+    np.maximum(ratio, 0, out=ratio)
+    ratio[np.isnan(ratio)] = DEFAULT
+    return ratio
+
+def columnlevels(netcdf, top=TOP):
+    '''Slice of the pressure levels from the bottom of the column to top'''
+    levels = np.flatnonzero(np.ma.getdata(netcdf.variables['lev'][:]) >= top)
+    if not len(levels):
+        raise ValueError('No pressure levels at or below {:g} hPa'.format(top))
+    return slice(levels.min(), levels.max() + 1)
+
+def columnmax(netcdf, domain, start, stop, levels):
+    '''[time, lat, lon] warmest tmpprs of each column, in K
+
+    With surface pressure (pressfc) in the dataset, levels below the
+    ground are left out. Columns without temperatures are NaN.
+    '''
+    columns = wxdata.hyperslab(netcdf.variables['tmpprs'], domain, start, stop,
+                               compact=True, levels=levels)
+    if 'pressfc' in netcdf.variables:
+        surface = wxdata.hyperslab(netcdf.variables['pressfc'], domain, start, stop,
+                                   compact=True)
+        pressures = 100 * np.ma.getdata(netcdf.variables['lev'][levels])
+        if not columns.flags.writeable:
+            columns = columns.copy()
+        columns[pressures[np.newaxis, :, np.newaxis, np.newaxis] >
+                surface[:, np.newaxis]] = np.nan
+    # fmax skips NaN, so a column is NaN only when all of it is
+    return np.fmax.reduce(columns, axis=1)
+
+def chunksize(netcdf, domain, levels, budget=wxdata.MEMORY):
+    '''Timesteps per chunk that keep the columns and surface fields in budget'''
+    points = (domain[3] - domain[2]) * (domain[5] - domain[4])
+    count = len(range(*levels.indices(len(netcdf.variables['lev']))))
+    # float32 columns and their below-ground mask, then apcpsfc, pressfc,
+    # the column maximum and the ratio in float32 and csnowsfc in uint8
+    perstep = points * (5 * count + 4 * 4 + 1)
+    return max(int(budget // perstep), 1)
+
+def snowfall(netcdf, select_model, domain, start=0, stop=None, chunk=None,
+             budget=wxdata.MEMORY, top=TOP, bucket=None):
+    '''Running snowfall totals (mm of snow) with Kuchera ratios
+
+    Each step's liquid increment where csnowsfc is flagged is multiplied
+    by the ratio at the end of the step. Only one chunk of temperature
+    columns is held at a time. Raises ValueError for datasets without
+    tmpprs on pressure levels, e.g. hrrr_sfc.
+    '''
+    if 'tmpprs' not in netcdf.variables or 'lev' not in netcdf.variables:
+        raise ValueError('Kuchera ratios need tmpprs on pressure levels, which the '
+                         '{} dataset does not have'.format(select_model))
+    if bucket is None:
+        bucket = wxaccum.BUCKETS.get(select_model, wxaccum.DEFAULT_BUCKET)
+    if stop is None:
+        stop = len(netcdf.variables['time'])
+    levels = columnlevels(netcdf, top)
+    if chunk is None:
+        chunk = chunksize(netcdf, domain, levels, budget)
+    accumulator = wxaccum.Accumulator(bucket)
+    hours = wxdata.forecasthours(netcdf)
+
+    totals = np.empty((len(range(start, stop)), domain[3] - domain[2],
+                       domain[5] - domain[4]), dtype=np.float32)
+    for chunk_start in range(start, stop, chunk):
+        chunk_stop = min(chunk_start + chunk, stop)
+        with wxtrace.TRACE.stage('kuchera', chunk_start):
+            ratio = kuchera(columnmax(netcdf, domain, chunk_start, chunk_stop, levels))
+        fields = dict((varname, wxdata.hyperslab(netcdf.variables[varname], domain,
+                                                 chunk_start, chunk_stop, compact=True))
+                      for varname in ('apcpsfc', 'csnowsfc'))
+        accumulator.update(fields['apcpsfc'], hours[chunk_start:chunk_stop],
+                           fields['csnowsfc'], scale=ratio,
+                           out=totals[chunk_start - start:chunk_stop - start])
+    return totals
@@ -0,0 +1,231 @@
+'''STORE FETCHED MODEL FIELDS LOCALLY AS MEMORY-MAPPED ARRAYS
+
+Usage: python wxstore.py HRRR 20180211 02 [--area MIDWEST]
+                         [--varnames apcpsfc csnowsfc] [--url file.nc]
+
+A store holds one model cycle over one geodomain box: a .npy file per
+variable and chunk of timesteps, plus the lat/lon and time axes and a
+meta.json. wxdata.openfile opens a store directory like a dataset, and
+reads inside one chunk are views of the memory-mapped file.
+'''
+
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import wxcache
+import wxdata
+
+STOREDIR = os.path.join(wxcache.CACHEDIR, 'store')
+CHUNK = 24
+
+def storepath(select_model, date, cycle, directory=STOREDIR):
+    '''Directory of the store of one model cycle'''
+    return os.path.join(directory, select_model, date, cycle + 'z')
+
+def attributes(variable):
+    '''Attributes of a dataset variable as JSON-friendly values'''
+    return dict((attribute, np.asarray(getattr(variable, attribute)).tolist())
+                for attribute in variable.ncattrs())
+
+def ingest(netcdf, path, varnames, domain, start=0, stop=None, chunk=CHUNK):
+    '''Copy variables over a geodomain box from a dataset into a store
+
+    Fields are stored as float32 [time, lat, lon] arrays, in files of
+    chunk timesteps, with missing values as NaN. NARRE's ensemble
+    dimension is dropped. meta.json is written last, so a store is only
+    visible to readers once it is complete.
+    '''
+    if stop is None:
+        stop = len(netcdf.variables['time'])
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    meta = {'domain': [int(index) for index in domain[2:6]], 'variables': {}}
+    if np.ndim(domain[0]) == 1:
+        # Also keep the row and column that the half-open slices of
+        # geodomain leave out, so geodomain on the store finds the same box
+        llat_idx, ulat_idx, llon_idx, rlon_idx = domain[2:6]
+        lats = netcdf.variables['lat'][llat_idx:ulat_idx + 1]
+        lons = netcdf.variables['lon'][llon_idx:rlon_idx + 1]
+        domain = (lats, lons, llat_idx, llat_idx + len(lats),
+                  llon_idx, llon_idx + len(lons))
+
+    time = netcdf.variables['time']
+    axes = {'time': (np.ma.getdata(time[start:stop]), ('time', ), attributes(time)),
+            'lat': (np.ma.getdata(domain[0]), ('lat', 'lon')[:np.ndim(domain[0])],
+                    attributes(netcdf.variables['lat'])),
+            'lon': (np.ma.getdata(domain[1]), ('lat', 'lon')[-np.ndim(domain[1]):],
+                    attributes(netcdf.variables['lon']))}
+    for name, (values, dimensions, attrs) in axes.items():
+        np.save(os.path.join(path, name + '.0.npy'), values)
+        meta['variables'][name] = {'dimensions': list(dimensions),
+                                   'shape': list(np.shape(values)),
+                                   'attributes': attrs,
+                                   'chunks': [[0, int(np.shape(values)[0]), False]]}
+
+    for varname in varnames:
+        meta['variables'][varname] = {'dimensions': ['time', 'lat', 'lon'],
+                                      'attributes': attributes(netcdf.variables[varname]),
+                                      'chunks': []}
+    for chunk_start, fields in wxdata.iterfields(netcdf, varnames, domain,
+                                                 start, stop, 1, chunk):
+        for varname, field in fields.items():
+            data = np.ma.filled(np.ma.asarray(field, dtype=np.float32), np.nan)
+            offset = chunk_start - start
+            np.save(os.path.join(path, '{}.{}.npy'.format(varname, offset)), data)
+            meta['variables'][varname]['chunks'].append(
+                [offset, offset + len(data), bool(np.isnan(data).any())])
+            meta['variables'][varname]['shape'] = [offset + len(data)] + list(data.shape[1:])
+
+    with open(os.path.join(path, 'meta.json.part'), 'w') as handle:
+        json.dump(meta, handle)
+    os.replace(os.path.join(path, 'meta.json.part'), os.path.join(path, 'meta.json'))
+    return path
+
+def isstore(path):
+    '''Whether path is a complete store'''
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+def covers(path, coords, varnames):
+    '''Whether the store at path holds varnames over a lat/lon box
+
+    Box edges up to one grid step outside the store's lat/lon axes still
+    count as covered, as geodomain picks the nearest grid points.
+    '''
+    if not isstore(path):
+        return False
+    store = FieldStore(path)
+    try:
+        if any(varname not in store.variables for varname in varnames):
+            return False
+        lats = np.asarray(store.variables['lat'][:])
+        lons = np.asarray(store.variables['lon'][:])
+    finally:
+        store.close()
+
+    llat, ulat, llon, rlon = coords[:4]
+    llon, rlon = wxdata.normalizelon(lons, [llon, rlon])
+    step = max(np.abs(np.diff(axis, axis=dimension)).max()
+               for axis in (lats, lons) for dimension in range(np.ndim(axis))
+               if np.shape(axis)[dimension] > 1)
+    return bool(lats.min() - step <= llat and ulat <= lats.max() + step and
+                lons.min() - step <= llon and rlon <= lons.max() + step)
+
+class StoreVariable(object):
+    '''Variable of a FieldStore, read from memory-mapped chunk files'''
+
+    def __init__(self, store, name, meta):
+        self.store = store
+        self.name = name
+        self.dimensions = tuple(meta['dimensions'])
+        self.shape = tuple(meta['shape'])
+        self.ndim = len(self.shape)
+        self.chunks = [tuple(chunk) for chunk in meta['chunks']]
+        self.attributes = meta['attributes']
+        for attribute, value in self.attributes.items():
+            if not hasattr(self, attribute):
+                setattr(self, attribute, value)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def ncattrs(self):
+        '''Names of the variable attributes'''
+        return list(self.attributes)
+
+    def __getitem__(self, index):
+        parts = wxcache.normalize(index, self.shape)
+        first = parts[0]
+        rest = tuple(slice(*part) if isinstance(part, tuple) else part
+                     for part in parts[1:])
+        if not isinstance(first, tuple):
+            first = (first, first + 1, 1)
+            rest = (0, ) + rest
+        else:
+            rest = (slice(None), ) + rest
+        steps = np.arange(*first)
+
+        pieces = []
+        missing = False
+        for chunk_start, chunk_stop, chunk_missing in self.chunks:
+            local = steps[(steps >= chunk_start) & (steps < chunk_stop)] - chunk_start
+            if not len(local):
+                continue
+            array = self.store.chunk(self.name, chunk_start)
+            if first[2] > 0:
+                array = array[local[0]:local[-1] + 1:first[2]]
+            else:
+                array = array[local]
+            pieces.append(array)
+            missing = missing or chunk_missing
+
+        if not pieces:
+            data = np.empty((0, ) + self.shape[1:], dtype=np.float32)
+        elif len(pieces) == 1:
+            data = pieces[0]
+        else:
+            data = np.concatenate(pieces)
+        data = data[rest]
+        if self.name in self.store.axes:
+            return data
+        if missing:
+            return np.ma.masked_invalid(data, copy=False)
+        return np.ma.array(data, copy=False)
+
+class FieldStore(object):
+    '''Stand-in for a netCDF4.Dataset that reads a store from local disk
+
+    Chunks are memory-mapped read-only on first use, so render processes
+    share one copy of the pages.
+    '''
+
+    axes = ('time', 'lat', 'lon')
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as handle:
+            meta = json.load(handle)
+        self.domain = meta['domain']
+        self.variables = dict((name, StoreVariable(self, name, variable))
+                              for name, variable in meta['variables'].items())
+        self._chunks = {}
+
+    def chunk(self, name, start):
+        '''Memory-mapped array of one chunk of a variable'''
+        if (name, start) not in self._chunks:
+            self._chunks[name, start] = np.load(
+                os.path.join(self.path, '{}.{}.npy'.format(name, start)), mmap_mode='r')
+        return self._chunks[name, start]
+
+    def close(self):
+        '''Drop the memory maps'''
+        self._chunks = {}
+
+def main(argv=None):
+    '''Ingest one model cycle into a store'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('model')
+    parser.add_argument('date')
+    parser.add_argument('cycle')
+    parser.add_argument('--area', default='MIDWEST')
+    parser.add_argument('--varnames', nargs='+', default=['apcpsfc', 'crainsfc',
+                                                          'csnowsfc', 'cicepsfc',
+                                                          'cfrzrsfc'])
+    parser.add_argument('--url', help='dataset to read instead of NOMADS')
+    parser.add_argument('--chunk', type=int, default=CHUNK)
+    parser.add_argument('--directory', default=STOREDIR)
+    args = parser.parse_args(argv)
+
+    url = args.url or wxdata.model(args.model, args.date, args.cycle)
+    netcdf = wxdata.openfile(url)
+    domain = wxdata.geodomain(netcdf, getattr(wxdata, args.area).coords)
+    path = ingest(netcdf, storepath(args.model, args.date, args.cycle, args.directory),
+                  args.varnames, domain, chunk=args.chunk)
+    wxdata.closefile(netcdf)
+    print('Stored', url, 'in', path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
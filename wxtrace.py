@@ -0,0 +1,168 @@
+'''TIME AND MEASURE EACH STAGE OF A RUN'''
+
+import collections
+import contextlib
+import functools
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peakmemory():
+    '''Peak resident memory of this process's lifetime in bytes, if known'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Records kept in full; older ones only count towards the stage totals
+MAXRECORDS = 10000
+
+class Trace(object):
+    '''Wall time, CPU time, bytes read and memory allocated by each stage
+
+    Stages are recorded with the stage() context manager, optionally per
+    frame, and written as one JSON trace per run. Totals per stage cover
+    the whole run, while only the latest maxrecords records are kept, so
+    a long-running watch does not grow without bound. Reads served from
+    a cache are counted as hits rather than bytes read.
+
+    Memory is traced with tracemalloc from the first stage on, and each
+    record's alloc_peak is the most memory allocated at once during the
+    stage, above what was allocated when it began.
+    '''
+
+    def __init__(self, name='run', sla=None, maxrecords=MAXRECORDS):
+        self.name = name
+        self.sla = sla
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.records = collections.deque(maxlen=maxrecords)
+        self.totals = collections.OrderedDict()
+        self._open = []
+        self._highest = []
+
+    def reset(self):
+        '''Forget every record, e.g. in a worker that hands its own back'''
+        self.records.clear()
+        self.totals.clear()
+
+    @contextlib.contextmanager
+    def stage(self, stage, frame=None, **info):
+        '''Record the stage around a block; set record['bytes'] inside it'''
+        record = {'stage': stage, 'frame': frame, 'bytes': 0}
+        record.update(info)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.foldpeak()
+        memory = tracemalloc.get_traced_memory()[0]
+        highest = {'memory': memory}
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        self._open.append(record)
+        self._highest.append(highest)
+        try:
+            yield record
+        finally:
+            self.foldpeak()
+            position = next(position for position in range(len(self._open) - 1, -1, -1)
+                            if self._open[position] is record)
+            del self._open[position], self._highest[position]
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['alloc_peak'] = highest['memory'] - memory
+            self.add(record)
+
+    def foldpeak(self):
+        '''Count the traced peak towards every open stage and start a new one
+
+        tracemalloc keeps one peak, so it is reset whenever a stage starts
+        or ends, and each open stage keeps the highest peak it has seen.
+        '''
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for highest in self._highest:
+            highest['memory'] = max(highest['memory'], peak)
+        tracemalloc.reset_peak()
+
+    def current(self):
+        '''Innermost stage being recorded, or a throwaway record outside any'''
+        return self._open[-1] if self._open else {}
+
+    def add(self, record):
+        '''Count a finished record towards its stage's totals and keep it'''
+        totals = self.totals.setdefault(record['stage'], {
+            'count': 0, 'wall': 0., 'cpu': 0., 'bytes': 0, 'hits': 0, 'hitbytes': 0,
+            'alloc_peak': 0})
+        totals['count'] += 1
+        totals['wall'] += record['wall']
+        totals['cpu'] += record['cpu']
+        totals['bytes'] += record['bytes']
+        if record.get('hit'):
+            totals['hits'] += 1
+            totals['hitbytes'] += record.get('hitbytes', 0)
+        totals['alloc_peak'] = max(totals['alloc_peak'], record.get('alloc_peak', 0))
+        self.records.append(record)
+
+    def merge(self, records):
+        '''Add the records that a worker process handed back'''
+        for record in records:
+            self.add(record)
+
+    def elapsed(self):
+        '''Wall time since the trace started'''
+        return time.perf_counter() - self.start
+
+    def oversla(self):
+        '''Whether the run has taken longer than its SLA in seconds'''
+        return self.sla is not None and self.elapsed() > self.sla
+
+    def summary(self):
+        '''Totals per stage, in the order the stages first ran'''
+        return collections.OrderedDict((stage, dict(totals))
+                                       for stage, totals in self.totals.items())
+
+    def table(self):
+        '''Summary table of the stages as text'''
+        lines = ['{:<14} {:>6} {:>10} {:>10} {:>14} {:>6} {:>10}'.format(
+            'stage', 'count', 'wall (s)', 'cpu (s)', 'bytes', 'hits', 'alloc (MB)')]
+        for stage, totals in self.summary().items():
+            lines.append('{:<14} {:>6} {:>10.3f} {:>10.3f} {:>14} {:>6} {:>10.1f}'.format(
+                stage, totals['count'], totals['wall'], totals['cpu'],
+                totals['bytes'], totals['hits'], totals['alloc_peak'] / 1024. ** 2))
+        lines.append('total wall {:.3f} s{}'.format(
+            self.elapsed(), ', over the SLA of {} s'.format(self.sla)
+            if self.oversla() else ''))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        '''Write the run trace as JSON'''
+        trace = {'name': self.name,
+                 'started': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                          time.gmtime(self.started)),
+                 'wall': self.elapsed(), 'sla': self.sla,
+                 'over_sla': self.oversla(), 'peak_rss': peakmemory(),
+                 'summary': self.summary(),
+                 'stages': list(self.records)}
+        with open(path, 'w') as handle:
+            json.dump(trace, handle, indent=1, default=str)
+
+# Trace that the library records into; scripts name it and write it out
+TRACE = Trace()
+
+def traced(stage):
+    '''Decorator that records every call of a function as a stage of TRACE'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with TRACE.stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,165 @@
+'''RENDER FORECAST HOURS AS A MODEL CYCLE IS PUBLISHED'''
+
+import copy
+import json
+import os
+import time
+import numpy as np
+import wxaccum
+import wxdata
+import wxparallel
+import wxtrace
+
+INTERVAL = 60
+MANIFEST = 'watch.json'
+ACCUMULATOR = 'accumulator.{}.npz'    # formatted with the steps it covers
+
+class Watch(object):
+    '''Poll a dataset and render only the timesteps not yet rendered
+
+    A manifest in directory records the rendered timesteps and names the
+    accumulation state saved beside it, so a restarted watch carries on
+    where the last one stopped. Both only move on once a poll's frames
+    are rendered, so a failed poll is simply repeated. render is called as
+    render(fields, step, start=start, validtimes=labels, **kwargs) where
+    fields[name][step - start] is the data of the absolute timestep step.
+    With accumulate set, fields[accumulate] holds the running
+    precipitation totals (of ptype only, if given).
+
+    NOMADS lists every forecast hour of a cycle in the time axis before
+    the data arrives, so a timestep only counts as published once the
+    probe variable has data in the domain.
+    '''
+
+    def __init__(self, url, select_model, area, render, varnames=(), directory='.',
+                 accumulate=None, ptype=None, probe=None, workers=1, **kwargs):
+        self.url = url
+        self.select_model = select_model
+        self.area = area
+        self.render = render
+        self.varnames = list(varnames)
+        self.directory = directory
+        self.accumulate = accumulate
+        self.ptype = ptype
+        self.probe = probe
+        self.workers = workers
+        self.kwargs = kwargs
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.manifest = {'url': url, 'rendered': {}}
+        self.accumulator = wxaccum.Accumulator(
+            wxaccum.BUCKETS.get(select_model, wxaccum.DEFAULT_BUCKET))
+        manifest = self.path(MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as handle:
+                saved = json.load(handle)
+            if saved['url'] == url:
+                self.manifest = saved
+                if saved.get('accumulator'):
+                    self.accumulator = wxaccum.Accumulator.load(
+                        self.path(saved['accumulator']))
+
+    def path(self, name):
+        '''Location of a file of the watch'''
+        return os.path.join(self.directory, name)
+
+    @property
+    def done(self):
+        '''Number of leading timesteps already rendered'''
+        return len(self.manifest['rendered'])
+
+    def published(self, netcdf, domain, steps):
+        '''Number of leading timesteps of the dataset that have data'''
+        if self.probe is None:
+            return steps
+        variable = netcdf.variables[self.probe]
+        for step in range(self.done, steps):
+            if np.ma.getmaskarray(wxdata.hyperslab(variable, domain, step, step + 1)).all():
+                return step
+        return steps
+
+    def poll(self):
+        '''Render the timesteps published since the last poll
+
+        Returns the number of new timesteps and the length of the time axis.
+        '''
+        # Reopened without the field cache, which would keep hyperslabs read
+        # before their data was published
+        netcdf = wxdata.openfile(self.url)
+        try:
+            timeaxis = wxdata.timeaxis(netcdf)
+            domain = wxdata.geodomain(netcdf, self.area.coords)
+            start = self.done
+            stop = self.published(netcdf, domain, len(timeaxis))
+            if stop <= start:
+                return 0, len(timeaxis)
+
+            varnames = list(self.varnames)
+            if self.accumulate is not None:
+                varnames += [name for name in ['apcpsfc', self.ptype]
+                             if name is not None and name not in varnames]
+            fields = wxdata.readfields(netcdf, varnames, domain, start, stop)
+        finally:
+            wxdata.closefile(netcdf)
+
+        # The carried state only advances once the frames are rendered
+        accumulator = copy.deepcopy(self.accumulator)
+        if self.accumulate is not None:
+            with wxtrace.TRACE.stage('accumulate'):
+                fields[self.accumulate] = accumulator.update(
+                    fields['apcpsfc'], timeaxis.forecasthours[start:stop],
+                    fields.get(self.ptype))
+
+        wxparallel.renderframes(self.render, fields, range(start, stop), self.workers,
+                                start=start, validtimes=timeaxis.labels(),
+                                **self.kwargs)
+        self.commit(accumulator, start, stop)
+        return stop - start, len(timeaxis)
+
+    def commit(self, accumulator, start, stop):
+        '''Record timesteps start to stop as rendered with accumulator's state
+
+        The state goes to a file of its own and the manifest is replaced
+        last, so a crash at any point leaves the two consistent.
+        '''
+        rendered = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        manifest = copy.deepcopy(self.manifest)
+        for step in range(start, stop):
+            manifest['rendered'][str(step)] = rendered
+        previous = manifest.get('accumulator')
+        if self.accumulate is not None:
+            manifest['accumulator'] = ACCUMULATOR.format(stop)
+            accumulator.save(self.path(manifest['accumulator']))
+        with open(self.path(MANIFEST) + '.part', 'w') as handle:
+            json.dump(manifest, handle, indent=1)
+        os.replace(self.path(MANIFEST) + '.part', self.path(MANIFEST))
+
+        self.manifest = manifest
+        self.accumulator = accumulator
+        if previous and previous != manifest.get('accumulator'):
+            os.remove(self.path(previous))
+
+    def run(self, interval=INTERVAL, steps=None, timeout=None):
+        '''Poll until steps (default: the whole time axis) are rendered
+
+        Gives up after timeout seconds, if given. Returns whether every
+        timestep was rendered.
+        '''
+        started = time.time()
+        while True:
+            try:
+                new, available = self.poll()
+            except (IOError, OSError, RuntimeError) as error:
+                # The dataset may not exist yet early in the cycle
+                print('Polling {} failed: {}'.format(self.url, error))
+                new, available = 0, None
+            if new:
+                print('Rendered timesteps {} to {}'.format(self.done - new, self.done - 1))
+
+            total = steps if steps is not None else available
+            if total is not None and self.done >= total:
+                return True
+            if timeout is not None and time.time() - started + interval > timeout:
+                return False
+            time.sleep(interval)